@@ -41,20 +41,46 @@ __author__ = 'Rob Ballou (rob.ballou@gmail.com)'
 __version__ = '1.0rc2'
 __license__ = 'MIT'
 
+import calendar
 import collections
 import re
 import datetime
+import copy
+import errno
+import math
 import os
+import random
+import sys
+import threading
+import time
+import types
+import urlparse
+import Queue
 import criteria
 import filters
 import inspect
+from cache import ListingCache
+from executor import RemovalExecutor, RemovalError
+from journal import DeletionJournal
+from layouts import KeyLayout
+from listing import ListingSnapshot
+from partition import DirectoryLeaseStore, PartitionWorker, SQLiteLeaseStore
+from names import ParsedName, parse_timestamp
+from mysql import BackupTable, ConnectionPool, DropPacer, fetch_backup_tables
+from pipeline import run_pipeline
+from simulated import SimulatedEC2Connection, SimulatedS3Connection
+from sources import KeyRecord, iter_inventory, iter_listing_file, iter_s3_keys
+from trees import remove_tree
+from trace import TraceSink
+from watch import DirectoryWatch
 
 try:
     from boto.s3.connection import S3Connection
     from boto.ec2.connection import EC2Connection
+    from boto.ec2.regioninfo import RegionInfo
     from boto.ec2.snapshot import Snapshot
 except ImportError:
-    pass
+    Snapshot = None
 
 CRITERIA = {
     # 'has_date': criteria.HasDate,
@@ -63,17 +89,95 @@ CRITERIA = {
 
 FILTERS = {}
 
+# shared listing cache, see enable_listing_cache()
+LISTING_CACHE = None
+
+# z values for the two-sided confidence intervals of estimate()
+CONFIDENCE_Z = {0.8: 1.2816, 0.9: 1.6449, 0.95: 1.96, 0.98: 2.3263, 0.99: 2.5758}
+
+# more keys than this right under the directory and estimate() treats the bucket as flat
+FLAT_KEYS = 1000
+
+# EC2 error codes that mean the snapshot is already gone
+SNAPSHOT_GONE_ERROR_CODES = ['InvalidSnapshot.NotFound']
+
+
+class ListingError(Exception):
+    """
+    Raised by list_sources() when some sources could not be listed. The
+    `failures` attribute is a list of (source, exception) tuples.
+    """
+    def __init__(self, message, failures):
+        super(ListingError, self).__init__(message)
+        self.failures = failures
+
+
 def add_criteria(class_name):
     CRITERIA.append(class_name)
 
 
-def connect_to_ec2(aws_access_key_id, aws_secret_access_key):
+def aggregate(directory='./', items=None, s3bucket=None, ec2snapshots=None, aws_access_key_id=None,
+              aws_secret_access_key=None, by='day', kind='items', page_size=1000, **kwargs):
+    """
+    Count the items that meet the criteria (see meets_criteria()) and add up their sizes per calendar
+    `by` ('year', 'month', 'day' or 'hour'), e.g. for capacity dashboards.
+
+    The source is streamed a page of `page_size` items at a time (or `items` are used, if given) and
+    only the totals are kept, so memory depends on the number of buckets and not on the number of
+    items. `kind` is 'archives', 'logs' or 'items' like for rotate(). Sizes come from S3 keys,
+    snapshot volumes (counted in bytes like the rest) or the files themselves.
+
+    Returns an OrderedDict of bucket start (a datetime) -> {'count': ..., 'bytes': ...}, oldest first.
+    """
+    # the start of the bucket each date falls in
+    buckets = {
+        'year': lambda date: datetime.datetime(date.year, 1, 1),
+        'month': lambda date: datetime.datetime(date.year, date.month, 1),
+        'day': lambda date: datetime.datetime(date.year, date.month, date.day),
+        'hour': lambda date: datetime.datetime(date.year, date.month, date.day, date.hour),
+    }
+    if by not in buckets:
+        raise Exception('Unknown bucket <%s>, use year, month, day or hour' % by)
+    check = _kind_check(kind, ec2snapshots)
+    _reject_filters(kwargs)
+
+    if items is None:
+        source = _open_source(s3bucket, ec2snapshots, aws_access_key_id, aws_secret_access_key, kwargs)
+        pages = _iter_source_pages(directory, s3bucket, ec2snapshots, page_size, **source)
+    else:
+        _source_arguments(kwargs)
+        pages = [items]
+
+    bucket_start = buckets[by]
+    criteria_plan = _criteria_plan(kwargs, directory)
+    totals = {}
+    for page in pages:
+        for item in page:
+            if not check(item):
+                continue
+            filename = _item_name(item)
+            name = criteria_plan.parse(filename, item)
+            if not criteria_plan.test_parsed(filename, name) or not name['date']:
+                continue
+            bucket = bucket_start(name['date'])
+            if bucket not in totals:
+                totals[bucket] = {'count': 0, 'bytes': 0}
+            totals[bucket]['count'] += 1
+            totals[bucket]['bytes'] += _item_size(item, directory)
+    return collections.OrderedDict(sorted(totals.items()))
+
+
+def connect_to_ec2(aws_access_key_id, aws_secret_access_key, endpoint=None):
     """
     Connect to the ec2 account
 
     Using the boto library, we'll connect to the S3 account. If aws_access_key_id and
     aws_secret_access_key are None, we'll check out the environment variables. If no
     authentication information is found, you'll get an Exception.
+
+    If `endpoint` is given (for example "http://localhost:5000"), we'll talk to that
+    host instead of the default EC2 region. Useful for testing against a local fake
+    EC2 service.
     """
     if not aws_secret_access_key and not os.environ['AWS_SECRET_ACCESS_KEY']:
         raise Exception('The AWS_SECRET_ACCESS_KEY was not set. Either set this environment variable or pass it as aws_secret_access_key')
@@ -83,6 +187,11 @@ def connect_to_ec2(aws_access_key_id, aws_secret_access_key):
         aws_access_key_id = os.environ['AWS_ACCESS_KEY_ID']
     if not aws_secret_access_key:
         aws_secret_access_key = os.environ['AWS_SECRET_ACCESS_KEY']
+    if endpoint:
+        url = urlparse.urlparse(endpoint)
+        region = RegionInfo(name='endpoint', endpoint=url.hostname)
+        return EC2Connection(aws_access_key_id, aws_secret_access_key, region=region,
+                             port=url.port, is_secure=(url.scheme == 'https'), path=url.path or '/')
     return EC2Connection(aws_access_key_id, aws_secret_access_key)
 
 
@@ -105,6 +214,111 @@ def connect_to_s3(aws_access_key_id, aws_secret_access_key):
     return S3Connection(aws_access_key_id, aws_secret_access_key)
 
 
+def disable_listing_cache():
+    """
+    Stop caching listings and drop everything in the cache
+    """
+    global LISTING_CACHE
+    if LISTING_CACHE is not None:
+        LISTING_CACHE.clear()
+    LISTING_CACHE = None
+
+
+def enable_listing_cache(ttl=300, max_entries=64):
+    """
+    Cache listings so that list_archives, list_items and list_logs calls for the same source (directory,
+    S3 bucket and prefix, or EC2 snapshot filters) only list it once within `ttl` seconds. Up to
+    `max_entries` listings are kept, dropping the least recently used first. remove_items() invalidates
+    the listings for the source it removes from.
+
+    Returns the ListingCache.
+    """
+    global LISTING_CACHE
+    LISTING_CACHE = ListingCache(ttl=ttl, max_entries=max_entries)
+    return LISTING_CACHE
+
+
+def estimate(s3bucket, directory='', prefixes=None, sample=10, spacing='random', seed=None, confidence=0.95,
+             kind='archives', aws_access_key_id=None, aws_secret_access_key=None, **kwargs):
+    """
+    Estimate how many keys, and how many bytes, of a huge bucket meet the criteria (see meets_criteria())
+    without listing all of it, e.g. to try out a retention change.
+
+    The keys under `directory` are split into prefixes: the given `prefixes`, or the common prefixes one
+    '/' below `directory`, found with a single delimited listing. In a flat bucket (more than FLAT_KEYS
+    keys right under `directory`) the keys are split by their leading characters instead, into about
+    10 * `sample` prefixes found with one single page listing each. `sample` of the prefixes are picked
+    at random (`seed` makes the pick repeatable) or evenly spaced (`spacing='even'`), listed in full and
+    tested. Keys right under `directory` (or, in a flat bucket, keys that are a whole prefix) are
+    counted exactly. The cost is that of listing the sampled prefixes.
+
+    Returns a dictionary with the number of 'prefixes', how many were 'sampled', and estimates of the
+    keys 'listed', 'matched' and their 'bytes' for the whole bucket. Each estimate is a dictionary with
+    the 'estimate' and the 'low' and 'high' ends of its `confidence` interval.
+    """
+    if confidence not in CONFIDENCE_Z:
+        raise Exception('Unknown confidence <%s>, use one of %s' % (confidence, sorted(CONFIDENCE_Z)))
+    check = _kind_check(kind)
+    if directory == './':
+        directory = ''
+
+    source = _open_source(s3bucket, None, aws_access_key_id, aws_secret_access_key, kwargs)
+    bucket = source['s3_connection'].get_bucket(s3bucket)
+    criteria_plan = _criteria_plan(kwargs, directory)
+
+    def tally(keys):
+        totals = {'listed': 0, 'matched': 0, 'bytes': 0}
+        for key in keys:
+            totals['listed'] += 1
+            if check(key) and criteria_plan.matches(_item_name(key), key):
+                totals['matched'] += 1
+                totals['bytes'] += key.size or 0
+        return totals
+
+    exact = {'listed': 0, 'matched': 0, 'bytes': 0}
+    if prefixes is None:
+        prefixes = []
+        keys = []
+        for entry in bucket.list(directory, '/'):
+            # common prefixes have a name but no key
+            if hasattr(entry, 'key'):
+                keys.append(entry)
+                if len(keys) > FLAT_KEYS:
+                    break
+            else:
+                prefixes.append(entry.name)
+        if len(keys) > FLAT_KEYS:
+            # listing on would list (nearly) every key
+            prefixes, keys = _split_by_characters(bucket, directory, 10 * sample)
+        exact = tally(keys)
+
+    population = len(prefixes)
+    sampled = min(sample, population)
+    if spacing == 'random':
+        chosen = random.Random(seed).sample(prefixes, sampled)
+    elif spacing == 'even':
+        chosen = [prefixes[i * population // sampled] for i in range(sampled)]
+    else:
+        raise Exception('Unknown spacing <%s>, use random or even' % spacing)
+    clusters = [tally(bucket.list(prefix)) for prefix in chosen]
+
+    # cluster sampling: scale the mean per prefix up to every prefix, with a finite population correction
+    z = CONFIDENCE_Z[confidence]
+    result = {'prefixes': population, 'sampled': sampled}
+    for field in ['listed', 'matched', 'bytes']:
+        values = [cluster[field] for cluster in clusters]
+        total = exact[field]
+        error = 0.0
+        if sampled:
+            mean = float(sum(values)) / sampled
+            total += population * mean
+            if sampled > 1:
+                variance = sum((value - mean) ** 2 for value in values) / (sampled - 1)
+                error = z * population * math.sqrt((1 - float(sampled) / population) * variance / sampled)
+        result[field] = {'estimate': total, 'low': max(exact[field], total - error), 'high': total + error}
+    return result
+
+
 def filter_criteria(items, **kwargs):
     """
     Similar to meets_criteria() but fires afterwards and can filter the entire set (meets_criteria()
@@ -202,6 +416,10 @@ def is_log(fn):
     Returns True/False
     """
     extensions = ['.log']
+    try:
+        fn = fn.key
+    except:
+        pass
     basename, extension = os.path.splitext(fn)
     if extension in extensions:
         return True
@@ -219,37 +437,261 @@ def list_archives(directory='./', items=None, s3bucket=None, ec2snapshots=None,
     If `s3bucket` is used, we'll connect to the S3 account/bucket to look for items. If used in
     conjuction with `directory`, that will be used as the file prefix.
 
-    If `ec2snapshots` is used, we'll connect to AWS account and look for snapshots.
+    If `ec2snapshots` is used, we'll connect to AWS account and look for snapshots. The following
+    kwargs are sent to EC2 as filters so that only matching snapshots are returned by the API:
+
+      - snapshot_tags (dict of tag name -> value or list of values)
+      - snapshot_volume (volume id or list of volume ids)
+      - snapshot_status (status or list of statuses, e.g. 'completed')
+
+    Snapshots are requested `snapshot_page_size` at a time (default: 1000). An existing boto
+    connection can be given as `ec2_connection`, or an alternative endpoint as `ec2_endpoint`.
+
+    With `inventory` (a local S3 Inventory manifest.json, CSV file or list of CSV files, plain or gzipped),
+    the keys are read from the inventory instead of listing the bucket. `directory` is still used as
+    the key prefix and `s3bucket` (if given) picks the bucket's rows. Set `inventory_schema` to the list
+    of column names if the files are not described by a manifest.
+
+    With `listing_file` (a newline-delimited file of names, plain or gzipped, such as `find` output), the
+    names are read from the file instead of listing the source.
+
+    Inventory and listing file sources are streamed: a generator is returned instead of a list, so
+    memory use stays the same however big the files are.
+
+    With `as_snapshot=True` a ListingSnapshot is returned instead of a list. It can be passed back as
+    `items` to any of the list_* functions to query it again without listing or parsing anything.
 
     See meets_criteria() for list of kwargs that can be used to limit the results.
     """
+    items = _source_items(items, directory, s3bucket, ec2snapshots, aws_access_key_id, aws_secret_access_key, kwargs)
 
-    if not items:
-        if not s3bucket and not ec2snapshots:
-            # regular file system request
-            items = os.listdir(directory)
-        elif s3bucket and not ec2snapshots:
-            # s3 request
-            try:
+    if ec2snapshots:
+        # every snapshot is an archive
+        return _select(directory, items, lambda archive: True, **kwargs)
+
+    return _select(directory, items, is_archive, **kwargs)
+
+
+def _iter_source_pages(directory='./', s3bucket=None, ec2snapshots=None, page_size=1000, s3_connection=None,
+                       ec2_connection=None, ec2_endpoint=None, snapshot_filters=None, snapshot_page_size=1000, partition=None,
+                       inventory=None, inventory_schema=None, listing_file=None, s3_records=False, key_layout=None,
+                       layout_criteria=None):
+    """
+    List the source like _list_source(), but yield it one page of `page_size` items at a time as
+    the pages come in (the listing cache is not used). Connections must already be open.
+    """
+    if listing_file:
+        pages = _chunks(iter_listing_file(listing_file, '' if directory == './' or not s3bucket else directory), page_size)
+    elif inventory:
+        pages = _chunks(iter_inventory(inventory, inventory_schema, '' if directory == './' else directory, s3bucket), page_size)
+    elif ec2snapshots:
+        pages = _iter_ec2_snapshot_pages(ec2_connection, _ec2_snapshot_params(ec2_connection, snapshot_filters, page_size))
+    elif s3bucket:
+        if directory == './':
+            directory = ''
+        if key_layout is not None:
+            pages = _chunks(_iter_key_layout(s3_connection, s3bucket, directory, key_layout, layout_criteria or {}, s3_records),
+                            page_size)
+        elif s3_records:
+            pages = _chunks(iter_s3_keys(s3_connection, s3bucket, directory, page_size), page_size)
+        else:
+            pages = _chunks(s3_connection.get_bucket(s3bucket).list(directory), page_size)
+    else:
+        pages = _chunks(os.listdir(directory), page_size)
+
+    if partition is None:
+        for page in pages:
+            yield page
+        return
+    with partition.renewing():
+        for page in pages:
+            yield [item for item in page if partition.owns(_item_id(item))]
+
+
+def _iter_key_layout(s3, s3bucket, directory, key_layout, layout_criteria, s3_records=False, cached=False):
+    """
+    Yield the keys under `directory` that could meet the criteria, listing only the prefixes and key
+    ranges the key layout gives for them (see KeyLayout.listings()). With `cached`, whole prefixes are
+    listed through _list_source() so they can come from the listing cache.
+    """
+    if not isinstance(key_layout, KeyLayout):
+        key_layout = KeyLayout(key_layout)
+    for prefix, marker, stop in key_layout.listings(directory, layout_criteria):
+        if cached and marker is None and stop is None:
+            keys = _list_source(prefix, s3bucket, s3_connection=s3, s3_records=s3_records)
+        elif s3_records:
+            keys = iter_s3_keys(s3, s3bucket, prefix, marker=marker or '')
+        else:
+            keys = s3.get_bucket(s3bucket).list(prefix, marker=marker or '')
+        for key in keys:
+            if stop is not None and _item_name(key) >= stop:
+                # keys come in order, the rest are past the range
+                break
+            yield key
+
+
+def _list_partition(partition, directory='./', s3bucket=None, ec2snapshots=None, aws_access_key_id=None,
+                    aws_secret_access_key=None, **source):
+    """
+    List only the items in the partitions held by a PartitionWorker, renewing its leases while the
+    listing runs. With prefix partitions on S3, only the owned prefixes are listed; with hash
+    partitions the whole source is listed and filtered.
+    """
+    with partition.renewing():
+        return _list_partition_items(partition, directory, s3bucket, ec2snapshots, aws_access_key_id,
+                                     aws_secret_access_key, **source)
+
+
+def _list_partition_items(partition, directory='./', s3bucket=None, ec2snapshots=None, aws_access_key_id=None,
+                          aws_secret_access_key=None, **source):
+    if s3bucket and partition.prefixes:
+        if directory == './':
+            directory = ''
+        prefixes = []
+        for prefix in partition.owned_prefixes():
+            if prefix.startswith(directory) and prefix not in prefixes:
+                prefixes.append(prefix)
+            elif directory.startswith(prefix) and directory not in prefixes:
+                prefixes.append(directory)
+        items = []
+        for prefix in prefixes:
+            items.extend(_list_source(prefix, s3bucket, None, aws_access_key_id, aws_secret_access_key, **source))
+    else:
+        items = _list_source(directory, s3bucket, ec2snapshots, aws_access_key_id, aws_secret_access_key, **source)
+    return [item for item in items if partition.owns(_item_id(item))]
+
+
+def _list_source(directory='./', s3bucket=None, ec2snapshots=None, aws_access_key_id=None, aws_secret_access_key=None,
+                 s3_connection=None, ec2_connection=None, ec2_endpoint=None, snapshot_filters=None, snapshot_page_size=1000,
+                 partition=None, inventory=None, inventory_schema=None, listing_file=None, s3_records=False,
+                 key_layout=None, layout_criteria=None):
+    """
+    List everything in the directory, the S3 bucket (using `directory` as the prefix) or the EC2
+    snapshots for the account. Listings are shared through the listing cache when it is enabled
+    (see enable_listing_cache()).
+
+    If `partition` (a PartitionWorker) is given, only the items in its partitions are returned.
+
+    If `inventory` (see rotatelib.sources.inventory_files()) is given, the keys are read from local
+    S3 Inventory files instead of listing the bucket. If `listing_file` is given, the names are read
+    from that newline-delimited file. Both are streamed (as KeyRecords and names) and never cached.
+
+    With `s3_records`, S3 keys are listed as KeyRecords parsed straight from the ListObjects responses
+    (see rotatelib.sources.iter_s3_keys()) instead of boto Key objects.
+
+    With a `key_layout` (see KeyLayout), only the S3 prefixes and key ranges that can hold keys meeting
+    the `layout_criteria` are listed. Whole prefixes go through the listing cache, key ranges do not.
+    """
+    if partition is not None:
+        return _list_partition(partition, directory, s3bucket, ec2snapshots, aws_access_key_id, aws_secret_access_key,
+                               s3_connection=s3_connection, ec2_connection=ec2_connection, ec2_endpoint=ec2_endpoint,
+                               snapshot_filters=snapshot_filters, snapshot_page_size=snapshot_page_size,
+                               inventory=inventory, inventory_schema=inventory_schema, listing_file=listing_file,
+                               s3_records=s3_records, key_layout=key_layout, layout_criteria=layout_criteria)
+
+    if listing_file:
+        return iter_listing_file(listing_file, '' if directory == './' or not s3bucket else directory)
+    if inventory:
+        if directory == './':
+            directory = ''
+        return iter_inventory(inventory, inventory_schema, directory, s3bucket)
+
+    if s3bucket and ec2snapshots:
+        raise Exception('Use either s3bucket or ec2snapshots, not both')
+
+    if s3bucket and key_layout is not None:
+        if directory == './':
+            directory = ''
+        s3 = s3_connection or connect_to_s3(aws_access_key_id, aws_secret_access_key)
+        return list(_iter_key_layout(s3, s3bucket, directory, key_layout, layout_criteria or {}, s3_records, cached=True))
+
+    if not s3bucket and not ec2snapshots:
+        key = ('file', os.path.abspath(directory), '')
+    elif s3bucket:
+        if directory == './':
+            directory = ''
+        key = ('s3', s3bucket, directory)
+        if s3_records:
+            # KeyRecords and boto Keys are cached apart
+            key += ('records',)
+    else:
+        key = ('ec2', ec2_endpoint or '', repr(sorted((snapshot_filters or {}).items())))
+
+    if LISTING_CACHE is not None:
+        items = LISTING_CACHE.get(key)
+        if items is not None:
+            return items
+
+    if not s3bucket and not ec2snapshots:
+        # regular file system request
+        items = os.listdir(directory)
+    elif s3bucket:
+        # s3 request
+        try:
+            s3 = s3_connection
+            if s3 is None:
                 s3 = connect_to_s3(aws_access_key_id, aws_secret_access_key)
+            if s3_records:
+                items = list(iter_s3_keys(s3, s3bucket, directory))
+            else:
                 bucket = s3.get_bucket(s3bucket)
-                if directory == './':
-                    directory = ''
                 items = [item for item in bucket.list(directory)]
-            except NameError, e:
-                raise Exception('To use the S3 library, you must have the boto python library: %s' % e)
-        elif ec2snapshots and not s3bucket:
-            # ec2 request
-            try:
-                ec2 = connect_to_ec2(aws_access_key_id, aws_secret_access_key)
-                items = ec2.get_all_snapshots(owner='self')
-            except NameError, e:
-                raise Exception('To use the EC2 library, you must have the boto python library: %s' % e)
+        except NameError, e:
+            raise Exception('To use the S3 library, you must have the boto python library: %s' % e)
+    else:
+        # ec2 request
+        try:
+            ec2 = ec2_connection
+            if ec2 is None:
+                ec2 = connect_to_ec2(aws_access_key_id, aws_secret_access_key, endpoint=ec2_endpoint)
+            items = list_ec2_snapshots(ec2, filters=snapshot_filters, page_size=snapshot_page_size)
+        except NameError, e:
+            raise Exception('To use the EC2 library, you must have the boto python library: %s' % e)
+
+    if LISTING_CACHE is not None:
+        LISTING_CACHE.put(key, items)
+    return items
 
-    items = [archive for archive in items if is_archive(archive) and meets_criteria(directory, archive, **kwargs)]
+
+def _source_items(items, directory, s3bucket, ec2snapshots, aws_access_key_id, aws_secret_access_key, kwargs,
+                  layout_criteria=None):
+    """
+    The items given to a list_* function, or a listing of the source if there were none. Pops the
+    source arguments (see _source_arguments()) from kwargs. A key layout is given the rest of kwargs,
+    or `layout_criteria` if set, as the criteria to list for.
+    """
+    source = _source_arguments(kwargs)
+    if isinstance(items, ListingSnapshot):
+        return items
+    if source['key_layout'] is not None:
+        source['layout_criteria'] = kwargs if layout_criteria is None else layout_criteria
+    if not items:
+        return _list_source(directory, s3bucket, ec2snapshots, aws_access_key_id, aws_secret_access_key, **source)
+    if source['partition'] is not None:
+        return [item for item in items if source['partition'].owns(_item_id(item))]
     return items
 
 
+def _source_arguments(kwargs):
+    """
+    Pop the kwargs that describe how to list a source (as opposed to criteria)
+    """
+    return {
+        's3_connection': kwargs.pop('s3_connection', None),
+        'ec2_connection': kwargs.pop('ec2_connection', None),
+        'ec2_endpoint': kwargs.pop('ec2_endpoint', None),
+        'snapshot_filters': _snapshot_filters(kwargs),
+        'snapshot_page_size': kwargs.pop('snapshot_page_size', 1000),
+        'partition': kwargs.pop('partition', None),
+        'inventory': kwargs.pop('inventory', None),
+        'inventory_schema': kwargs.pop('inventory_schema', None),
+        'listing_file': kwargs.pop('listing_file', None),
+        's3_records': kwargs.pop('s3_records', False),
+        # left in kwargs, the criteria read the dates with it too (see _criteria_plan())
+        'key_layout': kwargs.get('key_layout'),
+    }
+
+
 def list_backup_tables(db, db_type=None, **kwargs):
     """
     Find backed up tables in the database
@@ -278,10 +720,64 @@ def list_backup_tables(db, db_type=None, **kwargs):
     if not tables:
         raise Exception('Could not figure out the database type or get a list of tables')
 
-    backup_tables = [table for table in tables if is_backup_table(table) and meets_criteria(db, table, **kwargs)]
+    plan = _criteria_plan(kwargs)
+    backup_tables = [table for table in tables if is_backup_table(table) and plan.matches(table)]
     return backup_tables
 
 
+def list_directories(directory='./', items=None, **kwargs):
+    """
+    List the subdirectories of the directory with dated names (e.g. 2026-10-01T0300/) that meet the
+    criteria (see meets_criteria()). Remove them with remove_items(..., trees=True).
+    """
+    items = _source_items(items, directory, None, None, None, None, kwargs)
+    return _select(directory, items, lambda name: os.path.isdir(os.path.join(directory, _item_name(name))), **kwargs)
+
+
+def list_ec2_snapshots(ec2, filters=None, page_size=1000):
+    """
+    Get the snapshots owned by the connected account, one page at a time.
+
+    `filters` is a dictionary of EC2 filter names and values (see _snapshot_filters()) that is
+    applied by the API so that non-matching snapshots never leave AWS.
+    """
+    params = _ec2_snapshot_params(ec2, filters, page_size)
+    snapshots = []
+    for page in _iter_ec2_snapshot_pages(ec2, params):
+        snapshots.extend(page)
+    return snapshots
+
+
+def _dated_entries(plan, items):
+    """
+    (item, parsed name) for the items that have a date and meet the criteria
+    """
+    for item in items:
+        filename = _item_name(item)
+        name = plan.parse(filename, item)
+        if plan.test_parsed(filename, name) and name['date']:
+            yield item, name
+
+
+def _ec2_snapshot_params(ec2, filters, page_size):
+    params = {}
+    ec2.build_list_params(params, 'self', 'Owner')
+    if filters:
+        ec2.build_filter_params(params, filters)
+    if page_size:
+        params['MaxResults'] = page_size
+    return params
+
+
+def _iter_ec2_snapshot_pages(ec2, params):
+    while True:
+        page = ec2.get_list('DescribeSnapshots', params, [('item', Snapshot)], verb='POST')
+        yield page
+        if not getattr(page, 'next_token', None):
+            break
+        params['NextToken'] = page.next_token
+
+
 def list_items(directory='./', items=None, s3bucket=None, aws_access_key_id=None, aws_secret_access_key=None, **kwargs):
     """
     List all of the items that meet the criteria
@@ -289,28 +785,19 @@ def list_items(directory='./', items=None, s3bucket=None, aws_access_key_id=None
     This method is very similar to the list_archives and list_logs methods, but allows you to find
     items that are not logs or archives.
     """
-    if not items:
-        if not s3bucket:
-            # regular file system request
-            items = os.listdir(directory)
-        else:
-            # s3 request
-            try:
-                s3 = connect_to_s3(aws_access_key_id, aws_secret_access_key)
-                bucket = s3.get_bucket(s3bucket)
-                if directory == './':
-                    directory = ''
-                items = [item for item in bucket.list(directory)]
-            except NameError, e:
-                raise Exception('To use the S3 library, you must have the boto python library: %s', e)
-    items = [archive for archive in items if has_date(archive) and meets_criteria(directory, archive, **kwargs)]
-
-    filter_items = []
-    for item in items:
-        filter_items.append({
-          'item': item,
-          'parsed': parse_name(item)
-        })
+    items = _source_items(items, directory, s3bucket, None, aws_access_key_id, aws_secret_access_key, kwargs)
+    if kwargs.get('as_snapshot'):
+        check = has_date
+        if kwargs.get('date_source', 'name') != 'name':
+            # the date isn't in the name, the criteria will look for it
+            check = lambda item: True
+        return _select(directory, items, check, **kwargs)
+    if isinstance(items, ListingSnapshot):
+        filter_items = [{'item': entry[1], 'parsed': entry[2]} for entry in items.entries(**kwargs)]
+    elif isinstance(items, types.GeneratorType):
+        filter_items = ({'item': item, 'parsed': name} for item, name in _dated_entries(_criteria_plan(kwargs, directory), items))
+    else:
+        filter_items = [{'item': item, 'parsed': name} for item, name in _dated_entries(_criteria_plan(kwargs, directory), items)]
     items = filter_criteria(filter_items, **kwargs)
 
     return items
@@ -326,22 +813,145 @@ def list_logs(directory='./', items=None, s3bucket=None, aws_access_key_id=None,
 
     See meets_criteria() for list of kwargs that can be used to limit the results.
     """
-    if not items:
-        if not s3bucket:
-            # regular file system request
-            items = os.listdir(directory)
-        else:
-            # s3 request
+    items = _source_items(items, directory, s3bucket, None, aws_access_key_id, aws_secret_access_key, kwargs)
+    return _select(directory, items, is_log, **kwargs)
+
+
+def list_sources(sources, max_workers=16, timeout=None, **kwargs):
+    """
+    List and evaluate many sources at once, e.g. hundreds of tenant buckets and local volumes.
+
+    `sources` is a list (or any iterable) of sources. Each source is a dictionary of arguments for
+    list_archives(), for example {'directory': '/backups/'}, {'s3bucket': 'tenant-1', 'directory': 'db/'}
+    or {'ec2snapshots': True}. Add a `kind` of 'items', 'logs',
+    'directories' or 'backup_tables' to use list_items(), list_logs(), list_directories() or list_backup_tables() instead (the latter needs
+    a `db`). kwargs are criteria for every source; a source can override them with its own.
+
+    Every source is checked before any is listed, so a bad source fails at once. Up to `max_workers`
+    sources are listed at the same time. Yields (source, item) tuples as soon as each source is done,
+    so the total time is set by the slowest source; sources not done after `timeout` seconds (if
+    given) count as failed. If any source fails, the rest are still listed and a ListingError is
+    raised at the end.
+    """
+    functions = {
+        'archives': list_archives,
+        'backup_tables': list_backup_tables,
+        'directories': list_directories,
+        'items': list_items,
+        'logs': list_logs,
+    }
+    sources = list(sources)
+    prepared = []
+    for source in sources:
+        arguments = dict(kwargs)
+        arguments.update(source)
+        kind = arguments.pop('kind', 'archives')
+        if kind not in functions:
+            raise Exception('Unknown source kind <%s>' % kind)
+        _check_source(functions[kind], arguments)
+        prepared.append((source, functions[kind], arguments))
+
+    def list_source(source):
+        return list(source[1](**source[2]))
+
+    failures = []
+    results = _fan_out(list_source, prepared, max_workers, timeout)
+    try:
+        for (source, function, arguments), items, error in results:
+            if error:
+                failures.append((source, error))
+                continue
+            for item in items:
+                yield source, item
+    finally:
+        results.close()
+
+    if failures:
+        raise ListingError('Could not list %d of %d sources' % (len(failures), len(sources)), failures)
+
+
+def _check_source(function, arguments):
+    """
+    Raise if the arguments for one of list_sources()'s sources could never be listed
+    """
+    try:
+        inspect.getcallargs(function, **arguments)
+    except TypeError, e:
+        raise Exception('Bad source for %s: %s' % (function.__name__, e))
+    if arguments.get('s3bucket') and arguments.get('ec2snapshots'):
+        raise Exception('Use either s3bucket or ec2snapshots, not both')
+    if arguments.get('date_source', 'name') not in ['name', 'timestamp', 'mtime']:
+        raise Exception('Unknown date_source <%s>, use name, timestamp or mtime' % arguments['date_source'])
+    if arguments.get('key_layout') is not None and not isinstance(arguments['key_layout'], KeyLayout):
+        KeyLayout(arguments['key_layout'])
+
+
+def _fan_out(func, sources, max_workers, timeout=None):
+    """
+    Call func(source) for every source on up to `max_workers` threads. Yields (source, result, error)
+    tuples as each call finishes. Sources not finished after `timeout` seconds (if given) are yielded
+    with an error instead.
+    """
+    work = Queue.Queue()
+    for i, source in enumerate(sources):
+        work.put((i, source))
+    results = Queue.Queue(maxsize=max_workers * 2)
+    stopped = threading.Event()
+
+    def worker():
+        while not stopped.is_set():
             try:
-                s3 = connect_to_s3(aws_access_key_id, aws_secret_access_key)
-                bucket = s3.get_bucket(s3bucket)
-                if directory == './':
-                    directory = ''
-                items = [item for item in bucket.list(directory)]
-            except NameError, e:
-                raise Exception('To use the S3 library, you must have the boto python library: %s', e)
-    items = [archive for archive in items if is_log(archive) and meets_criteria(directory, archive, **kwargs)]
-    return items
+                i, source = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = (i, source, func(source), None)
+            except Exception, e:
+                result = (i, source, None, e)
+            while not stopped.is_set():
+                try:
+                    results.put(result, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+
+    threads = [threading.Thread(target=worker) for i in range(min(max_workers, len(sources)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    done = set()
+    deadline = None if timeout is None else time.time() + timeout
+    try:
+        while len(done) < len(sources):
+            # wait in short steps, so the deadline (and Ctrl-C) is noticed
+            wait = 0.1
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    for i, source in enumerate(sources):
+                        if i not in done:
+                            yield source, None, Exception('No result after %s seconds' % timeout)
+                    return
+            try:
+                i, source, result, error = results.get(timeout=wait)
+            except Queue.Empty:
+                continue
+            done.add(i)
+            yield source, result, error
+    finally:
+        stopped.set()
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def _make_list(item):
@@ -350,6 +960,81 @@ def _make_list(item):
     return item
 
 
+def _snapshot_filters(kwargs):
+    """
+    Pop the snapshot_* filter kwargs and translate them into EC2 API filters
+    """
+    snapshot_filters = {}
+    tags = kwargs.pop('snapshot_tags', None) or {}
+    for tag in tags:
+        snapshot_filters['tag:%s' % tag] = tags[tag]
+    volume = kwargs.pop('snapshot_volume', None)
+    if volume:
+        snapshot_filters['volume-id'] = volume
+    status = kwargs.pop('snapshot_status', None)
+    if status:
+        snapshot_filters['status'] = status
+    return snapshot_filters
+
+
+def _item_name(item):
+    """
+    Figure out the name to test for this item (snapshot description, S3 key or the filename itself)
+    """
+    # the common cases, without probing for attributes
+    if isinstance(item, basestring):
+        return item
+    if isinstance(item, KeyRecord):
+        return item.key
+    try:
+        return item.description
+    except:
+        try:
+            return item.key
+        except:
+            return item
+
+
+def _item_id(item):
+    """
+    A stable name for an item: snapshot ids, S3 keys and file or table names
+    """
+    if isinstance(item, dict):
+        item = item['item']
+    if isinstance(item, BackupTable):
+        return str(item)
+    if getattr(item, 'id', None):
+        return item.id
+    return _item_name(item)
+
+
+def _select(directory, items, check, as_snapshot=False, **kwargs):
+    """
+    Pick the items that pass `check` and meet the criteria. Returns a list, a generator if `items`
+    is one, or a ListingSnapshot when `as_snapshot` is set. If `items` is already a ListingSnapshot,
+    it is queried instead.
+    """
+    if isinstance(items, ListingSnapshot):
+        return [item for item in items.query(**kwargs) if check(item)]
+
+    plan = _criteria_plan(kwargs, directory)
+    if not as_snapshot and isinstance(items, types.GeneratorType):
+        # streamed from a file, keep it streaming
+        return (item for item in items if check(item) and plan.matches(_item_name(item), item))
+    if not as_snapshot:
+        return [item for item in items if check(item) and plan.matches(_item_name(item), item)]
+
+    entries = []
+    for item in items:
+        if not check(item):
+            continue
+        filename = _item_name(item)
+        name = plan.parse(filename, item)
+        if plan.test_parsed(filename, name):
+            entries.append((filename, item, name))
+    return ListingSnapshot(entries, _test_criteria)
+
+
 def meets_criteria(directory, filename, **kwargs):
     """
     Current criteria:
@@ -366,55 +1051,94 @@ def meets_criteria(directory, filename, **kwargs):
       - startswith (string or list of strings)
       - pattern (regex)
       - year (int or list of ints)
+
+    Pass a TraceSink as `trace` to record how each item was evaluated (see rotatelib.trace).
+
+    `date_source` says where the date of an item comes from:
+
+      - name: parsed from the name (the default, see parse_name())
+      - timestamp: the time the backend gives, an S3 key's last_modified or a snapshot's start_time
+      - mtime: the modification time of the file in `directory`
+
+    Backend timestamps are UTC and are converted to local time, like file times and the relative
+    (timedelta) cutoffs.
     """
-    # figure out the filename
-    try:
-        filename = filename.description
-    except:
-        try:
-            filename = filename.key
-        except:
-            pass
-    snapshot_use_start_time = False
-    if 'snapshot_use_start_time' in kwargs:
-        snapshot_use_start_time = kwargs['snapshot_use_start_time']
+    return _criteria_plan(kwargs, directory).matches(_item_name(filename), filename)
 
-    # parse the filename
-    name = parse_name(filename, snapshot_use_start_time=snapshot_use_start_time)
 
+def _criteria_plan(kwargs, directory=None):
+    """
+    Set up the criteria in kwargs once so they can be tested against many items (see CriteriaPlan)
+    """
+    kwargs = dict(kwargs)
     # has_date is used by default, so make sure it is on
     if 'has_date' not in kwargs:
         kwargs['has_date'] = True
+    trace = kwargs.pop('trace', None)
+    date_source = kwargs.pop('date_source', 'name')
+    key_layout = kwargs.pop('key_layout', None)
+    snapshot_use_start_time = kwargs.get('snapshot_use_start_time', False)
+
+    if date_source == 'name' and key_layout is not None:
+        if not isinstance(key_layout, KeyLayout):
+            key_layout = KeyLayout(key_layout)
+        prefix = '' if directory in (None, './') else directory
+
+        def parse(filename, item):
+            # the date where the layout says it is, or wherever parse_name() finds one
+            return ParsedName(filename, lambda: key_layout.parse_date(filename, prefix) or _find_date(filename))
+    elif date_source == 'name':
+        def parse(filename, item):
+            return parse_name(filename, snapshot_use_start_time=snapshot_use_start_time)
+    elif date_source == 'timestamp':
+        def parse(filename, item):
+            return ParsedName(filename, lambda: _item_timestamp(item))
+    elif date_source == 'mtime':
+        def parse(filename, item):
+            return ParsedName(filename, lambda: _item_mtime(directory, filename))
+    else:
+        raise Exception('Unknown date_source <%s>, use name, timestamp or mtime' % date_source)
+    return criteria.CriteriaPlan(get_criteria(), kwargs, parse, trace=trace)
 
-    # if debug is not there, explicitly set it off
-    if 'debug' not in kwargs:
-        kwargs['debug'] = False
 
-    available_criteria = get_criteria()
+def _item_mtime(directory, filename):
+    """
+    The modification time of a file, or None if it is gone
+    """
+    try:
+        return datetime.datetime.fromtimestamp(os.stat(os.path.join(directory or '', filename)).st_mtime)
+    except OSError:
+        return None
 
-    if kwargs['debug']:
-        criteria_for_this_item = set(available_criteria).intersection(set(kwargs.keys()))
-        print "\n\tFilename.: %s" % filename
-        print "\tDate.....: %s" % name['date']
-        print "\tTests....: %s" % criteria_for_this_item
-        for ct in criteria_for_this_item:
-            print "\t\t%s: %s" % (ct, kwargs[ct])
 
-    for argument_criteria in kwargs.keys():
-        if argument_criteria in available_criteria:
-            this_criteria = available_criteria[argument_criteria]()
-            if kwargs['debug']:
-                this_criteria.debugMode = True
-            this_criteria.set_argument(kwargs[argument_criteria])
-            if not this_criteria.test(filename, name):
-                return False
-    return True
+def _item_timestamp(item):
+    """
+    The time the backend gives for an item, an S3 key's last_modified or a snapshot's start_time, in
+    local time so it compares with the relative cutoffs (see DateCriteria)
+    """
+    for attribute in ['last_modified', 'start_time']:
+        value = getattr(item, attribute, None)
+        if value:
+            date = parse_timestamp(value)
+            if date is None:
+                return None
+            local = datetime.datetime.fromtimestamp(calendar.timegm(date.timetuple()))
+            return local.replace(microsecond=date.microsecond)
+    return None
+
+
+def _test_criteria(filename, name, **kwargs):
+    """
+    Test an already parsed name against the criteria, see meets_criteria()
+    """
+    return _criteria_plan(kwargs).test_parsed(filename, name)
 
 
 def parse_name(fn, debug=False, snapshot_use_start_time=False):
     """
     Figure out if the given filename has a date portion or not. This returns a dictionary with the
-    name of the item and the date, if applicable.
+    name of the item and the date, if applicable. The date is only parsed the first time it is
+    used (see ParsedName).
     """
     o = None
     try:
@@ -429,72 +1153,522 @@ def parse_name(fn, debug=False, snapshot_use_start_time=False):
         except:
             pass
 
-    item = {'name': fn, 'date': None}
+    item = ParsedName(fn, lambda: _find_date(fn, o))
+
+    if debug:
+        print item
+
+    return item
+
+
+def _find_date(fn, o=None):
+    """
+    The date in the name, or in the start time of the item `o` it came from, see parse_name()
+    """
+    date = None
     # check YYYY-MM-DDTHH:MM:SS
     if re.search(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):?(\d{2}):?(\d{2})?', fn):
         result = re.findall(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):?(\d{2}):?(\d{2})?', fn)[0]
-        item['date'] = datetime.datetime(int(result[0]), int(result[1]), int(result[2]), int(result[3]), int(result[4]))
+        date = datetime.datetime(int(result[0]), int(result[1]), int(result[2]), int(result[3]), int(result[4]))
     # check YYYY-MM-DDTHHMM-Z
     elif re.search(r'(\d{4})-(\d{2})-(\d{2})T(\d{2})(\d{2})?-?(\d{4})?', fn):
         result = re.findall(r'(\d{4})-(\d{2})-(\d{2})T(\d{2})(\d{2})?-?(\d{4})?', fn)[0]
         minute = 0
         if result[4]:
             minute = int(result[4])
-        item['date'] = datetime.datetime(int(result[0]), int(result[1]), int(result[2]), int(result[3]), minute)
+        date = datetime.datetime(int(result[0]), int(result[1]), int(result[2]), int(result[3]), minute)
     # check YYYYMMDD
     elif re.search(r'(\d{4})-?(\d{2})-?(\d{2})', fn):
         result = re.findall(r'(\d{4})-?(\d{2})-?(\d{2})', fn)[0]
-        item['date'] = datetime.datetime(int(result[0]), int(result[1]), int(result[2]))
+        date = datetime.datetime(int(result[0]), int(result[1]), int(result[2]))
 
-    if not item['date'] and o:
+    if not date and o:
         try:
-            date = o.start_time
-            if re.search(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})?', date):
-                result = re.findall(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})?', date)[0]
-                item['date'] = datetime.datetime(int(result[0]), int(result[1]), int(result[2]), int(result[3]), int(result[4]))
+            start_time = o.start_time
+            if re.search(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})?', start_time):
+                result = re.findall(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})?', start_time)[0]
+                date = datetime.datetime(int(result[0]), int(result[1]), int(result[2]), int(result[3]), int(result[4]))
         except:
             pass
+    return date
 
-    if debug:
-        print item
 
-    return item
+def plan(source, policies):
+    """
+    Evaluate several retention policies against one source in a single pass.
+
+    `source` is a dictionary of list_archives() arguments, like the sources of list_sources(), e.g.
+    {'s3bucket': 'mybucket', 'directory': 'backups/'}. Each policy is a dictionary of criteria and
+    filters with an optional `kind` ('archives', 'logs' or 'items', the default is 'archives'), e.g.
+    {'kind': 'logs', 'before': datetime.timedelta(7)} or {'before': datetime.timedelta(30), 'except_first':
+    'month'}. Source arguments that are not about listing (such as `date_source`) apply to every policy.
+
+    The source is listed once and every name is parsed once, however many policies there are. Returns
+    a list with the items that meet each policy, in the same order as `policies`.
+    """
+    arguments = dict(source)
+    directory = arguments.pop('directory', './')
+    s3bucket = arguments.pop('s3bucket', None)
+    ec2snapshots = arguments.pop('ec2snapshots', None)
+    items = arguments.pop('items', None)
+    aws_access_key_id = arguments.pop('aws_access_key_id', None)
+    aws_secret_access_key = arguments.pop('aws_secret_access_key', None)
+    # a key layout can only list for the criteria that no policy changes
+    shared = dict((argument, value) for argument, value in arguments.items()
+                  if not [policy for policy in policies if argument in policy])
+    items = _source_items(items, directory, s3bucket, ec2snapshots, aws_access_key_id, aws_secret_access_key, arguments,
+                          shared)
+
+    compiled = []
+    for policy in policies:
+        kwargs = dict(arguments)
+        kwargs.update(policy)
+        kind = kwargs.pop('kind', 'archives')
+        compiled.append((kind, _kind_check(kind, ec2snapshots), kwargs.get('date_source', 'name'),
+                         _criteria_plan(kwargs, directory), kwargs, []))
+
+    for item in items:
+        filename = _item_name(item)
+        checked = {}
+        parsed = {}
+        for kind, check, date_source, criteria_plan, kwargs, entries in compiled:
+            if kind not in checked:
+                checked[kind] = check(item)
+            if not checked[kind]:
+                continue
+            # names are parsed lazily and shared, so each date is only looked for once
+            if date_source not in parsed:
+                parsed[date_source] = criteria_plan.parse(filename, item)
+            if kind == 'items' and not parsed[date_source]['date']:
+                continue
+            if criteria_plan.test_parsed(filename, parsed[date_source]):
+                entries.append({'item': item, 'parsed': parsed[date_source]})
+
+    results = []
+    for kind, check, date_source, criteria_plan, kwargs, entries in compiled:
+        if [argument for argument in kwargs if argument in get_filters()]:
+            results.append(filter_criteria(entries, **kwargs))
+        else:
+            results.append([entry['item'] for entry in entries])
+    return results
+
 
+def rotate(directory='./', s3bucket=None, ec2snapshots=None, aws_access_key_id=None, aws_secret_access_key=None,
+           kind='archives', page_size=1000, batch_size=100, queue_size=4, executor=None, **kwargs):
+    """
+    Find and remove the items that meet the criteria in one pipelined pass.
+
+    Listing, criteria evaluation and removal each run in their own thread: pages of `page_size` items
+    are evaluated while the next page is being listed, and matches are removed in batches of
+    `batch_size` (see remove_items()) while evaluation continues. The stages are connected by queues
+    of `queue_size` pages or batches, so memory stays bounded however big the source is.
 
-def remove_items(directory='./', items=None, db=None, s3bucket=None, ec2snapshots=None, aws_access_key_id=None, aws_secret_access_key=None):
+    `kind` is 'archives', 'logs' or 'items' (anything with a date), like the list_* functions. Filters
+    such as except_first need the whole listing and can't be used here.
+
+    Returns a dictionary with the number of items 'listed', 'matched' and 'removed'. Items that could
+    not be removed are reported in a RemovalError at the end.
+    """
+    check = _kind_check(kind, ec2snapshots)
+    _reject_filters(kwargs)
+
+    source = _open_source(s3bucket, ec2snapshots, aws_access_key_id, aws_secret_access_key, kwargs)
+    if not executor:
+        executor = RemovalExecutor()
+
+    stats = {'listed': 0, 'matched': 0, 'removed': 0}
+    failures = []
+
+    def evaluate(pages):
+        # one plan for the whole run, so criteria are reordered using the earlier pages
+        plan = _criteria_plan(kwargs, directory)
+        batch = []
+        for page in pages:
+            stats['listed'] += len(page)
+            for item in page:
+                if not check(item):
+                    continue
+                filename = _item_name(item)
+                if kind == 'items':
+                    name = plan.parse(filename, item)
+                    matched = plan.test_parsed(filename, name) and name['date']
+                else:
+                    matched = plan.matches(filename, item)
+                if matched:
+                    batch.append(item)
+                    if len(batch) >= batch_size:
+                        stats['matched'] += len(batch)
+                        yield batch
+                        batch = []
+        if batch:
+            stats['matched'] += len(batch)
+            yield batch
+
+    def remove(batches):
+        for batch in batches:
+            try:
+                remove_items(directory=directory, items=batch, s3bucket=s3bucket, ec2snapshots=ec2snapshots,
+                             s3_connection=source['s3_connection'], ec2_connection=source['ec2_connection'],
+                             executor=executor)
+                stats['removed'] += len(batch)
+            except RemovalError, e:
+                failures.extend(e.failures)
+                stats['removed'] += len(batch) - len(e.failures)
+            yield len(batch)
+
+    pages = _iter_source_pages(directory, s3bucket, ec2snapshots, page_size, **source)
+    run_pipeline(pages, [evaluate, remove], queue_size=queue_size)
+    if failures:
+        raise RemovalError('Could not remove %d of %d items' % (len(failures), stats['matched']), failures)
+    return stats
+
+
+def remove_items(directory='./', items=None, db=None, s3bucket=None, ec2snapshots=None, aws_access_key_id=None, aws_secret_access_key=None,
+                 ec2_connection=None, ec2_endpoint=None, s3_connection=None, max_workers=32, executor=None, partition=None,
+                 journal=None, pacer=None, trees=False, tree_workers=8, deadline=None, priority=None):
     """
     Delete the items in the directory/items list. See connect_to_s3() for information about using this method
     with S3 accounts.
+
+    Every backend removes items through a RemovalExecutor (see rotatelib.executor), which runs up to
+    `max_workers` removals at a time, backs off when the backend throttles us (S3 SlowDown, EC2
+    RequestLimitExceeded, MySQL lock wait timeouts) and retries with jittered backoff. Database tables
+    are always dropped one at a time on the given connection. Pass your own `executor` to tune this.
+
+    Files, snapshots and tables that are already gone are ignored. Any other failure raises a RemovalError
+    once every item has been tried. EC2 items can be Snapshot objects or snapshot ids.
+
+    If `partition` (a PartitionWorker) is given, its leases are renewed first (and then in the
+    background while the removals run) and only the items in the partitions it still holds are removed.
+
+    If `journal` (a path or DeletionJournal) is given, the planned removals and each completed one
+    are recorded so that an interrupted run can be finished with resume_removal().
+
+    With `trees=True`, items that are directories (see list_directories()) are removed with everything
+    in them, using up to `tree_workers` threads per directory (see rotatelib.trees.remove_tree()).
+
+    `priority` sets the order items are removed in: 'oldest' or 'newest' (by the date in the name),
+    'largest' (by size, to free space fastest) or a function to sort by. With a `deadline` (seconds
+    from now or a datetime) no new removal is started once it has passed. Returns the items that were
+    left because of the deadline, in priority order (an empty list when everything was done).
+
+    On a busy MySQL server, pass a DropPacer (see rotatelib.mysql) as `pacer` to drop tables with a short
+    lock wait timeout, in paced batches, and only while the server and its replicas keep up.
     """
+    if isinstance(items, types.GeneratorType):
+        items = list(items)
     if not items:
-        return
+        return []
+
+    if partition is not None:
+        partition.renew()
+        items = [item for item in items if partition.owns(_item_id(item))]
+        if not items:
+            return []
+
+    if priority is not None:
+        items = _prioritize(items, priority, directory)
+    if isinstance(deadline, datetime.datetime):
+        deadline = time.mktime(deadline.timetuple())
+    elif deadline is not None:
+        deadline = time.time() + deadline
+
+    if not executor:
+        executor = RemovalExecutor(max_workers=max_workers)
 
     if not db and not s3bucket and not ec2snapshots:
         # OS level items
-        for item in items:
+        def remove(item):
             try:
                 this_item = os.path.join(directory, item)
             except AttributeError, e:
                 this_item = os.path.join(directory, item['item'])
-            os.remove(this_item)
+            try:
+                if trees and os.path.isdir(this_item) and not os.path.islink(this_item):
+                    remove_tree(this_item, tree_workers)
+                else:
+                    os.remove(this_item)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        noun = 'files'
     elif not db and s3bucket and not ec2snapshots:
         # S3 items
-        s3 = connect_to_s3(aws_access_key_id, aws_secret_access_key)
+        s3 = s3_connection
+        if s3 is None:
+            s3 = connect_to_s3(aws_access_key_id, aws_secret_access_key)
         bucket = s3.get_bucket(s3bucket)
-        for item in items:
-            bucket.delete_key(item.key)
+
+        def remove(item):
+            bucket.delete_key(getattr(item, 'key', item))
+        noun = 'keys'
     elif not db and not s3bucket and ec2snapshots:
         # EC2 snapshots
-        for item in items:
+        ec2 = ec2_connection
+        if ec2 is None and [item for item in items if isinstance(item, basestring)]:
+            ec2 = connect_to_ec2(aws_access_key_id, aws_secret_access_key, endpoint=ec2_endpoint)
+
+        def remove(item):
             try:
-                item.delete()
-            except Exception:
-                pass
+                if isinstance(item, basestring):
+                    ec2.delete_snapshot(item)
+                elif ec2_connection is not None:
+                    ec2_connection.delete_snapshot(item.id)
+                else:
+                    item.delete()
+            except Exception, e:
+                if getattr(e, 'error_code', None) not in SNAPSHOT_GONE_ERROR_CODES:
+                    raise
+        noun = 'snapshots'
     else:
         # Database items
+        executor = copy.copy(executor)
+        executor.max_workers = 1
         cur = db.cursor()
-        for item in items:
+
+        def remove(item):
+            if pacer is not None:
+                pacer.wait(cur)
             try:
                 cur.execute("DROP TABLE %s" % item)
-            except Exception:
-                pass
+            except Exception, e:
+                # MySQL "Unknown table" or sqlite "no such table": already gone
+                if not (e.args and e.args[0] == 1051) and 'no such table' not in str(e):
+                    raise
+            if pacer is not None:
+                pacer.done()
+        noun = 'tables'
+
+    if journal is not None:
+        if not isinstance(journal, DeletionJournal):
+            journal = DeletionJournal(journal)
+        journal.plan({'directory': directory, 's3bucket': s3bucket, 'ec2snapshots': bool(ec2snapshots), 'db': bool(db),
+                      'trees': trees, 'tree_workers': tree_workers}, [_item_id(item) for item in items])
+        remove_item = remove
+
+        def remove(item):
+            remove_item(item)
+            journal.done(_item_id(item))
+
+    if db and pacer is not None:
+        pacer.start(cur)
+    try:
+        if partition is not None:
+            with partition.renewing():
+                failures = executor.run(remove, items, deadline)
+        else:
+            failures = executor.run(remove, items, deadline)
+        remaining = executor.remaining
+        if journal is not None:
+            if failures or remaining:
+                journal.checkpoint()
+            else:
+                journal.finish()
+    finally:
+        if db and pacer is not None:
+            pacer.finish(cur)
+        if LISTING_CACHE is not None and not db:
+            if s3bucket:
+                LISTING_CACHE.invalidate('s3', s3bucket)
+            elif ec2snapshots:
+                LISTING_CACHE.invalidate('ec2')
+            else:
+                LISTING_CACHE.invalidate('file', os.path.abspath(directory))
+    if failures:
+        raise RemovalError('Could not remove %d of %d %s' % (len(failures), len(items), noun), failures, remaining)
+    return remaining
+
+
+def _open_source(s3bucket, ec2snapshots, aws_access_key_id, aws_secret_access_key, kwargs):
+    """
+    Pop the source arguments from kwargs (see _source_arguments()) and connect to S3 or EC2 if needed
+    """
+    source = _source_arguments(kwargs)
+    if source['key_layout'] is not None:
+        source['layout_criteria'] = kwargs
+    if s3bucket and source['s3_connection'] is None:
+        source['s3_connection'] = connect_to_s3(aws_access_key_id, aws_secret_access_key)
+    if ec2snapshots and source['ec2_connection'] is None:
+        source['ec2_connection'] = connect_to_ec2(aws_access_key_id, aws_secret_access_key, endpoint=source['ec2_endpoint'])
+    return source
+
+
+def _prioritize(items, priority, directory):
+    """
+    Sort the items to remove by priority, see remove_items()
+    """
+    if callable(priority):
+        return sorted(items, key=priority)
+    if priority in ['oldest', 'newest']:
+        dates = [(_removal_date(item), item) for item in items]
+        dated = [entry for entry in dates if entry[0]]
+        dated.sort(key=lambda entry: entry[0], reverse=priority == 'newest')
+        # undated items go last either way
+        return [entry[1] for entry in dated] + [entry[1] for entry in dates if not entry[0]]
+    if priority == 'largest':
+        return sorted(items, key=lambda item: _item_size(item, directory), reverse=True)
+    raise Exception('Unknown priority <%s>, use oldest, newest, largest or a function' % priority)
+
+
+def _removal_date(item):
+    if isinstance(item, dict):
+        return item['parsed']['date']
+    return parse_name(_item_name(item))['date']
+
+
+def _item_size(item, directory):
+    if isinstance(item, dict):
+        item = item['item']
+    size = getattr(item, 'size', None)
+    if size is None:
+        # boto gives the size of a snapshot's volume in GiB
+        size = getattr(item, 'volume_size', None)
+        if size is not None:
+            size = int(size) * 1024 ** 3
+    if size is None and isinstance(item, basestring):
+        try:
+            size = os.path.getsize(os.path.join(directory, item))
+        except OSError:
+            pass
+    return size or 0
+
+
+def _kind_check(kind, ec2snapshots=None):
+    """
+    The test for items of `kind` ('archives', 'logs' or 'items') before the criteria are tested. 'items'
+    only need a date, which is checked once the name is parsed (it may not come from the name), and
+    every snapshot is an archive.
+    """
+    checks = {'archives': is_archive, 'logs': is_log, 'items': lambda item: True}
+    if kind not in checks:
+        raise Exception('Unknown kind <%s>' % kind)
+    if ec2snapshots and kind == 'archives':
+        return lambda archive: True
+    return checks[kind]
+
+
+def _reject_filters(kwargs):
+    """
+    Raise for filters (such as except_first) in kwargs: they need the whole listing, which the
+    streaming functions never hold
+    """
+    for argument in kwargs:
+        if argument in get_filters():
+            raise Exception('The %s filter needs the whole listing, use the list_* functions instead' % argument)
+
+
+def _split_by_characters(bucket, directory, wanted):
+    """
+    Split the keys under `directory` into at least `wanted` prefixes (if there are enough keys) by
+    their leading characters, breadth first, with one single page listing per character found.
+    Returns the sorted prefixes and the keys that are one of the prefixes split further.
+    """
+    queue = collections.deque([directory])
+    keys = []
+    while queue and len(queue) < wanted:
+        prefix = queue.popleft()
+        marker = ''
+        while True:
+            key = next(iter(bucket.list(prefix, marker=marker)), None)
+            if key is None:
+                break
+            if key.key == prefix:
+                keys.append(key)
+                marker = key.key
+                continue
+            child = key.key[:len(prefix) + 1]
+            queue.append(child)
+            # after every key starting with child
+            marker = child + (unichr(sys.maxunicode) if isinstance(child, unicode) else '\xff')
+    return sorted(queue), keys
+
+
+def resume_removal(journal, db=None, **kwargs):
+    """
+    Finish a remove_items() run that was interrupted, using its journal (a path or DeletionJournal).
+    The items that were not removed yet are read from the journal, so the source is not listed
+    again. Database runs need the `db` connection again; any other remove_items() arguments (such as
+    credentials or connections) can be passed as kwargs.
+
+    Returns the number of items that were left to remove.
+    """
+    if not isinstance(journal, DeletionJournal):
+        journal = DeletionJournal(journal)
+    source, pending = journal.pending()
+    if not pending:
+        return 0
+    if source['db'] and not db:
+        raise Exception('The journal is for a database run, pass the db connection to resume it')
+    # directory trees are removed the same way they were planned (older journals do not say)
+    kwargs.setdefault('trees', source.get('trees', False))
+    kwargs.setdefault('tree_workers', source.get('tree_workers', 8))
+    remove_items(directory=source['directory'], items=pending, db=db, s3bucket=source['s3bucket'],
+                 ec2snapshots=source['ec2snapshots'], journal=journal, **kwargs)
+    return len(pending)
+
+
+def scan_backup_tables(servers, schemas=None, max_workers=8, **kwargs):
+    """
+    Find the backup tables in every schema of many database servers.
+
+    `servers` is a list of ConnectionPools, one per server (see rotatelib.mysql). Each server is asked
+    for the dated tables of all its schemas (or only `schemas`) with a single information_schema
+    query, and up to `max_workers` servers are scanned at the same time. The tables are then tested
+    against the criteria in kwargs (see meets_criteria()).
+
+    Returns a list of BackupTable (server, schema, table) tuples; a server's tables can be passed to
+    remove_items() with a connection to that server. If any server fails, the rest are still scanned
+    and a ListingError is raised at the end.
+    """
+    def scan(pool):
+        plan = _criteria_plan(kwargs)
+        return [BackupTable(pool.name, schema, table) for schema, table in fetch_backup_tables(pool, schemas)
+                if is_backup_table(table) and plan.matches(table)]
+
+    tables = []
+    failures = []
+    for pool, found, error in _fan_out(scan, servers, max_workers):
+        if error:
+            failures.append((pool, error))
+        else:
+            tables.extend(found)
+    if failures:
+        raise ListingError('Could not scan %d of %d servers' % (len(failures), len(servers)), failures)
+    return tables
+
+
+def watch_directory(directory='./', kind='archives', use_inotify=True, **kwargs):
+    """
+    Watch a local directory that keeps receiving dumps and keep the items that meet the criteria (see
+    meets_criteria()) up to date, instead of listing and evaluating the whole directory every cycle.
+
+    Returns a DirectoryWatch (see rotatelib.watch). Call its update() to read the pending create,
+    move and delete events (on Linux, through inotify) and evaluate only the entries they name, and
+    items() for the names that meet the criteria right now. Relative `before` and `after` cutoffs
+    (timedeltas) move with the clock without evaluating anything again. `kind` is 'archives', 'logs'
+    or 'items', like for rotate(). Dates come from the names or, with `date_source='mtime'`, from the
+    files (a file is evaluated again when it is written or touched). Filters such as except_first need
+    the whole listing and can't be used here.
+    """
+    check = _kind_check(kind)
+    _reject_filters(kwargs)
+    if kwargs.get('date_source', 'name') not in ['name', 'mtime']:
+        raise Exception('Unknown date_source <%s> for a directory, use name or mtime' % kwargs['date_source'])
+
+    relative = {}
+    for argument in ['before', 'after']:
+        if isinstance(kwargs.get(argument), datetime.timedelta):
+            relative[argument] = kwargs.pop(argument)
+    criteria_plan = _criteria_plan(kwargs, directory)
+
+    def evaluate(filename):
+        if not check(filename):
+            return False, None
+        name = criteria_plan.parse(filename, os.path.join(directory, filename))
+        if not criteria_plan.test_parsed(filename, name):
+            return False, None
+        if kind == 'items' and not name['date']:
+            return False, None
+        return True, name['date']
+
+    return DirectoryWatch(directory, evaluate, use_inotify=use_inotify, **relative)
@@ -0,0 +1,59 @@
+import collections
+import threading
+import time
+
+
+class ListingCache(object):
+    """
+    Keeps recent listings so that several criteria passes over the same source
+    only list it once.
+
+    Entries are keyed by (backend, source, prefix), expire `ttl` seconds after
+    they were listed and the least recently used entry is dropped once there
+    are more than `max_entries`. remove_items() invalidates every entry for
+    the source it removed items from.
+    """
+    def __init__(self, ttl=300, max_entries=64):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, key):
+        """
+        A copy of the cached listing for this key, or None
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            # move to the end (most recently used)
+            self.entries[key] = entry
+            self.hits += 1
+            return list(entry[1])
+
+    def invalidate(self, backend, source=None):
+        """
+        Drop every listing for the backend, or only for one source of that backend
+        """
+        with self.lock:
+            for key in self.entries.keys():
+                if key[0] == backend and (source is None or key[1] == source):
+                    del self.entries[key]
+
+    def put(self, key, items):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), list(items))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
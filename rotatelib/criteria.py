@@ -14,6 +14,10 @@ class BaseCriteria(object):
     """
     criteria_name = None
 
+    # criteria that only look at the name can run before it is parsed (see CriteriaPlan)
+    needs_parse = True
+    cost = 1
+
     def __init__(self, debug=False):
         self.debugMode = False
 
@@ -75,7 +79,8 @@ class After(DateCriteria):
             return False
 
         if self.argument and parsed_name['date'] <= self.argument:
-            self.debug("FAILED before criteria")
+            if self.debugMode:
+                self.debug("FAILED after criteria")
             return False
         return True
 
@@ -151,6 +156,8 @@ class Hour(ListArgumentCriteria):
     def test(self, filename, parsed_name):
         self.debugArguments(filename, parsed_name)
         self.argument = self.make_list(self.argument)
+        if not parsed_name['date']:
+            return False
         # ignore any hour besides the requested one
         if parsed_name['date'].hour not in self.argument:
             return False
@@ -188,6 +195,9 @@ class Pattern(BaseCriteria):
     """
     Match against a RegExp pattern
     """
+    needs_parse = False
+    cost = 2
+
     def test(self, filename, parsed_name):
         self.debugArguments(filename, parsed_name)
         if not re.match(self.argument, filename):
@@ -196,6 +206,8 @@ class Pattern(BaseCriteria):
 
 
 class Endswith(ListArgumentCriteria):
+    needs_parse = False
+
     def test(self, filename, parsed_name):
         passes = False
         for s in self.argument:
@@ -213,6 +225,8 @@ class ExceptEndswith(Endswith):
 
 
 class Startswith(ListArgumentCriteria):
+    needs_parse = False
+
     def test(self, filename, parsed_name):
         passes = False
         for s in self.argument:
@@ -227,3 +241,131 @@ class ExceptStartswith(Startswith):
 
     def test(self, filename, parsed_name):
         return not super(ExceptStartswith, self).test(filename, parsed_name)
+
+# ---------------------------------------------------------------------
+# CRITERIA PLANS
+# ---------------------------------------------------------------------
+
+
+class CriteriaStep(object):
+    """
+    One criteria in a CriteriaPlan, with how many items it has tested and rejected
+    """
+    __slots__ = ['name', 'argument', 'criteria', 'tested', 'rejected']
+
+    def __init__(self, name, argument, criteria):
+        self.name = name
+        self.argument = argument
+        self.criteria = criteria
+        self.tested = 0
+        self.rejected = 0
+
+    def rank(self):
+        # smoothed rejection rate per unit of cost, higher runs first
+        return float(self.rejected + 1) / (self.tested + 2) / self.criteria.cost
+
+    def test(self, filename, parsed_name):
+        self.tested += 1
+        if self.criteria.test(filename, parsed_name):
+            return True
+        self.rejected += 1
+        return False
+
+
+class CriteriaPlan(object):
+    """
+    The criteria of one call, set up once and then tested against every item.
+
+    Criteria that only look at the name (startswith, endswith, pattern and
+    their except_ versions) run first, so names they reject are never parsed.
+    The criteria that need the parsed name are reordered every
+    `reorder_every` items so that the ones that have rejected the most items
+    so far run first.
+
+    `parse` is called as parse(filename, item) when the parsed name is needed
+    (see rotatelib.parse_name()). With a `trace` sink (see rotatelib.trace) every
+    criteria is recorded for the items it wants.
+    """
+    def __init__(self, available_criteria, kwargs, parse, trace=None, reorder_every=256):
+        self.parse = parse
+        self.trace = trace
+        self.reorder_every = reorder_every
+        self.debugMode = kwargs.get('debug', False)
+        self.name_steps = []
+        self.parsed_steps = []
+        self.seen = 0
+        for argument_criteria in kwargs:
+            if argument_criteria not in available_criteria:
+                continue
+            this_criteria = available_criteria[argument_criteria]()
+            if self.debugMode:
+                this_criteria.debugMode = True
+            this_criteria.set_argument(kwargs[argument_criteria])
+            step = CriteriaStep(argument_criteria, kwargs[argument_criteria], this_criteria)
+            if this_criteria.needs_parse:
+                self.parsed_steps.append(step)
+            else:
+                self.name_steps.append(step)
+        self.name_steps.sort(key=lambda step: step.criteria.cost)
+        # has_date is cheap and rejects every undated item, so it starts first
+        self.parsed_steps.sort(key=lambda step: step.name != 'has_date')
+
+    def matches(self, filename, item=None):
+        """
+        Does the (unparsed) name of the item meet the criteria?
+        """
+        # the trace sink decides once per item, so its sample rate holds
+        traced = self.trace is not None and self.trace.wants(filename)
+        if self.debugMode or traced:
+            return self.test_parsed(filename, self.parse(filename, item), traced)
+        for step in self.name_steps:
+            if not step.test(filename, None):
+                return False
+        return self._test_parsed_steps(filename, self.parse(filename, item))
+
+    def reorder(self):
+        self.parsed_steps = sorted(self.parsed_steps, key=lambda step: -step.rank())
+
+    def test_parsed(self, filename, parsed_name, traced=None):
+        """
+        Does the already parsed name meet the criteria? `traced` is whether the trace sink already
+        wants the item (asked here if None).
+        """
+        if self.debugMode:
+            self.debug_item(filename, parsed_name)
+        if traced is None:
+            traced = self.trace is not None and self.trace.wants(filename)
+        if traced:
+            return self._trace(filename, parsed_name)
+        for step in self.name_steps:
+            if not step.test(filename, parsed_name):
+                return False
+        return self._test_parsed_steps(filename, parsed_name)
+
+    def debug_item(self, filename, parsed_name):
+        print "\n\tFilename.: %s" % filename
+        print "\tDate.....: %s" % parsed_name['date']
+        print "\tTests....: %s" % [step.name for step in self.name_steps + self.parsed_steps]
+        for step in self.name_steps + self.parsed_steps:
+            print "\t\t%s: %s" % (step.name, step.argument)
+
+    def _test_parsed_steps(self, filename, parsed_name):
+        self.seen += 1
+        if self.seen % self.reorder_every == 0:
+            self.reorder()
+        for step in self.parsed_steps:
+            if not step.test(filename, parsed_name):
+                return False
+        return True
+
+    def _trace(self, filename, parsed_name):
+        record = {'name': filename, 'date': parsed_name['date'], 'criteria': [], 'failed': None, 'passed': True}
+        for step in self.name_steps + self.parsed_steps:
+            passed = step.test(filename, parsed_name)
+            record['criteria'].append((step.name, step.argument, passed))
+            if not passed:
+                record['failed'] = step.name
+                record['passed'] = False
+                break
+        self.trace.emit(record)
+        return record['passed']
@@ -0,0 +1,222 @@
+import random
+import threading
+import time
+import Queue
+
+# error codes that mean "slow down and try again"
+THROTTLE_ERROR_CODES = [
+    'RequestLimitExceeded',  # EC2
+    'Throttling',
+    'ThrottlingException',
+    'SlowDown',  # S3
+    'ServiceUnavailable',
+]
+
+# MySQL lock wait timeout and deadlock errors
+THROTTLE_DB_ERRORS = [1205, 1213]
+
+
+class RemovalError(Exception):
+    """
+    Raised by remove_items() when some items could not be removed. The
+    `failures` attribute is a list of (item, exception) tuples and
+    `remaining` the items that were not tried before the deadline.
+    """
+    def __init__(self, message, failures, remaining=None):
+        super(RemovalError, self).__init__(message)
+        self.failures = failures
+        self.remaining = remaining or []
+
+
+class DeadlineReached(Exception):
+    """
+    Raised inside RemovalExecutor.call() when a retry would run past the deadline
+    """
+
+
+def is_throttle_error(e):
+    """
+    Does this exception mean the backend wants us to slow down?
+    """
+    if getattr(e, 'error_code', None) in THROTTLE_ERROR_CODES:
+        return True
+    if e.args and e.args[0] in THROTTLE_DB_ERRORS:
+        return True
+    if 'database is locked' in str(e):
+        return True
+    return False
+
+
+class AIMDController(object):
+    """
+    Additive increase/multiplicative decrease controller for the number of
+    concurrent operations.
+
+    Every success grows the limit by roughly one operation per window. A
+    throttle error (or a success slower than `latency_target`) cuts the limit
+    by `decrease`, at most once per `cooldown` seconds so a burst of errors
+    from the same window only counts once.
+    """
+    def __init__(self, initial=4, minimum=1, maximum=32, decrease=0.5, latency_target=None, cooldown=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.last_decrease = 0
+        self.lock = threading.Lock()
+
+    def concurrency(self):
+        return int(self.limit)
+
+    def on_success(self, latency):
+        with self.lock:
+            if self.latency_target and latency > self.latency_target:
+                self._decrease()
+                return
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_throttle(self):
+        with self.lock:
+            self._decrease()
+
+    def _decrease(self):
+        now = time.time()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        self.last_decrease = now
+
+
+class RemovalExecutor(object):
+    """
+    Runs a removal function over a list of items for every remove_items() backend.
+
+    Concurrency is adjusted by an AIMDController between `min_workers` and
+    `max_workers`. Throttled calls are retried up to `retries` times with
+    exponential backoff and full jitter. Errors listed by `is_gone` are
+    treated as already removed. With `max_workers=1` everything runs in the
+    calling thread, which is what database connections need.
+
+    With a `deadline` (a time.time() value) no new item is started once it
+    has passed, and throttled items are not retried past it. The items that
+    were not removed because of the deadline are left in `remaining`.
+    """
+    def __init__(self, max_workers=32, min_workers=1, initial_workers=4, retries=5, backoff_base=0.2,
+                 backoff_cap=20.0, latency_target=None, is_gone=None):
+        self.max_workers = max_workers
+        self.min_workers = min_workers
+        self.initial_workers = initial_workers
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.latency_target = latency_target
+        self.is_gone = is_gone
+        self.controller = None
+        self.stats = {}
+        self.remaining = []
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def call(self, func, item, deadline=None):
+        """
+        Call func(item), retrying throttled calls
+        """
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                func(item)
+                self.controller.on_success(time.time() - start)
+                return
+            except Exception, e:
+                if self.is_gone and self.is_gone(e):
+                    return
+                if not is_throttle_error(e) or attempt >= self.retries:
+                    raise
+                self.controller.on_throttle()
+                self._count('throttled')
+                delay = self.backoff(attempt)
+                if deadline is not None and time.time() + delay >= deadline:
+                    raise DeadlineReached()
+                time.sleep(delay)
+                attempt += 1
+
+    def run(self, func, items, deadline=None):
+        """
+        Call func(item) for every item, in order. Returns a list of (item, exception)
+        tuples for the items that failed.
+        """
+        self.controller = AIMDController(initial=self.initial_workers, minimum=self.min_workers,
+                                         maximum=self.max_workers, latency_target=self.latency_target)
+        self.stats = {'removed': 0, 'failed': 0, 'throttled': 0}
+        self.remaining = []
+        failures = []
+        remaining = []
+
+        if self.max_workers <= 1:
+            for i, item in enumerate(items):
+                if deadline is not None and time.time() >= deadline:
+                    remaining.extend(items[i:])
+                    break
+                try:
+                    self.call(func, item, deadline)
+                    self._count('removed')
+                except DeadlineReached:
+                    remaining.append(item)
+                except Exception, e:
+                    self._count('failed')
+                    failures.append((item, e))
+            self.remaining = remaining
+            return failures
+
+        work = Queue.Queue()
+        for item in items:
+            work.put(item)
+        slots = threading.Condition()
+        state = {'active': 0}
+
+        def worker():
+            while True:
+                try:
+                    item = work.get_nowait()
+                except Queue.Empty:
+                    return
+                with slots:
+                    while state['active'] >= self.controller.concurrency():
+                        slots.wait(0.05)
+                    if deadline is not None and time.time() >= deadline:
+                        remaining.append(item)
+                        continue
+                    state['active'] += 1
+                try:
+                    self.call(func, item, deadline)
+                    self._count('removed')
+                except DeadlineReached:
+                    with slots:
+                        remaining.append(item)
+                except Exception, e:
+                    with slots:
+                        failures.append((item, e))
+                    self._count('failed')
+                finally:
+                    with slots:
+                        state['active'] -= 1
+                        slots.notify_all()
+
+        threads = [threading.Thread(target=worker) for i in range(min(self.max_workers, work.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # keep the order the items were given in
+        order = dict((id(item), i) for i, item in enumerate(items))
+        self.remaining = sorted(remaining, key=lambda item: order[id(item)])
+        return failures
+
+    def _count(self, stat):
+        with self.controller.lock:
+            self.stats[stat] += 1
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+import time
+
+
+class DeletionJournal(object):
+    """
+    An append-only journal of a remove_items() run.
+
+    The run writes the source and every item it plans to remove, then a line
+    for each item as it is removed and a final line when it is done. If the
+    run is killed, pending() gives back the source and the items that were
+    not removed yet, so resume_removal() can carry on without listing the
+    source again.
+
+    Completed items are buffered and written (and fsync'd) every
+    `checkpoint_every` items or `checkpoint_seconds` seconds. Anything removed
+    after the last checkpoint is simply removed again on resume, which
+    remove_items() treats as already gone.
+    """
+    def __init__(self, path, checkpoint_every=1000, checkpoint_seconds=1.0):
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_seconds = checkpoint_seconds
+        self.buffer = []
+        self.last_checkpoint = time.time()
+        self.lock = threading.Lock()
+        self.tail_checked = False
+
+    def _write(self, records):
+        with open(self.path, 'a+') as f:
+            if not self.tail_checked:
+                # finish a line cut short by a killed run before appending to it
+                f.seek(0, os.SEEK_END)
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != '\n':
+                        f.write('\n')
+                self.tail_checked = True
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def checkpoint(self):
+        with self.lock:
+            self._checkpoint()
+
+    def _checkpoint(self):
+        if self.buffer:
+            self._write(self.buffer)
+            self.buffer = []
+        self.last_checkpoint = time.time()
+
+    def done(self, name):
+        """
+        Record that an item has been removed
+        """
+        with self.lock:
+            self.buffer.append({'op': 'done', 'name': name})
+            if len(self.buffer) >= self.checkpoint_every or time.time() - self.last_checkpoint >= self.checkpoint_seconds:
+                self._checkpoint()
+
+    def finish(self):
+        """
+        Record that the run is complete
+        """
+        with self.lock:
+            self.buffer.append({'op': 'finish'})
+            self._checkpoint()
+
+    def pending(self):
+        """
+        The source and the names of the items not removed by the last run, or
+        (None, []) if there is nothing left to do.
+        """
+        source = None
+        planned = []
+        done = set()
+        if not os.path.exists(self.path):
+            return None, []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut short when the process was killed
+                    continue
+                if record['op'] == 'plan':
+                    source = record['source']
+                    planned = []
+                    done = set()
+                elif record['op'] == 'item':
+                    planned.append(record['name'])
+                elif record['op'] == 'done':
+                    done.add(record['name'])
+                elif record['op'] == 'finish':
+                    source = None
+                    planned = []
+        return source, [name for name in planned if name not in done]
+
+    def plan(self, source, names):
+        """
+        Record a new run: the source arguments and the names of the items to remove
+        """
+        with self.lock:
+            self.buffer = []
+            records = [{'op': 'plan', 'source': source}]
+            records.extend({'op': 'item', 'name': name} for name in names)
+            self._write(records)
+            self.last_checkpoint = time.time()
@@ -0,0 +1,203 @@
+import collections
+import datetime
+import re
+
+# the fields a key layout can use, most significant first, how each is written and how it is read
+FIELDS = [('%Y', '%04d', r'(\d{4})'), ('%m', '%02d', r'(\d{2})'), ('%d', '%02d', r'(\d{2})'), ('%H', '%02d', r'(\d{2})')]
+
+
+class KeyLayout(object):
+    """
+    Where the date is in the keys of a bucket, so date criteria can be pushed down into the listing.
+
+    `layout` is the start of every key after the directory, as a strftime format using %Y and then
+    optionally %m, %d and %H in that order, e.g. '%Y/%m/%d/' for 'backups/2026/10/16/db.tar.gz' or
+    'db-%Y%m%d' for 'db-20261016.tar.gz'. The fields are zero padded, so keys sort by date.
+
+    Give it to the list_* functions as `key_layout` (the format itself will do). The after, before,
+    year, day and hour criteria and startswith are then turned into the S3 prefixes (or, when the date
+    range is open on one side, the key range) to list, and the dates of the keys are read where the
+    layout puts them (see parse_date()). The criteria are still tested on every key listed, so keys
+    that do not follow the layout are never wrongly matched, just not listed.
+    """
+    # more prefixes than this and one listing of the key range is cheaper
+    max_prefixes = 1000
+
+    def __init__(self, layout):
+        self.layout = layout
+        parts = re.split('(%.)', layout)
+        self.literals = parts[0::2]
+        fields = parts[1::2]
+        if not fields or fields != [field[0] for field in FIELDS[:len(fields)]]:
+            raise Exception('Unsupported key layout <%s>, use %%Y then %%m, %%d and %%H in order' % layout)
+        self.depth = len(fields)
+        pattern = [re.escape(self.literals[0])]
+        for i in range(self.depth):
+            pattern.append(FIELDS[i][2] + re.escape(self.literals[i + 1]))
+        self.pattern = re.compile(''.join(pattern))
+
+    def __repr__(self):
+        return '<KeyLayout: %s>' % self.layout
+
+    def parse_date(self, key, directory=''):
+        """
+        The date at the start of the key after `directory`, or None if the key does not follow the layout
+        """
+        if not key.startswith(directory):
+            return None
+        match = self.pattern.match(key, len(directory))
+        if not match:
+            return None
+        values = [int(value) for value in match.groups()]
+        try:
+            return datetime.datetime(*(values + [1] * (3 - len(values))))
+        except ValueError:
+            return None
+
+    def render(self, date, depth, literal=True):
+        """
+        The start of the keys dated in the same year, month, day or hour (`depth` 1 to 4) as `date`,
+        with the text after the last field if `literal` is set
+        """
+        values = [date.year, date.month, date.day, date.hour]
+        parts = [self.literals[0]]
+        for i in range(depth):
+            parts.append(FIELDS[i][1] % values[i])
+            if literal or i < depth - 1:
+                parts.append(self.literals[i + 1])
+        return ''.join(parts)
+
+    def listings(self, directory, criteria):
+        """
+        The listings that find every key under `directory` that could meet the criteria, as a list of
+        (prefix, marker, stop) tuples: list the keys starting with prefix after marker (if not None),
+        up to the first key that is not less than stop (if not None).
+        """
+        date_criteria = criteria.get('date_source', 'name') == 'name'
+        low = high = None
+        if date_criteria:
+            low = _date_argument(criteria.get('after'))
+            high = _date_argument(criteria.get('before'))
+        years = date_criteria and _int_set(criteria.get('year'))
+        if years:
+            low = max(low or datetime.datetime.min, datetime.datetime(min(years), 1, 1))
+            high = min(high or datetime.datetime.max, datetime.datetime(max(years) + 1, 1, 1))
+
+        if low is not None and high is not None and low >= high:
+            # nothing can meet the criteria
+            return []
+        listings = None
+        if low is not None and high is not None:
+            filters = {0: years, 2: date_criteria and _int_set(criteria.get('day')),
+                       3: date_criteria and _int_set(criteria.get('hour'))}
+            prefixes = self._cover(low, high, filters)
+            if prefixes is not None:
+                listings = [(directory + prefix, None, None) for prefix in prefixes]
+        if listings is None:
+            marker = stop = None
+            if low is not None:
+                marker = directory + self.render(low, self.depth, literal=False)
+            if high is not None:
+                end = _truncate(high, self.depth - 1)
+                if end < high:
+                    end = _next(end, self.depth - 1)
+                stop = directory + self.render(end, self.depth, literal=False)
+            listings = [(directory, marker, stop)]
+
+        startswith = criteria.get('startswith')
+        if not startswith:
+            return listings
+        if isinstance(startswith, basestring):
+            startswith = [startswith]
+        narrowed = []
+        for prefix, marker, stop in listings:
+            for start in startswith:
+                if start.startswith(prefix):
+                    listing = (start, marker, stop)
+                elif prefix.startswith(start):
+                    listing = (prefix, marker, stop)
+                else:
+                    continue
+                if listing not in narrowed:
+                    narrowed.append(listing)
+        return narrowed
+
+    def _cover(self, low, high, filters):
+        """
+        The fewest prefixes (relative to the directory) covering the dates from `low` to `high` that
+        pass the year, day and hour `filters`, or None if there would be more than max_prefixes
+        """
+        prefixes = []
+
+        def visit(start, level):
+            end = _next(start, level)
+            if end <= low or start >= high:
+                return
+            value = [start.year, start.month, start.day, start.hour][level]
+            if filters.get(level) and value not in filters[level]:
+                return
+            finer_filters = any(filters.get(finer) for finer in range(level + 1, self.depth))
+            if level + 1 == self.depth or (low <= start and end <= high and not finer_filters):
+                prefixes.append(self.render(start, level + 1))
+                if len(prefixes) > self.max_prefixes:
+                    raise _TooManyPrefixes()
+                return
+            child = start
+            while child < end:
+                visit(child, level + 1)
+                child = _next(child, level + 1)
+
+        year = datetime.datetime(low.year, 1, 1)
+        try:
+            while year < high:
+                visit(year, 0)
+                year = _next(year, 0)
+        except _TooManyPrefixes:
+            return None
+        return prefixes
+
+
+class _TooManyPrefixes(Exception):
+    pass
+
+
+def _date_argument(argument):
+    """
+    A before/after argument as a datetime, the way the date criteria read it
+    """
+    if isinstance(argument, datetime.timedelta):
+        return datetime.datetime.today() - argument
+    if isinstance(argument, datetime.datetime):
+        return argument
+    return None
+
+
+def _int_set(argument):
+    if argument is None:
+        return None
+    if isinstance(argument, basestring) or not isinstance(argument, collections.Iterable):
+        argument = [argument]
+    return set(int(value) for value in argument)
+
+
+def _truncate(date, level):
+    """
+    The start of the year, month, day or hour (`level` 0 to 3) that `date` is in
+    """
+    fields = [date.year, date.month, date.day, date.hour][:level + 1]
+    return datetime.datetime(*(fields + [1] * (3 - len(fields))))
+
+
+def _next(date, level):
+    """
+    The start of the next year, month, day or hour (`level` 0 to 3) after the one starting at `date`
+    """
+    if level == 0:
+        return datetime.datetime(date.year + 1, 1, 1)
+    if level == 1:
+        if date.month == 12:
+            return datetime.datetime(date.year + 1, 1, 1)
+        return datetime.datetime(date.year, date.month + 1, 1)
+    if level == 2:
+        return date + datetime.timedelta(days=1)
+    return date + datetime.timedelta(hours=1)
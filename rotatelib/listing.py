@@ -0,0 +1,123 @@
+import bisect
+import collections
+
+import criteria
+
+
+class ListingSnapshot(object):
+    """
+    A listing that has been parsed once and sorted by date so it can be queried
+    many times, e.g. with a different `before` cutoff for each retention tier.
+
+    `before` and `after` are answered with a bisect over the sorted dates,
+    `day`, `hour` and `year` with bucket maps that are built the first time
+    they are needed. Any other criteria are tested on what is left using the
+    names that were parsed when the snapshot was made.
+
+    Snapshots are returned by the list_* functions when they are called with
+    `as_snapshot=True`, and can be passed back to them as `items`.
+    """
+    def __init__(self, entries, test):
+        """
+        `entries` is a list of (filename, item, parsed_name) tuples and `test` is
+        called as test(filename, parsed_name, **kwargs) for the remaining criteria.
+        """
+        dated = [entry for entry in entries if entry[2]['date']]
+        dated.sort(key=lambda entry: entry[2]['date'])
+        self.dated = dated
+        self.dates = [entry[2]['date'] for entry in dated]
+        self.undated = [entry for entry in entries if not entry[2]['date']]
+        self.test = test
+        self.buckets = {}
+
+    def __iter__(self):
+        for entry in self.dated + self.undated:
+            yield entry[1]
+
+    def __len__(self):
+        return len(self.dated) + len(self.undated)
+
+    def after(self, cutoff):
+        """
+        Items dated after the cutoff (datetime or timedelta), oldest first
+        """
+        return [entry[1] for entry in self.dated[self._after_index(cutoff):]]
+
+    def before(self, cutoff):
+        """
+        Items dated before the cutoff (datetime or timedelta), oldest first
+        """
+        return [entry[1] for entry in self.dated[:self._before_index(cutoff)]]
+
+    def bucket(self, field):
+        """
+        Map of date field value (e.g. the day) to the positions of the dated items
+        """
+        if field not in self.buckets:
+            positions = collections.defaultdict(list)
+            for position, date in enumerate(self.dates):
+                positions[getattr(date, field)].append(position)
+            self.buckets[field] = positions
+        return self.buckets[field]
+
+    def entries(self, **kwargs):
+        """
+        The (filename, item, parsed_name) entries that meet the criteria, see query()
+        """
+        has_date = kwargs.pop('has_date', True)
+        lo = 0
+        hi = len(self.dated)
+        indexed = False
+
+        if 'after' in kwargs:
+            lo = self._after_index(kwargs.pop('after'))
+            indexed = True
+        if 'before' in kwargs:
+            hi = self._before_index(kwargs.pop('before'))
+            indexed = True
+
+        positions = None
+        for field in ['year', 'day', 'hour']:
+            if field not in kwargs:
+                continue
+            bucket = self.bucket(field)
+            matched = set()
+            for value in criteria.BaseCriteria().make_list(kwargs.pop(field)):
+                matched.update(bucket.get(value, []))
+            positions = matched if positions is None else positions & matched
+            indexed = True
+
+        if positions is None:
+            found = self.dated[lo:hi]
+        else:
+            found = [self.dated[position] for position in sorted(positions) if lo <= position < hi]
+        if not has_date and not indexed:
+            found = found + self.undated
+
+        if [argument for argument in kwargs if argument != 'debug']:
+            kwargs['has_date'] = False
+            found = [entry for entry in found if self.test(entry[0], entry[2], **kwargs)]
+        return found
+
+    def query(self, **kwargs):
+        """
+        The items that meet the criteria (see meets_criteria()), oldest first
+        """
+        return [entry[1] for entry in self.entries(**kwargs)]
+
+    def _after_index(self, cutoff):
+        cutoff = self._cutoff(criteria.After, cutoff)
+        if not cutoff:
+            return 0
+        return bisect.bisect_right(self.dates, cutoff)
+
+    def _before_index(self, cutoff):
+        cutoff = self._cutoff(criteria.Before, cutoff)
+        if not cutoff:
+            return len(self.dates)
+        return bisect.bisect_left(self.dates, cutoff)
+
+    def _cutoff(self, criteria_class, argument):
+        this_criteria = criteria_class()
+        this_criteria.set_argument(argument)
+        return this_criteria.argument
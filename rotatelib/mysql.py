@@ -0,0 +1,210 @@
+import collections
+import threading
+import time
+import Queue
+
+# schemas that never hold backup tables
+SYSTEM_SCHEMAS = ['information_schema', 'mysql', 'performance_schema', 'sys']
+
+# table names with something that looks like a date (see rotatelib.parse_name())
+DATED_TABLE_REGEXP = '[0-9]{4}-?[0-9]{2}-?[0-9]{2}'
+
+
+class BackupTable(collections.namedtuple('BackupTable', ['server', 'schema', 'table'])):
+    """
+    A backup table found by scan_backup_tables(). str() gives the schema qualified
+    name, so these can be passed straight to remove_items() with a connection to
+    the same server.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return '%s.%s' % (self.schema, self.table)
+
+
+class ConnectionPool(object):
+    """
+    A small pool of connections to one database server.
+
+    `connect` is called with no arguments to open a new connection (e.g.
+    lambda: MySQLdb.connect(host, user, password)). At most `size` connections
+    are opened. `paramstyle` is the DB-API parameter style of the driver
+    ('format' for MySQLdb, 'qmark' for sqlite3).
+    """
+    def __init__(self, connect, size=2, name=None, paramstyle='format'):
+        self.connect = connect
+        self.size = size
+        self.name = name
+        self.paramstyle = paramstyle
+        self.idle = Queue.Queue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+    def get(self):
+        """
+        An idle connection, a new one if there is room, or the next one to be put back
+        """
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            if self.opened < self.size:
+                self.opened += 1
+                return self.connect()
+        return self.idle.get()
+
+    def put(self, db):
+        self.idle.put(db)
+
+    def placeholder(self):
+        if self.paramstyle == 'qmark':
+            return '?'
+        return '%s'
+
+
+def fetch_backup_tables(pool, schemas=None):
+    """
+    (schema, table) for every table with a date-like name on the server, in one
+    information_schema query. Only the given `schemas` are looked at, if any.
+    """
+    sql = ("SELECT table_schema, table_name FROM information_schema.tables "
+           "WHERE table_type = 'BASE TABLE' AND table_name REGEXP '%s'" % DATED_TABLE_REGEXP)
+    if schemas:
+        params = list(schemas)
+        sql += ' AND table_schema IN (%s)' % ', '.join([pool.placeholder()] * len(params))
+    else:
+        params = list(SYSTEM_SCHEMAS)
+        sql += ' AND table_schema NOT IN (%s)' % ', '.join([pool.placeholder()] * len(params))
+
+    db = pool.get()
+    try:
+        cur = db.cursor()
+        cur.execute(sql, params)
+        return [(row[0], row[1]) for row in cur.fetchall()]
+    finally:
+        pool.put(db)
+
+
+class DropPacer(object):
+    """
+    Paces DROP TABLE on a busy MySQL server, see remove_items(db=..., pacer=...).
+
+    The session's `lock_wait_timeout` is lowered so a drop that is blocked by a
+    long running query gives up quickly (and is retried later as a lock wait
+    timeout) instead of queueing every other query on that table behind its
+    metadata lock. Tables are dropped `batch_size` at a time with a `pause`
+    between batches to spread out the buffer pool work of each drop. Before
+    each batch we wait, checking every `check_interval` seconds, while the
+    server has more than `max_threads_running` running threads or any of the
+    `replicas` (connections to them) is more than `max_replication_lag`
+    seconds behind. If the server is still busy after `max_wait` seconds, the
+    drop fails instead. The session's own lock_wait_timeout is put back once
+    the drops are done.
+    """
+    def __init__(self, lock_wait_timeout=5, batch_size=10, pause=1.0, max_threads_running=None, replicas=None,
+                 max_replication_lag=None, check_interval=1.0, max_wait=None):
+        self.lock_wait_timeout = lock_wait_timeout
+        self.batch_size = batch_size
+        self.pause = pause
+        self.max_threads_running = max_threads_running
+        self.replicas = replicas or []
+        self.max_replication_lag = max_replication_lag
+        self.check_interval = check_interval
+        self.max_wait = max_wait
+        self.dropped = 0
+        self.paced_at = None
+        self.previous_lock_wait_timeout = None
+        self.stats = {'batches': 0, 'waits': 0, 'waited': 0.0}
+
+    def busy(self, cur):
+        """
+        Why the server is too busy for the next batch, or None if it isn't
+        """
+        if self.max_threads_running is not None:
+            threads_running = threads_running_status(cur)
+            if threads_running > self.max_threads_running:
+                return 'Threads_running is %d' % threads_running
+        if self.max_replication_lag is not None:
+            for replica in self.replicas:
+                lag = replication_lag(replica)
+                if lag is None:
+                    return 'replication is not running on a replica'
+                if lag > self.max_replication_lag:
+                    return 'a replica is %d seconds behind' % lag
+        return None
+
+    def start(self, cur):
+        """
+        Set up the connection the tables are dropped on (see finish())
+        """
+        self.dropped = 0
+        self.paced_at = None
+        cur.execute('SELECT @@SESSION.lock_wait_timeout')
+        self.previous_lock_wait_timeout = int(cur.fetchone()[0])
+        cur.execute('SET SESSION lock_wait_timeout = %d' % self.lock_wait_timeout)
+
+    def finish(self, cur):
+        """
+        Put the connection's lock_wait_timeout back the way start() found it
+        """
+        if self.previous_lock_wait_timeout is not None:
+            cur.execute('SET SESSION lock_wait_timeout = %d' % self.previous_lock_wait_timeout)
+            self.previous_lock_wait_timeout = None
+
+    def wait(self, cur):
+        """
+        Called before each drop: pause between batches and wait for the server to be quiet. A drop
+        that is retried (e.g. after a lock wait timeout) is only paced once.
+        """
+        if self.dropped % self.batch_size == 0 and self.paced_at != self.dropped:
+            if self.dropped and self.pause:
+                time.sleep(self.pause)
+            self.stats['batches'] += 1
+            start = time.time()
+            reason = self.busy(cur)
+            while reason:
+                if self.max_wait is not None and time.time() - start >= self.max_wait:
+                    raise Exception('The server is still busy after %d seconds: %s' % (self.max_wait, reason))
+                self.stats['waits'] += 1
+                time.sleep(self.check_interval)
+                reason = self.busy(cur)
+            self.stats['waited'] += time.time() - start
+            # only once the server is quiet, so the next drop waits again if this one gave up
+            self.paced_at = self.dropped
+
+    def done(self):
+        """
+        Called after each table is dropped (or found already gone), so only real drops count toward
+        a batch
+        """
+        self.dropped += 1
+
+
+def replication_lag(db):
+    """
+    Seconds_Behind_Master of a replica, or None if it is not replicating
+    """
+    cur = db.cursor()
+    cur.execute('SHOW SLAVE STATUS')
+    row = cur.fetchone()
+    if not row:
+        return None
+    columns = [column[0] for column in cur.description]
+    lag = row[columns.index('Seconds_Behind_Master')]
+    if lag is None:
+        return None
+    return int(lag)
+
+
+def threads_running_status(cur):
+    cur.execute("SHOW GLOBAL STATUS LIKE 'Threads_running'")
+    row = cur.fetchone()
+    return int(row[1])
@@ -0,0 +1,97 @@
+import datetime
+import email.utils
+
+
+def parse_timestamp(value):
+    """
+    A naive datetime for a backend timestamp: an ISO 8601 string such as S3's last_modified or EC2's
+    start_time ('2009-06-15T11:30:00.000Z'), an RFC 1123 string (the Last-Modified header), seconds
+    since the epoch or a datetime. Times are UTC. Returns None if the value can't be read.
+    """
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, (int, long, float)):
+        return datetime.datetime.utcfromtimestamp(value)
+    try:
+        # slicing is much faster than strptime or a regex for the usual fixed layout
+        if value[4] == '-' and value[10] == 'T':
+            return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                     int(value[11:13]), int(value[14:16]), int(value[17:19] or 0))
+    except (IndexError, ValueError):
+        pass
+    parsed = email.utils.parsedate(value)
+    if parsed:
+        return datetime.datetime(*parsed[:6])
+    return None
+
+
+class ParsedName(dict):
+    """
+    What parse_name() returns: a dictionary with the item's `name` and `date`.
+
+    The date is only looked for the first time it is asked for, and then kept,
+    so items that are rejected on their name or extension alone never pay for
+    the date regexes.
+    """
+    __slots__ = ['find_date']
+
+    def __init__(self, name, find_date):
+        """
+        `find_date` is called with no arguments to get the date (or None)
+        """
+        dict.__init__(self, name=name)
+        self.find_date = find_date
+
+    def __missing__(self, key):
+        if key != 'date' or self.find_date is None:
+            raise KeyError(key)
+        date = self.find_date()
+        self.find_date = None
+        self['date'] = date
+        return date
+
+    def resolve(self):
+        """
+        Find the date now, if it hasn't been yet
+        """
+        if self.find_date is not None:
+            self['date']
+        return self
+
+    def __contains__(self, key):
+        return (key == 'date' and self.find_date is not None) or dict.__contains__(self, key)
+
+    def __eq__(self, other):
+        return dict.__eq__(self.resolve(), other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __iter__(self):
+        return dict.__iter__(self.resolve())
+
+    def __len__(self):
+        return dict.__len__(self.resolve())
+
+    def __repr__(self):
+        return dict.__repr__(self.resolve())
+
+    def copy(self):
+        return dict(self.resolve())
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self):
+        return dict.items(self.resolve())
+
+    def iteritems(self):
+        return dict.iteritems(self.resolve())
+
+    def keys(self):
+        return dict.keys(self.resolve())
+
+    def values(self):
+        return dict.values(self.resolve())
@@ -0,0 +1,210 @@
+import contextlib
+import fcntl
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+
+def hash_partition(name, partitions):
+    """
+    The hash partition a name belongs to. Stable across processes and hosts.
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return (zlib.crc32(name) & 0xffffffff) % partitions
+
+
+class SQLiteLeaseStore(object):
+    """
+    Leases kept in a table of a SQLite database on shared storage
+    """
+    def __init__(self, path):
+        self.path = path
+        db = self._connect()
+        db.execute('CREATE TABLE IF NOT EXISTS rotatelib_leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+        db.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def acquire(self, name, owner, ttl):
+        """
+        Take (or renew) the lease if it is free, expired or already ours
+        """
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT owner, expires FROM rotatelib_leases WHERE name = ?', (name,)).fetchone()
+            now = time.time()
+            if row and row[0] != owner and row[1] > now:
+                db.execute('ROLLBACK')
+                return False
+            db.execute('INSERT OR REPLACE INTO rotatelib_leases (name, owner, expires) VALUES (?, ?, ?)', (name, owner, now + ttl))
+            db.execute('COMMIT')
+            return True
+        finally:
+            db.close()
+
+    def release(self, name, owner):
+        db = self._connect()
+        try:
+            db.execute('DELETE FROM rotatelib_leases WHERE name = ? AND owner = ?', (name, owner))
+        finally:
+            db.close()
+
+
+class DirectoryLeaseStore(object):
+    """
+    Leases kept as one file per lease in a directory, guarded by a lock file
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _lease_file(self, name):
+        return os.path.join(self.path, '%s.lease' % name)
+
+    def _locked(self, func):
+        lock = open(os.path.join(self.path, '.lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            return func()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def _read(self, name):
+        try:
+            with open(self._lease_file(name)) as f:
+                owner, expires = f.read().rsplit(' ', 1)
+            return owner, float(expires)
+        except (IOError, ValueError):
+            return None
+
+    def acquire(self, name, owner, ttl):
+        """
+        Take (or renew) the lease if it is free, expired or already ours
+        """
+        def acquire():
+            lease = self._read(name)
+            now = time.time()
+            if lease and lease[0] != owner and lease[1] > now:
+                return False
+            temp = '%s.%s.tmp' % (self._lease_file(name), uuid.uuid4().hex)
+            with open(temp, 'w') as f:
+                f.write('%s %f' % (owner, now + ttl))
+            os.rename(temp, self._lease_file(name))
+            return True
+        return self._locked(acquire)
+
+    def release(self, name, owner):
+        def release():
+            lease = self._read(name)
+            if lease and lease[0] == owner:
+                os.remove(self._lease_file(name))
+        self._locked(release)
+
+
+class PartitionWorker(object):
+    """
+    One of several cooperating workers that split a source between them.
+
+    The keyspace is split either into `partitions` hash partitions or into a
+    list of non-overlapping `prefixes` (full S3 key or file name prefixes). A
+    worker only lists and removes keys in the partitions it holds a lease for;
+    with prefix partitions on S3 only the owned prefixes are listed at all.
+    With hash partitions every worker lists the whole source and keeps its own
+    share, so N workers cost N full listings: use them for local directories,
+    inventories and listing files, and prefix partitions for S3.
+
+    Leases live in a shared `store` (SQLiteLeaseStore or DirectoryLeaseStore)
+    and expire `ttl` seconds after they were last taken, so a partition held
+    by a worker that died is picked up by the next worker to call acquire().
+    They are renewed in the background while rotatelib lists or removes for
+    the worker (see renewing()).
+
+    Pass the worker to list_archives(), list_items(), list_logs() and
+    remove_items() as `partition`.
+    """
+    def __init__(self, store, partitions=None, prefixes=None, name='rotatelib', owner=None, ttl=300):
+        if bool(partitions) == bool(prefixes):
+            raise Exception('Give either the number of partitions or a list of prefixes')
+        self.store = store
+        self.prefixes = prefixes
+        self.partitions = partitions or len(prefixes)
+        self.name = name
+        self.owner = owner or '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.ttl = ttl
+        self.held = []
+
+    def _lease_name(self, partition):
+        return '%s-%d' % (self.name, partition)
+
+    def acquire(self, limit=1):
+        """
+        Renew the leases we hold and take free or expired partitions until we hold
+        `limit` of them (no limit if None). Returns the partitions we hold.
+        """
+        self.renew()
+        for partition in range(self.partitions):
+            if limit is not None and len(self.held) >= limit:
+                break
+            if partition not in self.held and self.store.acquire(self._lease_name(partition), self.owner, self.ttl):
+                self.held.append(partition)
+        self.held.sort()
+        return self.held
+
+    def owned_prefixes(self):
+        if not self.prefixes:
+            return []
+        return [self.prefixes[partition] for partition in self.held]
+
+    def owns(self, name):
+        """
+        Is this name (file or table name, S3 key or snapshot id) in one of our partitions?
+        """
+        if self.prefixes:
+            for prefix in self.owned_prefixes():
+                if name.startswith(prefix):
+                    return True
+            return False
+        return hash_partition(name, self.partitions) in self.held
+
+    def release(self):
+        for partition in self.held:
+            self.store.release(self._lease_name(partition), self.owner)
+        self.held = []
+
+    @contextlib.contextmanager
+    def renewing(self, interval=None):
+        """
+        Renew our leases every `interval` seconds (a third of the ttl by default) in the background
+        while the block runs, so they do not expire during a long listing or removal
+        """
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(interval or self.ttl / 3.0):
+                self.renew()
+
+        thread = threading.Thread(target=renew)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+    def renew(self):
+        """
+        Extend our leases, dropping any that another worker has taken over
+        """
+        self.held = [partition for partition in self.held
+                     if self.store.acquire(self._lease_name(partition), self.owner, self.ttl)]
+        return self.held
@@ -0,0 +1,73 @@
+import sys
+import threading
+import Queue
+
+_END = object()
+
+
+class _Failed(Exception):
+    """
+    Passed down the pipeline when an earlier part raised an exception
+    """
+    def __init__(self, exc_info):
+        Exception.__init__(self)
+        self.exc_info = exc_info
+
+
+def run_pipeline(source, stages, queue_size=8):
+    """
+    Run `source` through `stages` with every part in its own thread, so that
+    all of them work at the same time.
+
+    Each stage is a function that takes an iterable and returns an iterable.
+    Parts are connected by queues of `queue_size` elements, so a slow stage
+    holds back the ones before it instead of letting work pile up in memory.
+    Returns the output of the last stage as a list. An exception in any part
+    stops the pipeline and is raised here.
+    """
+    queues = [Queue.Queue(maxsize=queue_size) for stage in stages]
+    stopped = threading.Event()
+
+    def put(queue, value):
+        while not stopped.is_set():
+            try:
+                queue.put(value, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def drain(queue):
+        while True:
+            value = queue.get()
+            if value is _END:
+                return
+            if isinstance(value, _Failed):
+                raise value
+            yield value
+
+    def run(iterable, output):
+        try:
+            for value in iterable:
+                if not put(output, value):
+                    return
+            put(output, _END)
+        except _Failed, e:
+            put(output, e)
+        except Exception:
+            put(output, _Failed(sys.exc_info()))
+
+    # the source feeds the first queue, stage i reads queue i - 1 and feeds queue i
+    threads = [threading.Thread(target=run, args=(source, queues[0]))]
+    for i in range(len(stages) - 1):
+        threads.append(threading.Thread(target=run, args=(stages[i](drain(queues[i])), queues[i + 1])))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        return list(stages[-1](drain(queues[-1])))
+    except _Failed, e:
+        raise e.exc_info[0], e.exc_info[1], e.exc_info[2]
+    finally:
+        stopped.set()
@@ -0,0 +1,415 @@
+"""
+In-memory stand-ins for boto's S3 and EC2 connections, for benchmarking and
+testing rotatelib offline.
+
+They hold as many keys and snapshots as fit in memory, page their listings
+like the real APIs and can add a fixed latency to every request and answer
+some requests with throttle errors (S3 SlowDown, EC2 RequestLimitExceeded),
+either at random or whenever too many requests are in flight at once.
+
+>>> s3 = SimulatedS3Connection(latency=0.01, max_concurrency=16)
+>>> s3.create_bucket('mybucket').fill(100000, prefix='backups/db-')
+>>> items = rotatelib.list_archives(s3bucket='mybucket', directory='backups/', s3_connection=s3, before=datetime.timedelta(30))
+>>> rotatelib.remove_items(items=items, s3bucket='mybucket', s3_connection=s3)
+>>> s3.stats
+"""
+import bisect
+import datetime
+import random
+import threading
+import time
+import urlparse
+from StringIO import StringIO
+from xml.sax.saxutils import escape
+
+from sources import KeyRecord
+
+
+class SimulatedError(Exception):
+    """
+    An error from a simulated backend, with the `error_code` boto would give
+    """
+    def __init__(self, error_code, status=400):
+        super(SimulatedError, self).__init__('%s %s' % (status, error_code))
+        self.error_code = error_code
+        self.status = status
+
+
+class SimulatedBackend(object):
+    """
+    Latency and throttling shared by the simulated connections.
+
+    Every request waits `latency` seconds (plus up to `jitter` more). A request
+    is throttled with probability `throttle_rate`, or when `max_concurrency`
+    requests are already in flight. `seed` makes the random throttling
+    repeatable. Counts of requests by kind are kept in `stats`.
+    """
+    throttle_code = 'Throttling'
+
+    def __init__(self, latency=0, jitter=0, throttle_rate=0, max_concurrency=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.max_concurrency = max_concurrency
+        self.random = random.Random(seed)
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'throttled': 0}
+        self.lock = threading.Lock()
+
+    def request(self, kind, func, *args):
+        """
+        Run `func` as one request of the given kind, with latency and throttling
+        """
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats[kind] = self.stats.get(kind, 0) + 1
+            throttled = ((self.max_concurrency is not None and self.in_flight >= self.max_concurrency) or
+                         (self.throttle_rate and self.random.random() < self.throttle_rate))
+            if throttled:
+                self.stats['throttled'] += 1
+            else:
+                self.in_flight += 1
+            delay = self.latency + (self.jitter and self.random.random() * self.jitter)
+        if throttled:
+            if delay:
+                time.sleep(delay)
+            raise SimulatedError(self.throttle_code, 503)
+        try:
+            if delay:
+                time.sleep(delay)
+            return func(*args)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def retried_request(self, kind, retries, func, *args):
+        """
+        request(), retrying throttled requests up to `retries` times after a short wait as boto
+        does for listings. Removals are not retried here so the RemovalExecutor sees the throttling.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self.request(kind, func, *args)
+            except SimulatedError, e:
+                attempt += 1
+                if e.error_code != self.throttle_code or attempt > retries:
+                    raise
+                time.sleep(min(0.001 * 2 ** attempt, 1.0))
+
+
+class SimulatedBucket(object):
+    """
+    A bucket of a SimulatedS3Connection. Keys are KeyRecords; list() pages
+    through them in key order `page_size` at a time like ListObjects.
+    """
+    def __init__(self, connection, name, page_size=1000):
+        self.connection = connection
+        self.name = name
+        self.page_size = page_size
+        self.keys = {}
+        self.names = []
+        self.unsorted = False
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __nonzero__(self):
+        # an empty one is still there to connect to
+        return True
+
+    def add_key(self, key, size=0, last_modified=None):
+        with self.lock:
+            if key not in self.keys:
+                self.names.append(key)
+                self.unsorted = True
+            self.keys[key] = KeyRecord(key, size, last_modified)
+
+    def delete_key(self, key):
+        return self.connection.request('delete', self._delete_key, key)
+
+    def _delete_key(self, key):
+        # like S3, deleting a key that is not there is not an error
+        with self.lock:
+            self.keys.pop(key, None)
+
+    def fill(self, count, prefix='backup-', suffix='.tar.gz', start=None, step=datetime.timedelta(hours=1), size=1024):
+        """
+        Add `count` keys named prefix + date + suffix, one `step` apart going back from `start`
+        (default: now), with matching last modified times
+        """
+        date = start or datetime.datetime.utcnow().replace(microsecond=0)
+        for i in xrange(count):
+            self.add_key('%s%s%s' % (prefix, date.strftime('%Y-%m-%dT%H%M%S'), suffix), size,
+                         date.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+            date -= step
+        return self
+
+    def get_key(self, key):
+        return self.connection.request('get', self.keys.get, key)
+
+    def list(self, prefix='', delimiter='', marker='', retries=5):
+        """
+        Yield the keys starting with `prefix` that come after `marker`, fetching them a page at a
+        time. With a `delimiter`, the keys that have it after the prefix are rolled up into one
+        SimulatedPrefix per common prefix, like ListObjects does. Throttled page requests are
+        retried up to `retries` times.
+        """
+        while True:
+            page, truncated, marker = self.connection.retried_request('list', retries, self._page, prefix, delimiter, marker,
+                                                                      self.page_size)
+            for entry in page:
+                yield entry
+            if not truncated:
+                return
+
+    def _page(self, prefix, delimiter, marker, page_size):
+        with self.lock:
+            if self.unsorted:
+                self.names = sorted(name for name in self.names if name in self.keys)
+                self.unsorted = False
+            names = self.names
+            i = bisect.bisect_left(names, prefix)
+            if marker:
+                i = max(i, bisect.bisect_right(names, marker))
+            page = []
+            truncated = False
+            while i < len(names) and names[i].startswith(prefix):
+                name = names[i]
+                if name not in self.keys:
+                    i += 1
+                    continue
+                if len(page) == page_size:
+                    # like IsTruncated: there is at least one more entry
+                    truncated = True
+                    break
+                position = name.find(delimiter, len(prefix)) if delimiter else -1
+                if position == -1:
+                    page.append(self.keys[name])
+                    i += 1
+                else:
+                    common = name[:position + len(delimiter)]
+                    page.append(SimulatedPrefix(common))
+                    # skip every key under the common prefix
+                    i = bisect.bisect_left(names, common[:-1] + chr(ord(common[-1]) + 1))
+                marker = names[i - 1]
+            if len(names) > 2 * len(self.keys) + 1000:
+                # drop deleted names once they are most of the list
+                self.unsorted = True
+            return page, truncated, marker
+
+
+class SimulatedPrefix(object):
+    """
+    A common prefix in a delimited listing, like boto's Prefix
+    """
+    __slots__ = ['name']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return '<SimulatedPrefix: %s>' % self.name
+
+
+class SimulatedS3Connection(SimulatedBackend):
+    """
+    Stands in for a boto S3Connection (see SimulatedBackend for the options)
+    """
+    throttle_code = 'SlowDown'
+
+    def __init__(self, page_size=1000, **kwargs):
+        super(SimulatedS3Connection, self).__init__(**kwargs)
+        self.page_size = page_size
+        self.buckets = {}
+
+    def create_bucket(self, name):
+        self.buckets[name] = SimulatedBucket(self, name, self.page_size)
+        return self.buckets[name]
+
+    def get_bucket(self, name):
+        if name not in self.buckets:
+            raise SimulatedError('NoSuchBucket', 404)
+        return self.buckets[name]
+
+    def make_request(self, method, bucket='', key='', headers=None, query_args=None, retries=5):
+        """
+        Answer a ListObjects request (a GET on a bucket) with the XML S3 sends, as read by
+        rotatelib.sources.iter_s3_keys(). Pages are at most `page_size` keys.
+        """
+        if method != 'GET' or key:
+            raise SimulatedError('NotImplemented', 501)
+        params = dict(urlparse.parse_qsl(query_args or '', keep_blank_values=True))
+        prefix = params.get('prefix', '')
+        delimiter = params.get('delimiter', '')
+        marker = params.get('marker', '')
+        page_size = min(int(params.get('max-keys', self.page_size)), self.page_size)
+        page, truncated, next_marker = self.retried_request('list', retries, self.get_bucket(bucket)._page, prefix,
+                                                            delimiter, marker, page_size)
+
+        body = ['<?xml version="1.0" encoding="UTF-8"?>\n<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+                '<Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker><MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>' %
+                (escape(bucket), escape(prefix), escape(marker), page_size, 'true' if truncated else 'false')]
+        if truncated and delimiter:
+            body.append('<NextMarker>%s</NextMarker>' % escape(next_marker))
+        for entry in page:
+            if isinstance(entry, SimulatedPrefix):
+                body.append('<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' % escape(entry.name))
+                continue
+            body.append('<Contents><Key>%s</Key>' % escape(entry.key))
+            if entry.last_modified:
+                body.append('<LastModified>%s</LastModified>' % entry.last_modified)
+            if entry.etag:
+                body.append('<ETag>%s</ETag>' % escape(entry.etag))
+            body.append('<Size>%d</Size><StorageClass>STANDARD</StorageClass></Contents>' % (entry.size or 0))
+        body.append('</ListBucketResult>')
+        return SimulatedResponse(''.join(body))
+
+
+class SimulatedResponse(StringIO):
+    """
+    The body and status of a simulated HTTP response, like boto's
+    """
+    def __init__(self, body, status=200, reason='OK'):
+        StringIO.__init__(self, body)
+        self.status = status
+        self.reason = reason
+
+
+class SimulatedSnapshot(object):
+    """
+    The parts of a boto Snapshot that rotatelib looks at
+    """
+    __slots__ = ['id', 'description', 'start_time', 'volume_id', 'status', 'tags']
+
+    def __init__(self, id, description='', start_time=None, volume_id=None, status='completed', tags=None):
+        self.id = id
+        self.description = description
+        self.start_time = start_time
+        self.volume_id = volume_id
+        self.status = status
+        self.tags = tags or {}
+
+    def __repr__(self):
+        return 'Snapshot:%s' % self.id
+
+
+class SimulatedEC2Connection(SimulatedBackend):
+    """
+    Stands in for a boto EC2Connection: DescribeSnapshots with filters and
+    MaxResults/NextToken paging, and DeleteSnapshot (see SimulatedBackend for
+    the options). Pages are at most `page_size` snapshots.
+    """
+    throttle_code = 'RequestLimitExceeded'
+
+    def __init__(self, page_size=1000, **kwargs):
+        super(SimulatedEC2Connection, self).__init__(**kwargs)
+        self.page_size = page_size
+        self.snapshots = {}
+        self.ids = []
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def __nonzero__(self):
+        # an empty one is still there to connect to
+        return True
+
+    def add_snapshot(self, description='', start_time=None, volume_id=None, status='completed', tags=None):
+        with self.lock:
+            self.next_id += 1
+            snapshot = SimulatedSnapshot('snap-%08x' % self.next_id, description, start_time, volume_id, status, tags)
+            self.snapshots[snapshot.id] = snapshot
+            self.ids.append(snapshot.id)
+        return snapshot
+
+    def fill(self, count, description='backup ', volume_id='vol-00000001', start=None, step=datetime.timedelta(hours=1)):
+        """
+        Add `count` snapshots described as description + date, one `step` apart going back from
+        `start` (default: now)
+        """
+        date = start or datetime.datetime.utcnow().replace(microsecond=0)
+        for i in xrange(count):
+            self.add_snapshot(description + date.strftime('%Y-%m-%dT%H:%M:%S'), date.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                              volume_id)
+            date -= step
+        return self
+
+    def build_list_params(self, params, items, label):
+        if isinstance(items, basestring):
+            items = [items]
+        for i, item in enumerate(items):
+            params['%s.%d' % (label, i + 1)] = item
+
+    def build_filter_params(self, params, filters):
+        i = 1
+        for name in filters:
+            aws_name = name
+            if not aws_name.startswith('tag:'):
+                aws_name = name.replace('_', '-')
+            params['Filter.%d.Name' % i] = aws_name
+            value = filters[name]
+            if not isinstance(value, list):
+                value = [value]
+            for j, v in enumerate(value):
+                params['Filter.%d.Value.%d' % (i, j + 1)] = v
+            i += 1
+
+    def delete_snapshot(self, snapshot_id):
+        return self.request('delete', self._delete_snapshot, snapshot_id)
+
+    def _delete_snapshot(self, snapshot_id):
+        with self.lock:
+            if self.snapshots.pop(snapshot_id, None) is None:
+                raise SimulatedError('InvalidSnapshot.NotFound')
+            return True
+
+    def get_list(self, action, params, markers, verb='GET'):
+        if action != 'DescribeSnapshots':
+            raise SimulatedError('InvalidAction')
+        return self.retried_request('list', 5, self._describe_snapshots, params)
+
+    def _describe_snapshots(self, params):
+        filters = {}
+        i = 1
+        while 'Filter.%d.Name' % i in params:
+            values = []
+            j = 1
+            while 'Filter.%d.Value.%d' % (i, j) in params:
+                values.append(params['Filter.%d.Value.%d' % (i, j)])
+                j += 1
+            filters[params['Filter.%d.Name' % i]] = values
+            i += 1
+
+        page_size = min(int(params.get('MaxResults', self.page_size)), self.page_size)
+        start = int(params.get('NextToken', 0))
+        page = SimulatedResultSet()
+        with self.lock:
+            position = start
+            while position < len(self.ids) and len(page) < page_size:
+                snapshot = self.snapshots.get(self.ids[position])
+                position += 1
+                if snapshot is not None and self._matches(snapshot, filters):
+                    page.append(snapshot)
+            if position < len(self.ids):
+                page.next_token = str(position)
+        return page
+
+    def _matches(self, snapshot, filters):
+        for name, values in filters.items():
+            if name.startswith('tag:'):
+                value = snapshot.tags.get(name[4:])
+            else:
+                value = getattr(snapshot, name.replace('-', '_'), None)
+            if value not in values:
+                return False
+        return True
+
+
+class SimulatedResultSet(list):
+    """
+    A page of results, with the token for the next page (if there is one)
+    """
+    next_token = None
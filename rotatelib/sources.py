@@ -0,0 +1,189 @@
+import csv
+import gzip
+import json
+import mmap
+import os
+import urllib
+from xml.etree import cElementTree
+
+# the columns of an inventory file when there is no manifest to tell us
+DEFAULT_INVENTORY_SCHEMA = ['Bucket', 'Key', 'Size', 'LastModifiedDate']
+
+
+class KeyRecord(object):
+    """
+    A minimal stand-in for a boto S3 Key: just the parts rotatelib looks at
+    """
+    __slots__ = ['key', 'size', 'last_modified', 'etag']
+
+    def __init__(self, key, size=None, last_modified=None, etag=None):
+        self.key = key
+        self.size = size
+        self.last_modified = last_modified
+        self.etag = etag
+
+    def __repr__(self):
+        return '<KeyRecord: %s>' % self.key
+
+
+def _iter_lines(path):
+    """
+    Yield the lines of a plain (memory-mapped) or gzipped file without reading it all in
+    """
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+        try:
+            for line in f:
+                yield line
+        finally:
+            f.close()
+        return
+
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for line in iter(mapped.readline, ''):
+                yield line
+        finally:
+            mapped.close()
+
+
+def iter_listing_file(path, prefix='', block_size=1 << 20):
+    """
+    Yield the names in a newline-delimited listing file (e.g. `find` output, an rsync manifest or a
+    database export) that start with `prefix`. The file (plain or gzipped) is read `block_size` bytes
+    at a time, so memory use does not grow with the size of the file.
+    """
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+    else:
+        f = open(path, 'rb')
+    try:
+        rest = ''
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            lines = (rest + block).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                line = line.rstrip('\r')
+                if line and line.startswith(prefix):
+                    yield line
+        rest = rest.rstrip('\r')
+        if rest and rest.startswith(prefix):
+            yield rest
+    finally:
+        f.close()
+
+
+def inventory_files(path):
+    """
+    The data files of an S3 Inventory and their column names. `path` is a manifest.json (whose data
+    files are looked for next to it), a single CSV file or a list of CSV files.
+    """
+    if isinstance(path, (list, tuple)):
+        return list(path), DEFAULT_INVENTORY_SCHEMA
+    if not path.endswith('.json'):
+        return [path], DEFAULT_INVENTORY_SCHEMA
+
+    with open(path) as f:
+        manifest = json.load(f)
+    schema = [column.strip() for column in manifest['fileSchema'].split(',')]
+    base = os.path.dirname(path)
+    files = []
+    for data_file in manifest['files']:
+        candidates = [os.path.join(base, data_file['key']),
+                      os.path.join(base, 'data', os.path.basename(data_file['key'])),
+                      os.path.join(base, os.path.basename(data_file['key']))]
+        found = [candidate for candidate in candidates if os.path.exists(candidate)]
+        if not found:
+            raise Exception('Could not find the inventory file <%s> next to <%s>' % (data_file['key'], path))
+        files.append(found[0])
+    return files, schema
+
+
+def iter_inventory(path, schema=None, prefix='', bucket=None):
+    """
+    Yield a KeyRecord for every key in an S3 Inventory (see inventory_files()) that starts with
+    `prefix` (and is in `bucket`, if given). Only the key, size and last modified columns are
+    decoded.
+    """
+    files, file_schema = inventory_files(path)
+    schema = schema or file_schema
+    key_column = schema.index('Key')
+    bucket_column = schema.index('Bucket') if 'Bucket' in schema else None
+    size_column = schema.index('Size') if 'Size' in schema else None
+    modified_column = schema.index('LastModifiedDate') if 'LastModifiedDate' in schema else None
+
+    for data_file in files:
+        for row in csv.reader(_iter_lines(data_file)):
+            if not row:
+                continue
+            if bucket and bucket_column is not None and row[bucket_column] != bucket:
+                continue
+            key = urllib.unquote_plus(row[key_column])
+            if prefix and not key.startswith(prefix):
+                continue
+            size = None
+            if size_column is not None and row[size_column]:
+                size = int(row[size_column])
+            modified = None
+            if modified_column is not None:
+                modified = row[modified_column] or None
+            yield KeyRecord(key, size, modified)
+
+
+def iter_s3_keys(connection, bucket, prefix='', page_size=1000, marker=''):
+    """
+    Yield a KeyRecord for every key in the bucket that starts with `prefix` (and comes after `marker`),
+    using a boto S3Connection to request ListObjects pages of `page_size` keys. Each response is parsed
+    as it is read and only the key, size, last modified time and etag are kept, so no boto Key objects
+    are built.
+    """
+    while True:
+        query_args = 'max-keys=%d&prefix=%s' % (page_size, urllib.quote(_utf8(prefix), safe=''))
+        if marker:
+            query_args += '&marker=%s' % urllib.quote(_utf8(marker), safe='')
+        response = connection.make_request('GET', bucket, query_args=query_args)
+        if response.status != 200:
+            raise connection.provider.storage_response_error(response.status, response.reason, response.read())
+
+        truncated = False
+        record = None
+        root = None
+        for event, element in cElementTree.iterparse(response, events=('start', 'end')):
+            tag = element.tag.rsplit('}', 1)[-1]
+            if event == 'start':
+                if root is None:
+                    root = element
+                elif tag == 'Contents':
+                    record = KeyRecord(None)
+                continue
+            if record is not None:
+                if tag == 'Key':
+                    record.key = element.text or ''
+                elif tag == 'Size':
+                    record.size = int(element.text)
+                elif tag == 'LastModified':
+                    record.last_modified = element.text
+                elif tag == 'ETag':
+                    record.etag = element.text
+                elif tag == 'Contents':
+                    marker = record.key
+                    yield record
+                    record = None
+                    # drop the parsed elements so memory stays flat however long the page is
+                    root.clear()
+            elif tag == 'IsTruncated':
+                truncated = element.text == 'true'
+        if not truncated or not marker:
+            return
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
@@ -0,0 +1,40 @@
+import random
+import re
+import threading
+
+
+class TraceSink(object):
+    """
+    Collects a record of how each item was evaluated by meets_criteria().
+
+    Pass the sink as `trace` to meets_criteria() or the list_* functions. Each
+    record is a dictionary with the item's `name`, its parsed `date`, the
+    `criteria` that were evaluated in order as (name, argument, passed) tuples,
+    the first criterion that `failed` (or None) and whether the item `passed`.
+
+    Only a `sample_rate` fraction of items, and only items whose name matches
+    `pattern` (a regex), are traced. At most `max_records` are kept. Override
+    emit() to send records somewhere else. Without a sink nothing is recorded
+    and evaluation is unchanged.
+    """
+    def __init__(self, sample_rate=1.0, pattern=None, max_records=None):
+        self.sample_rate = sample_rate
+        self.pattern = re.compile(pattern) if pattern else None
+        self.max_records = max_records
+        self.records = []
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        with self.lock:
+            if self.max_records is None or len(self.records) < self.max_records:
+                self.records.append(record)
+
+    def wants(self, name):
+        """
+        Should this item be traced?
+        """
+        if self.pattern and not self.pattern.search(name):
+            return False
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        return True
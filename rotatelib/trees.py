@@ -0,0 +1,110 @@
+import errno
+import os
+import stat
+import threading
+import Queue
+
+
+def remove_tree(path, max_workers=8):
+    """
+    Remove a directory and everything in it, like shutil.rmtree(), but with up
+    to `max_workers` threads listing directories and unlinking files at the
+    same time. Each directory is removed as soon as everything below it is
+    gone. Symlinks are removed, never followed.
+
+    Entries that disappear while we work are ignored. Any other error is
+    raised once the rest of the tree has been removed. Returns the number of
+    files and directories removed.
+    """
+    if os.path.islink(path) or not os.path.isdir(path):
+        os.unlink(path)
+        return 1
+
+    lock = threading.Lock()
+    work = Queue.Queue()
+    # directory -> number of subdirectories not removed yet, and each directory's parent
+    pending = {}
+    parents = {path: None}
+    state = {'outstanding': 1, 'removed': 0}
+    errors = []
+
+    def fail(e):
+        if getattr(e, 'errno', None) != errno.ENOENT:
+            with lock:
+                errors.append(e)
+            return True
+        return False
+
+    def finish(directory):
+        # everything below the directory is gone, remove it and maybe its parent
+        while directory is not None:
+            try:
+                os.rmdir(directory)
+            except OSError, e:
+                if fail(e):
+                    return
+            with lock:
+                state['removed'] += 1
+                parent = parents.pop(directory)
+                if parent is None:
+                    return
+                pending[parent] -= 1
+                if pending[parent]:
+                    return
+                del pending[parent]
+            directory = parent
+
+    def process(directory):
+        subdirectories = []
+        removed = 0
+        for name in os.listdir(directory):
+            child = os.path.join(directory, name)
+            try:
+                if stat.S_ISDIR(os.lstat(child).st_mode):
+                    subdirectories.append(child)
+                else:
+                    os.unlink(child)
+                    removed += 1
+            except OSError, e:
+                fail(e)
+        with lock:
+            state['removed'] += removed
+            pending[directory] = len(subdirectories)
+            for subdirectory in subdirectories:
+                parents[subdirectory] = directory
+            state['outstanding'] += len(subdirectories)
+        for subdirectory in subdirectories:
+            work.put(subdirectory)
+        if not subdirectories:
+            finish(directory)
+
+    def worker():
+        while True:
+            try:
+                directory = work.get(timeout=0.01)
+            except Queue.Empty:
+                with lock:
+                    if not state['outstanding']:
+                        return
+                continue
+            try:
+                process(directory)
+            except OSError, e:
+                if not fail(e):
+                    # already gone, let its parent go too
+                    finish(directory)
+            finally:
+                with lock:
+                    state['outstanding'] -= 1
+
+    work.put(path)
+    threads = [threading.Thread(target=worker) for i in range(max(1, max_workers))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return state['removed']
@@ -0,0 +1,210 @@
+"""
+Keep the items of a local directory that meet the criteria up to date as
+files come and go, using Linux inotify (through ctypes) where it is
+available and rescanning the directory where it is not.
+"""
+import bisect
+import ctypes
+import ctypes.util
+import datetime
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+
+# entries that are gone after these events, and entries that are new or changed after the others
+REMOVED = IN_DELETE | IN_MOVED_FROM
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """
+    One inotify watch on a directory. Raises OSError if inotify can't be used.
+    """
+    def __init__(self, path, mask=WATCH_MASK):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify needs Linux')
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding())
+        if libc.inotify_add_watch(self.fd, path, mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch failed for <%s>' % path)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read(self, timeout=0):
+        """
+        The (mask, name) of each event, waiting up to `timeout` seconds for the first one
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return events
+                raise
+            position = 0
+            while position < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, position)
+                position += EVENT.size
+                events.append((mask, data[position:position + length].rstrip('\0')))
+                position += length
+
+
+class DirectoryWatch(object):
+    """
+    The items of a directory that meet the criteria, kept up to date by reading inotify events. Use
+    rotatelib.watch_directory() to set one up.
+
+    `evaluate(name)` tests one entry against the criteria that do not move with the clock and returns
+    (passes, date). It is only called for new and changed entries. Relative `before` and `after`
+    cutoffs (timedeltas) are not part of it: the dated entries that pass are kept sorted by date, so
+    the ones past the cutoffs at any moment are found with a binary search.
+
+    Without inotify (not Linux, `use_inotify` off, too many events queued or the directory moved),
+    each update() rescans the directory and only evaluates the names it has not seen.
+    """
+    def __init__(self, directory, evaluate, before=None, after=None, use_inotify=True):
+        self.directory = directory
+        self.evaluate = evaluate
+        self.before = before
+        self.after = after
+        self.stats = {'events': 0, 'evaluated': 0, 'rescans': 0}
+        self.seen = set()
+        self.undated = set()
+        # the dated entries that pass, sorted by date, and the date of each
+        self.dates = []
+        self.names = []
+        self.entries = {}
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify(directory)
+            except (OSError, AttributeError):
+                # not Linux, or a libc without inotify
+                self.inotify = None
+        self.rescan()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def items(self, now=None):
+        """
+        The names of the entries that meet the criteria at `now` (default: the current local time),
+        oldest first
+        """
+        if now is None:
+            now = datetime.datetime.today()
+        low, high = 0, len(self.dates)
+        if self.before is not None:
+            high = bisect.bisect_left(self.dates, now - self.before)
+        if self.after is not None:
+            low = bisect.bisect_right(self.dates, now - self.after)
+        items = self.names[low:high]
+        if self.before is None and self.after is None:
+            items.extend(sorted(self.undated))
+        return items
+
+    def rescan(self):
+        """
+        List the directory and evaluate the entries that appeared since the last listing. Returns the
+        number of entries that appeared or went away.
+        """
+        self.stats['rescans'] += 1
+        names = set(os.listdir(self.directory))
+        removed = self.seen - names
+        added = names - self.seen
+        for name in removed:
+            self._remove(name)
+        for name in added:
+            self._add(name)
+        return len(removed) + len(added)
+
+    def update(self, timeout=0):
+        """
+        Apply the changes to the directory, waiting up to `timeout` seconds for the first one. Returns
+        the number of entries that changed.
+        """
+        if self.inotify is None:
+            if timeout:
+                time.sleep(timeout)
+            return self.rescan()
+
+        events = self.inotify.read(timeout)
+        self.stats['events'] += len(events)
+        changes = {}
+        for mask, name in events:
+            if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                if not mask & IN_Q_OVERFLOW:
+                    # the watch is gone with the directory, rescan from now on
+                    self.close()
+                return self.rescan()
+            # only the last event for each name matters
+            changes[name] = mask
+        for name, mask in changes.items():
+            self._remove(name)
+            if not mask & REMOVED:
+                self._add(name)
+        return len(changes)
+
+    def _add(self, name):
+        self.seen.add(name)
+        self.stats['evaluated'] += 1
+        passes, date = self.evaluate(name)
+        if not passes:
+            return
+        if date is None:
+            self.undated.add(name)
+            return
+        i = bisect.bisect_right(self.dates, date)
+        self.dates.insert(i, date)
+        self.names.insert(i, name)
+        self.entries[name] = date
+
+    def _remove(self, name):
+        self.seen.discard(name)
+        self.undated.discard(name)
+        date = self.entries.pop(name, None)
+        if date is None:
+            return
+        i = bisect.bisect_left(self.dates, date)
+        while self.names[i] != name:
+            i += 1
+        del self.dates[i]
+        del self.names[i]
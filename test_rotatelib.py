@@ -1,13 +1,74 @@
 import unittest
 import rotatelib
+import cgi
 import datetime
+import gzip
+import json
+import os
+import re
+import shutil
 import sqlite3
+import StringIO
+import tempfile
+import time
+import types
+import urlparse
 
 
 class SnapshotMock(object):
-    def __init__(self, description=None, start_time=None):
+    def __init__(self, description=None, start_time=None, id=None, volume_id=None, status='completed', volume_size=None):
         self.description = description
         self.start_time = start_time
+        self.id = id
+        self.volume_id = volume_id
+        self.status = status
+        self.volume_size = volume_size
+
+
+class EC2ErrorMock(Exception):
+    def __init__(self, error_code):
+        super(EC2ErrorMock, self).__init__(error_code)
+        self.error_code = error_code
+
+
+class EC2ResultSetMock(list):
+    next_token = None
+
+
+class EC2ConnectionMock(object):
+    """
+    Stands in for a boto EC2Connection, paging and filtering like the DescribeSnapshots API
+    """
+    def __init__(self, snapshots, errors=None):
+        self.snapshots = snapshots
+        self.errors = errors or {}
+        self.requests = []
+        self.deleted = []
+
+    def build_list_params(self, params, items, label):
+        params['%s.1' % label] = items
+
+    def build_filter_params(self, params, filters):
+        params['Filters'] = filters
+
+    def get_list(self, action, params, markers, verb='GET'):
+        self.requests.append(dict(params))
+        filters = params.get('Filters', {})
+        snapshots = [s for s in self.snapshots
+                     if filters.get('volume-id', s.volume_id) == s.volume_id and filters.get('status', s.status) == s.status]
+        start = int(params.get('NextToken', 0))
+        end = start + params.get('MaxResults', len(snapshots))
+        page = EC2ResultSetMock(snapshots[start:end])
+        if end < len(snapshots):
+            page.next_token = str(end)
+        return page
+
+    def delete_snapshot(self, snapshot_id):
+        errors = self.errors.get(snapshot_id)
+        if errors:
+            raise EC2ErrorMock(errors.pop(0))
+        self.deleted.append(snapshot_id)
+        return True
 
 
 class TestArchiveFunctions(unittest.TestCase):
@@ -296,6 +357,1255 @@ class TestRotationFunctions(unittest.TestCase):
         self.assertTrue('test2014-05-20T013000.sql' in found_items)
 
 
+class TestListingSnapshot(unittest.TestCase):
+    items = ['test.txt', 'test2009-06-15T11.zip', 'test2009-06-20T01.bz2', 'test.zip', 'test2009-05-15T11.zip',
+             'test2009-06-01T02.zip', 'other2009-06-10T11.zip']
+
+    def testSnapshotIsSortedByDate(self):
+        snapshot = rotatelib.list_archives(items=self.items, as_snapshot=True)
+        self.assertTrue(isinstance(snapshot, rotatelib.ListingSnapshot))
+        self.assertEqual(list(snapshot), ['test2009-05-15T11.zip', 'test2009-06-01T02.zip', 'other2009-06-10T11.zip',
+                                          'test2009-06-15T11.zip', 'test2009-06-20T01.bz2'])
+        self.assertEqual(snapshot.before(datetime.datetime(2009, 6, 10, 11)), ['test2009-05-15T11.zip', 'test2009-06-01T02.zip'])
+        self.assertEqual(snapshot.after(datetime.datetime(2009, 6, 15, 11)), ['test2009-06-20T01.bz2'])
+
+    def testSnapshotQueriesMatchListArchives(self):
+        snapshot = rotatelib.list_archives(items=self.items, has_date=False, as_snapshot=True)
+        queries = [
+            {},
+            {'has_date': False},
+            {'before': datetime.datetime(2009, 6, 15)},
+            {'after': datetime.datetime(2009, 6, 1), 'before': datetime.datetime(2009, 6, 20)},
+            {'day': [15, 20]},
+            {'hour': 11, 'before': datetime.datetime(2009, 6, 12)},
+            {'year': 2009, 'except_day': 15},
+            {'startswith': 'test', 'after': datetime.datetime(2009, 6, 1)},
+            {'has_date': False, 'endswith': 'zip'},
+        ]
+        for query in queries:
+            expected = rotatelib.list_archives(items=self.items, **query)
+            found = rotatelib.list_archives(items=snapshot, **query)
+            self.assertEqual(sorted(found), sorted(expected))
+
+    def testListItemsWithSnapshotAndFilters(self):
+        items = ['test2014-05-20T013000.sql', 'test2014-05-20T023000.sql', 'test2014-06-20T013000.sql']
+        snapshot = rotatelib.list_items(items=items, as_snapshot=True)
+        self.assertEqual(rotatelib.list_items(items=snapshot, except_last='day'), ['test2014-05-20T013000.sql'])
+        self.assertEqual(len(rotatelib.list_items(items=snapshot, before=datetime.datetime(2014, 6, 1))), 2)
+
+
+class S3KeyMock(object):
+    def __init__(self, key, size=0, last_modified=None):
+        self.key = key
+        self.size = size
+        self.last_modified = last_modified
+
+
+class S3BucketMock(object):
+    def __init__(self, keys):
+        self.keys = keys
+        self.list_calls = 0
+        self.deleted = []
+
+    def list(self, prefix=''):
+        self.list_calls += 1
+        return [key for key in self.keys if key.key.startswith(prefix)]
+
+    def delete_key(self, key):
+        self.deleted.append(key)
+        self.keys = [k for k in self.keys if k.key != key]
+
+
+class S3ConnectionMock(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    def get_bucket(self, name):
+        return self.buckets[name]
+
+
+class TestListingCache(unittest.TestCase):
+    def tearDown(self):
+        rotatelib.disable_listing_cache()
+
+    def testCacheExpiresAndEvicts(self):
+        cache = rotatelib.ListingCache(ttl=60, max_entries=2)
+        cache.put(('s3', 'a', ''), [1])
+        cache.put(('s3', 'b', ''), [2])
+        self.assertEqual(cache.get(('s3', 'a', '')), [1])
+        cache.put(('s3', 'c', ''), [3])
+        # b was the least recently used
+        self.assertEqual(cache.get(('s3', 'b', '')), None)
+        self.assertEqual(cache.get(('s3', 'c', '')), [3])
+        cache.ttl = -1
+        self.assertEqual(cache.get(('s3', 'a', '')), None)
+
+    def testS3ListingIsSharedAndInvalidated(self):
+        bucket = S3BucketMock([S3KeyMock('logs/test20090601.zip'), S3KeyMock('logs/test20090602.log'),
+                               S3KeyMock('other/test20090603.zip')])
+        s3 = S3ConnectionMock({'mybucket': bucket})
+        cache = rotatelib.enable_listing_cache()
+        archives = rotatelib.list_archives(s3bucket='mybucket', directory='logs/', s3_connection=s3)
+        logs = rotatelib.list_logs(s3bucket='mybucket', directory='logs/', s3_connection=s3)
+        items = rotatelib.list_items(s3bucket='mybucket', directory='logs/', s3_connection=s3, before=datetime.datetime(2010, 1, 1))
+        self.assertEqual((len(archives), len(logs), len(items)), (1, 1, 2))
+        self.assertEqual(bucket.list_calls, 1)
+        rotatelib.list_archives(s3bucket='mybucket', directory='other/', s3_connection=s3)
+        self.assertEqual(bucket.list_calls, 2)
+
+        rotatelib.remove_items(items=archives, s3bucket='mybucket', s3_connection=s3)
+        self.assertEqual(len(cache), 0)
+        archives = rotatelib.list_archives(s3bucket='mybucket', directory='logs/', s3_connection=s3)
+        self.assertEqual(archives, [])
+        self.assertEqual(bucket.list_calls, 3)
+
+    def testCacheIsOptIn(self):
+        bucket = S3BucketMock([S3KeyMock('test20090601.zip')])
+        s3 = S3ConnectionMock({'mybucket': bucket})
+        rotatelib.list_archives(s3bucket='mybucket', s3_connection=s3)
+        rotatelib.list_archives(s3bucket='mybucket', s3_connection=s3)
+        self.assertEqual(bucket.list_calls, 2)
+
+
+class SlowS3BucketMock(S3BucketMock):
+    def list(self, prefix=''):
+        time.sleep(0.2)
+        return super(SlowS3BucketMock, self).list(prefix)
+
+
+class TestListSources(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ['test20090601.zip', 'test20090602.log', 'test.zip']:
+            open(os.path.join(self.directory, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testMergesSourcesOfEveryKind(self):
+        s3 = S3ConnectionMock({'tenant': S3BucketMock([S3KeyMock('db/test20090603.zip'), S3KeyMock('db/test20090604.zip')])})
+        db = sqlite3.connect(':memory:', check_same_thread=False)
+        db.cursor().execute('CREATE TABLE tableA20090922 (value VARCHAR(50))')
+        sources = [
+            {'directory': self.directory},
+            {'directory': self.directory, 'kind': 'logs'},
+            {'s3bucket': 'tenant', 'directory': 'db/', 's3_connection': s3, 'before': datetime.datetime(2009, 6, 4)},
+            {'db': db, 'kind': 'backup_tables'},
+        ]
+        found = list(rotatelib.list_sources(sources, before=datetime.datetime(2010, 1, 1)))
+        self.assertEqual(len(found), 4)
+        found = dict((rotatelib._item_name(item), source) for source, item in found)
+        self.assertEqual(found['test20090601.zip'], sources[0])
+        self.assertEqual(found['test20090602.log'], sources[1])
+        self.assertEqual(found['db/test20090603.zip'], sources[2])
+        self.assertEqual(found['tableA20090922'], sources[3])
+
+    def testSourcesAreListedConcurrently(self):
+        buckets = dict(('tenant%d' % i, SlowS3BucketMock([S3KeyMock('test2009060%d.zip' % i)])) for i in range(1, 7))
+        s3 = S3ConnectionMock(buckets)
+        sources = [{'s3bucket': name, 's3_connection': s3} for name in sorted(buckets)]
+        start = time.time()
+        found = list(rotatelib.list_sources(sources, max_workers=6))
+        self.assertEqual(len(found), 6)
+        self.assertTrue(time.time() - start < 0.8)
+
+    def testFailedSourcesAreReported(self):
+        sources = [{'directory': self.directory}, {'directory': os.path.join(self.directory, 'missing')}]
+        found = []
+        try:
+            for source, item in rotatelib.list_sources(sources):
+                found.append(item)
+            self.fail('ListingError was not raised')
+        except rotatelib.ListingError, e:
+            self.assertEqual([source for source, error in e.failures], [sources[1]])
+        self.assertEqual(found, ['test20090601.zip'])
+
+    def testSourcesFromAGenerator(self):
+        directories = [self.directory, os.path.join(self.directory, 'missing')]
+        try:
+            list(rotatelib.list_sources({'directory': directory} for directory in directories))
+            self.fail('ListingError was not raised')
+        except rotatelib.ListingError, e:
+            self.assertEqual([source for source, error in e.failures], [{'directory': directories[1]}])
+
+    def testBadSourcesFailBeforeListing(self):
+        bucket = S3BucketMock([S3KeyMock('test20090603.zip')])
+        s3 = S3ConnectionMock({'tenant': bucket})
+        for bad in [{'kind': 'backup_tables'}, {'s3bucket': 'tenant', 'ec2snapshots': True}, {'directory': self.directory, 'date_source': 'ctime'},
+                    {'kind': 'tables'}]:
+            self.assertRaises(Exception, list, rotatelib.list_sources([{'s3bucket': 'tenant', 's3_connection': s3}, bad]))
+        self.assertEqual(bucket.list_calls, 0)
+
+    def testSlowSourcesTimeOut(self):
+        s3 = S3ConnectionMock({'slow': SlowS3BucketMock([S3KeyMock('test20090603.zip')])})
+        sources = [{'directory': self.directory}, {'s3bucket': 'slow', 's3_connection': s3}]
+        start = time.time()
+        try:
+            list(rotatelib.list_sources(sources, timeout=0.05))
+            self.fail('ListingError was not raised')
+        except rotatelib.ListingError, e:
+            self.assertEqual([source for source, error in e.failures], [sources[1]])
+        self.assertTrue(time.time() - start < 0.15)
+
+
+class TestPartitionWorkers(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def stores(self):
+        return [rotatelib.SQLiteLeaseStore(os.path.join(self.directory, 'leases.db')),
+                rotatelib.DirectoryLeaseStore(os.path.join(self.directory, 'leases'))]
+
+    def testWorkersSplitTheKeyspace(self):
+        items = ['test200906%02d.zip' % day for day in range(1, 31)]
+        for store in self.stores():
+            workers = [rotatelib.PartitionWorker(store, partitions=2) for i in range(3)]
+            self.assertEqual([w.acquire() for w in workers], [[0], [1], []])
+            found = [rotatelib.list_archives(items=items, partition=w) for w in workers]
+            self.assertEqual(len(found[0]) + len(found[1]), 30)
+            self.assertFalse(set(found[0]) & set(found[1]))
+            self.assertEqual(found[2], [])
+
+    def testExpiredLeaseIsTakenOver(self):
+        for store in self.stores():
+            dead = rotatelib.PartitionWorker(store, partitions=2, ttl=0.05)
+            alive = rotatelib.PartitionWorker(store, partitions=2, ttl=60)
+            self.assertEqual(dead.acquire(limit=None), [0, 1])
+            self.assertEqual(alive.acquire(), [])
+            time.sleep(0.1)
+            self.assertEqual(alive.acquire(limit=None), [0, 1])
+            self.assertEqual(dead.renew(), [])
+
+    def testLeasesAreRenewedDuringListing(self):
+        class SlowBucket(S3BucketMock):
+            def list(self, prefix=''):
+                for key in S3BucketMock.list(self, prefix):
+                    time.sleep(0.05)
+                    yield key
+
+        bucket = SlowBucket([S3KeyMock('test200906%02d.zip' % day) for day in range(1, 11)])
+        s3 = S3ConnectionMock({'mybucket': bucket})
+        for store in self.stores():
+            worker = rotatelib.PartitionWorker(store, partitions=1, ttl=0.15)
+            other = rotatelib.PartitionWorker(store, partitions=1, ttl=60)
+            self.assertEqual(worker.acquire(), [0])
+            archives = rotatelib.list_archives(s3bucket='mybucket', s3_connection=s3, partition=worker)
+            self.assertEqual(len(archives), 10)
+            self.assertEqual(other.acquire(), [])
+            worker.release()
+
+    def testPrefixPartitionsOnlyListOwnedPrefixes(self):
+        bucket = S3BucketMock([S3KeyMock('a/test20090601.zip'), S3KeyMock('b/test20090602.zip'), S3KeyMock('c/test20090603.zip')])
+        s3 = S3ConnectionMock({'mybucket': bucket})
+        store = self.stores()[0]
+        worker = rotatelib.PartitionWorker(store, prefixes=['a/', 'b/', 'c/'])
+        rotatelib.PartitionWorker(store, prefixes=['a/', 'b/', 'c/']).acquire()
+        self.assertEqual(worker.acquire(limit=2), [1, 2])
+        archives = rotatelib.list_archives(s3bucket='mybucket', s3_connection=s3, partition=worker)
+        self.assertEqual([a.key for a in archives], ['b/test20090602.zip', 'c/test20090603.zip'])
+        self.assertEqual(bucket.list_calls, 2)
+
+        rotatelib.remove_items(items=['a/test20090601.zip', 'b/test20090602.zip'], s3bucket='mybucket',
+                               s3_connection=s3, partition=worker)
+        self.assertEqual(bucket.deleted, ['b/test20090602.zip'])
+
+
+class TestDeletionJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.names = ['test200906%02d.zip' % day for day in range(1, 11)]
+        for name in self.names:
+            open(os.path.join(self.directory, name), 'w').close()
+        self.journal = os.path.join(self.directory, 'removal.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testInterruptedRunIsResumed(self):
+        # what a run killed after removing four items leaves behind
+        journal = rotatelib.DeletionJournal(self.journal, checkpoint_every=2)
+        journal.plan({'directory': self.directory, 's3bucket': None, 'ec2snapshots': False, 'db': False}, self.names)
+        for name in self.names[:5]:
+            os.remove(os.path.join(self.directory, name))
+            journal.done(name)
+        with open(self.journal, 'a') as f:
+            f.write('{"op": "do')
+
+        source, pending = rotatelib.DeletionJournal(self.journal).pending()
+        self.assertEqual(source['directory'], self.directory)
+        self.assertEqual(pending, self.names[4:])
+
+        self.assertEqual(rotatelib.resume_removal(self.journal), 6)
+        self.assertEqual(os.listdir(self.directory), ['removal.journal'])
+        self.assertEqual(rotatelib.DeletionJournal(self.journal).pending(), (None, []))
+        self.assertEqual(rotatelib.resume_removal(self.journal), 0)
+        with open(self.journal) as f:
+            self.assertEqual(f.read().splitlines()[-1], '{"op": "finish"}')
+
+    def testFailedItemsArePending(self):
+        os.remove(os.path.join(self.directory, self.names[0]))
+        os.mkdir(os.path.join(self.directory, self.names[0]))
+        self.assertRaises(rotatelib.RemovalError, rotatelib.remove_items, directory=self.directory,
+                          items=self.names, journal=self.journal)
+        self.assertEqual(rotatelib.DeletionJournal(self.journal).pending()[1], self.names[:1])
+
+    def testDatabaseRunIsResumed(self):
+        db = sqlite3.connect(':memory:')
+        for table in ['tableA20090922', 'tableB20090922']:
+            db.cursor().execute('CREATE TABLE %s (value VARCHAR(50))' % table)
+        journal = rotatelib.DeletionJournal(self.journal)
+        journal.plan({'directory': './', 's3bucket': None, 'ec2snapshots': False, 'db': True}, ['tableA20090922', 'tableB20090922'])
+        db.cursor().execute('DROP TABLE tableA20090922')
+        self.assertRaises(Exception, rotatelib.resume_removal, self.journal)
+        self.assertEqual(rotatelib.resume_removal(self.journal, db=db), 2)
+        self.assertEqual(db.cursor().execute("SELECT * FROM sqlite_master WHERE type='table'").fetchall(), [])
+
+
+class TestPipelinedRotation(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for day in range(1, 31):
+            for name in ['test200906%02d.zip' % day, 'test200906%02d.log' % day]:
+                open(os.path.join(self.directory, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testRotateRemovesMatchingItems(self):
+        stats = rotatelib.rotate(directory=self.directory, before=datetime.datetime(2009, 6, 11), page_size=7, batch_size=3)
+        self.assertEqual(stats, {'listed': 60, 'matched': 10, 'removed': 10})
+        self.assertEqual(len(os.listdir(self.directory)), 50)
+        stats = rotatelib.rotate(directory=self.directory, kind='logs', day=[20, 21])
+        self.assertEqual(stats['removed'], 2)
+        self.assertRaises(Exception, rotatelib.rotate, directory=self.directory, except_first='day')
+
+    def testRotateItemsByMtime(self):
+        for name, mtime in [('a1b2c3', 1245065400), ('d4e5f6', time.time())]:
+            open(os.path.join(self.directory, name), 'w').close()
+            os.utime(os.path.join(self.directory, name), (mtime, mtime))
+        stats = rotatelib.rotate(directory=self.directory, kind='items', date_source='mtime', startswith='a1',
+                                 before=datetime.timedelta(30))
+        self.assertEqual(stats['removed'], 1)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'a1b2c3')))
+
+    def testStagesOverlap(self):
+        def source():
+            for i in range(5):
+                time.sleep(0.1)
+                yield i
+
+        def slow(items):
+            for item in items:
+                time.sleep(0.1)
+                yield item * 2
+
+        start = time.time()
+        self.assertEqual(rotatelib.run_pipeline(source(), [slow, slow], queue_size=1), [0, 4, 8, 12, 16])
+        self.assertTrue(time.time() - start < 1.2)
+
+    def testFailuresStopThePipeline(self):
+        def broken(items):
+            for item in items:
+                if item == 3:
+                    raise ValueError('broken')
+                yield item
+
+        def passthrough(items):
+            for item in items:
+                yield item
+
+        self.assertRaises(ValueError, rotatelib.run_pipeline, iter(range(10)), [broken, passthrough])
+        self.assertRaises(ValueError, rotatelib.run_pipeline, iter(range(10)), [passthrough, broken])
+
+
+class TestInventorySource(unittest.TestCase):
+    rows = [
+        '"mybucket","db/backup20090601.sql.gz","100","2009-06-01T03:00:00.000Z","abc","STANDARD"',
+        '"mybucket","db/backup20090615.sql.gz","200","2009-06-15T03:00:00.000Z","def","STANDARD"',
+        '"mybucket","db/my+backup20090620.sql.gz","300","2009-06-20T03:00:00.000Z","ghi","STANDARD"',
+        '"mybucket","logs/app20090601.log","50","2009-06-01T03:00:00.000Z","jkl","STANDARD"',
+        '"otherbucket","db/backup20090602.sql.gz","400","2009-06-02T03:00:00.000Z","mno","STANDARD"',
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'data'))
+        f = gzip.open(os.path.join(self.directory, 'data', 'part1.csv.gz'), 'wb')
+        f.write('\n'.join(self.rows[:3]) + '\n')
+        f.close()
+        with open(os.path.join(self.directory, 'data', 'part2.csv'), 'w') as f:
+            f.write('\n'.join(self.rows[3:]) + '\n')
+        with open(os.path.join(self.directory, 'manifest.json'), 'w') as f:
+            json.dump({
+                'sourceBucket': 'mybucket',
+                'fileFormat': 'CSV',
+                'fileSchema': 'Bucket, Key, Size, LastModifiedDate, ETag, StorageClass',
+                'files': [{'key': 'mybucket/config/data/part1.csv.gz'}, {'key': 'mybucket/config/data/part2.csv'}],
+            }, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testListArchivesFromManifest(self):
+        manifest = os.path.join(self.directory, 'manifest.json')
+        archives = list(rotatelib.list_archives(s3bucket='mybucket', inventory=manifest, before=datetime.datetime(2009, 6, 16)))
+        self.assertEqual([a.key for a in archives], ['db/backup20090601.sql.gz', 'db/backup20090615.sql.gz'])
+        self.assertEqual([a.size for a in archives], [100, 200])
+        archives = rotatelib.list_archives(s3bucket='mybucket', directory='db/my ', inventory=manifest)
+        self.assertEqual([a.key for a in archives], ['db/my backup20090620.sql.gz'])
+        logs = rotatelib.list_logs(inventory=manifest)
+        self.assertEqual([a.key for a in logs], ['logs/app20090601.log'])
+
+    def testListArchivesFromDataFiles(self):
+        files = [os.path.join(self.directory, 'data', name) for name in ['part1.csv.gz', 'part2.csv']]
+        archives = rotatelib.list_archives(inventory=files, inventory_schema=['Bucket', 'Key', 'Size', 'LastModifiedDate',
+                                                                              'ETag', 'StorageClass'])
+        self.assertEqual(len(list(archives)), 4)
+        archives = rotatelib.list_archives(inventory=files[1])
+        self.assertEqual([a.key for a in archives], ['db/backup20090602.sql.gz'])
+
+
+class TestListingFileSource(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.names = ['test200906%02d.%s' % (day, extension) for day in range(1, 31) for extension in ['zip', 'log']]
+        self.listing = os.path.join(self.directory, 'listing.txt')
+        with open(self.listing, 'w') as f:
+            f.write('\r\n'.join(self.names + ['undated.zip']))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testNamesAreStreamedAcrossBlocks(self):
+        names = list(rotatelib.iter_listing_file(self.listing, block_size=7))
+        self.assertEqual(names, self.names + ['undated.zip'])
+        self.assertEqual(list(rotatelib.iter_listing_file(self.listing, prefix='test2009061')), self.names[18:38])
+
+    def testListFunctionsReturnGenerators(self):
+        archives = rotatelib.list_archives(listing_file=self.listing, before=datetime.datetime(2009, 6, 11))
+        self.assertTrue(isinstance(archives, types.GeneratorType))
+        self.assertEqual(list(archives), ['test200906%02d.zip' % day for day in range(1, 11)])
+        logs = rotatelib.list_logs(listing_file=self.listing, day=1)
+        self.assertEqual(list(logs), ['test20090601.log'])
+        items = rotatelib.list_items(listing_file=self.listing, after=datetime.datetime(2009, 6, 29))
+        self.assertEqual([item['item'] for item in items], ['test20090630.zip', 'test20090630.log'])
+        items = rotatelib.list_items(listing_file=self.listing, except_last='month')
+        self.assertEqual(len(items), 59)
+
+
+class TestFleetScan(unittest.TestCase):
+    def server(self, tables):
+        """
+        A sqlite database that looks enough like MySQL's information_schema
+        """
+        def connect():
+            db = sqlite3.connect(':memory:', check_same_thread=False)
+            db.create_function('regexp', 2, lambda pattern, value: re.search(pattern, value) is not None)
+            db.execute("ATTACH ':memory:' AS information_schema")
+            db.execute('CREATE TABLE information_schema.tables (table_schema, table_name, table_type)')
+            db.executemany("INSERT INTO information_schema.tables VALUES (?, ?, 'BASE TABLE')", tables)
+            connections.append(db)
+            return db
+        connections = []
+        return connect, connections
+
+    def testScansEverySchemaOnEveryServer(self):
+        connect1, connections1 = self.server([('tenant1', 'orders'), ('tenant1', 'orders20090601'), ('tenant2', 'orders20090602'),
+                                              ('mysql', 'user20090601'), ('tenant2', 'orders20301231')])
+        connect2, connections2 = self.server([('tenant3', 'users2009-06-03'), ('tenant3', 'users')])
+        servers = [rotatelib.ConnectionPool(connect1, name='db1', paramstyle='qmark'),
+                   rotatelib.ConnectionPool(connect2, name='db2', paramstyle='qmark')]
+        tables = rotatelib.scan_backup_tables(servers, before=datetime.datetime(2010, 1, 1))
+        self.assertEqual(sorted(tables), [('db1', 'tenant1', 'orders20090601'), ('db1', 'tenant2', 'orders20090602'),
+                                          ('db2', 'tenant3', 'users2009-06-03')])
+        self.assertEqual(str(sorted(tables)[0]), 'tenant1.orders20090601')
+        self.assertEqual((len(connections1), len(connections2)), (1, 1))
+
+        tables = rotatelib.scan_backup_tables(servers, schemas=['tenant2'])
+        self.assertEqual(sorted(tables), [('db1', 'tenant2', 'orders20090602'), ('db1', 'tenant2', 'orders20301231')])
+        self.assertEqual(len(connections1), 1)
+
+    def testPoolReusesConnections(self):
+        opened = []
+        pool = rotatelib.ConnectionPool(lambda: opened.append(1) or sqlite3.connect(':memory:'), size=2)
+        first = pool.get()
+        second = pool.get()
+        pool.put(first)
+        self.assertTrue(pool.get() is first)
+        self.assertEqual(len(opened), 2)
+
+
+class TestCriteriaPlan(unittest.TestCase):
+    def testNameCriteriaRunBeforeParsing(self):
+        parsed = []
+
+        def parse(filename, item):
+            parsed.append(filename)
+            return rotatelib.parse_name(filename)
+
+        plan = rotatelib.criteria.CriteriaPlan(rotatelib.get_criteria(), {'has_date': True, 'startswith': 'db-',
+                                               'except_endswith': '.log', 'before': datetime.datetime(2010, 1, 1)}, parse)
+        self.assertEqual([step.name for step in plan.name_steps], ['startswith', 'except_endswith'])
+        self.assertFalse(plan.matches('web-2009-06-15T11.zip'))
+        self.assertFalse(plan.matches('db-2009-06-15T11.log'))
+        self.assertTrue(plan.matches('db-2009-06-15T11.zip'))
+        self.assertFalse(plan.matches('db-2012-06-15T11.zip'))
+        self.assertEqual(parsed, ['db-2009-06-15T11.zip', 'db-2012-06-15T11.zip'])
+
+    def testReorderByRejections(self):
+        plan = rotatelib.criteria.CriteriaPlan(rotatelib.get_criteria(), {'has_date': True, 'year': 2009, 'hour': [11]},
+                                               rotatelib.parse_name, reorder_every=10)
+        self.assertEqual(plan.parsed_steps[0].name, 'has_date')
+        for day in range(1, 21):
+            plan.matches('test2012-06-%02dT11.zip' % day)
+        self.assertEqual(plan.parsed_steps[0].name, 'year')
+        self.assertTrue(plan.matches('test2009-06-15T11.zip'))
+        self.assertFalse(plan.matches('test2009-06-15T12.zip'))
+
+    def testSameResults(self):
+        items = ['test.txt', 'test2009-06-15T11.zip', 'test2009-06-20T01.bz2', 'other2009-06-10T11.zip', 'test.zip']
+        self.assertEqual(rotatelib.list_archives(items=items, startswith='test', before=datetime.datetime(2009, 6, 16)),
+                         ['test2009-06-15T11.zip'])
+        self.assertEqual(rotatelib.list_archives(items=items, except_startswith='test', has_date=False),
+                         ['other2009-06-10T11.zip'])
+
+
+class TestParsedName(unittest.TestCase):
+    def testDateIsFoundOnce(self):
+        calls = []
+
+        def find_date():
+            calls.append(1)
+            return datetime.datetime(2009, 6, 15)
+
+        parsed = rotatelib.ParsedName('test20090615.zip', find_date)
+        self.assertEqual(calls, [])
+        self.assertTrue('date' in parsed)
+        self.assertEqual(parsed['name'], 'test20090615.zip')
+        self.assertEqual(calls, [])
+        self.assertEqual(parsed['date'], datetime.datetime(2009, 6, 15))
+        self.assertEqual(parsed.get('date'), datetime.datetime(2009, 6, 15))
+        self.assertEqual(calls, [1])
+        self.assertEqual(parsed, {'name': 'test20090615.zip', 'date': datetime.datetime(2009, 6, 15)})
+
+    def testNameCriteriaDoNotParseDates(self):
+        parsed = rotatelib.parse_name('test2009-06-15T11.zip')
+        for name, argument in [('startswith', 'test'), ('except_endswith', '.log'), ('pattern', '^test'), ('has_date', False)]:
+            this_criteria = rotatelib.get_criteria()[name]()
+            this_criteria.set_argument(argument)
+            self.assertTrue(this_criteria.test('test2009-06-15T11.zip', parsed))
+        self.assertFalse(dict.__contains__(parsed, 'date'))
+        self.assertEqual(sorted(parsed.keys()), ['date', 'name'])
+        self.assertEqual(parsed['date'], datetime.datetime(2009, 6, 15, 11, 0))
+
+
+class TestDateSource(unittest.TestCase):
+    def testParseTimestamp(self):
+        self.assertEqual(rotatelib.parse_timestamp('2009-06-15T11:30:05.000Z'), datetime.datetime(2009, 6, 15, 11, 30, 5))
+        self.assertEqual(rotatelib.parse_timestamp('Mon, 15 Jun 2009 11:30:05 GMT'), datetime.datetime(2009, 6, 15, 11, 30, 5))
+        self.assertEqual(rotatelib.parse_timestamp(0), datetime.datetime(1970, 1, 1))
+        self.assertEqual(rotatelib.parse_timestamp('not a date'), None)
+
+    def testS3LastModified(self):
+        bucket = S3BucketMock([S3KeyMock('backups/a1b2c3.zip', last_modified='2009-06-15T11:30:00.000Z'),
+                               S3KeyMock('backups/d4e5f6.zip', last_modified='2012-06-15T11:30:00.000Z'),
+                               S3KeyMock('backups/db-20120615.zip', last_modified='2009-06-15T11:30:00.000Z')])
+        s3 = S3ConnectionMock({'mybucket': bucket})
+        before = datetime.datetime(2010, 1, 1)
+        self.assertEqual([key.key for key in rotatelib.list_archives(s3bucket='mybucket', directory='backups/', s3_connection=s3, before=before)],
+                         [])
+        archives = rotatelib.list_archives(s3bucket='mybucket', directory='backups/', s3_connection=s3, before=before, date_source='timestamp')
+        self.assertEqual([key.key for key in archives], ['backups/a1b2c3.zip', 'backups/db-20120615.zip'])
+        items = rotatelib.list_items(s3bucket='mybucket', directory='backups/', s3_connection=s3, before=before, date_source='timestamp')
+        self.assertEqual([item['item'].key for item in items], ['backups/a1b2c3.zip', 'backups/db-20120615.zip'])
+
+    def testTimestampsAreLocal(self):
+        zone = os.environ.get('TZ')
+        os.environ['TZ'] = 'EST+05'
+        time.tzset()
+        try:
+            snapshots = [SnapshotMock('nightly', '2009-06-15T03:30:00.000Z')]
+            archives = rotatelib.list_archives(items=snapshots, ec2snapshots=True, day=14, date_source='timestamp')
+            self.assertEqual(archives, snapshots)
+        finally:
+            if zone is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = zone
+            time.tzset()
+
+    def testSnapshotStartTime(self):
+        snapshots = [SnapshotMock('nightly', '2009-06-15T11:30:00.000Z'), SnapshotMock('nightly', '2012-06-15T11:30:00.000Z')]
+        archives = rotatelib.list_archives(items=snapshots, ec2snapshots=True, before=datetime.datetime(2010, 1, 1), date_source='timestamp')
+        self.assertEqual(archives, snapshots[:1])
+
+    def testFileMtime(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for name, mtime in [('old.zip', 1245065400), ('new.zip', time.time())]:
+                open(os.path.join(directory, name), 'w').close()
+                os.utime(os.path.join(directory, name), (mtime, mtime))
+            self.assertEqual(rotatelib.list_archives(directory=directory, before=datetime.timedelta(30), date_source='mtime'), ['old.zip'])
+            self.assertEqual(sorted(rotatelib.list_archives(directory=directory, has_date=True, date_source='mtime')), ['new.zip', 'old.zip'])
+            self.assertRaises(Exception, rotatelib.list_archives, directory=directory, date_source='ctime')
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestTraceSink(unittest.TestCase):
+    items = ['test.txt', 'test2009-06-15T11.zip', 'test2009-06-20T01.bz2', 'other2009-06-10T11.zip']
+
+    def testRecordsEachCriteria(self):
+        sink = rotatelib.TraceSink()
+        archives = rotatelib.list_archives(items=self.items, before=datetime.datetime(2009, 6, 16), startswith='test', trace=sink)
+        self.assertEqual(archives, ['test2009-06-15T11.zip'])
+        records = dict((record['name'], record) for record in sink.records)
+        self.assertEqual(sorted(records), ['other2009-06-10T11.zip', 'test2009-06-15T11.zip', 'test2009-06-20T01.bz2'])
+        self.assertEqual(records['other2009-06-10T11.zip']['failed'], 'startswith')
+        self.assertEqual(records['test2009-06-20T01.bz2']['failed'], 'before')
+        self.assertEqual(records['test2009-06-20T01.bz2']['date'], datetime.datetime(2009, 6, 20, 1, 0))
+        passed = records['test2009-06-15T11.zip']
+        self.assertTrue(passed['passed'])
+        self.assertEqual(passed['failed'], None)
+        self.assertEqual(sorted(c[0] for c in passed['criteria']), ['before', 'has_date', 'startswith'])
+
+    def testPatternAndSampling(self):
+        sink = rotatelib.TraceSink(pattern=r'^other')
+        rotatelib.list_archives(items=self.items, trace=sink)
+        self.assertEqual([record['name'] for record in sink.records], ['other2009-06-10T11.zip'])
+        sink = rotatelib.TraceSink(sample_rate=0)
+        rotatelib.list_archives(items=self.items, trace=sink)
+        self.assertEqual(sink.records, [])
+
+    def testSampleRate(self):
+        items = ['test2009-06-%02dT%02d%02d.zip' % (day, hour, minute) for day in range(1, 29) for hour in range(24) for minute in range(0, 60, 10)]
+        sink = rotatelib.TraceSink(sample_rate=0.5)
+        rotatelib.trace.random.seed(1)
+        rotatelib.list_archives(items=items, before=datetime.datetime(2009, 6, 16), trace=sink)
+        fraction = float(len(sink.records)) / len(items)
+        self.assertTrue(0.45 < fraction < 0.55, fraction)
+
+
+class TestSimulatedBackends(unittest.TestCase):
+    start = datetime.datetime(2009, 6, 30)
+
+    def testS3ListsInPages(self):
+        s3 = rotatelib.SimulatedS3Connection(page_size=100)
+        bucket = s3.create_bucket('mybucket').fill(1000, prefix='backups/db-', start=self.start)
+        bucket.add_key('other/file.zip')
+        archives = rotatelib.list_archives(s3bucket='mybucket', directory='backups/', s3_connection=s3,
+                                           before=datetime.datetime(2009, 6, 20))
+        self.assertEqual(len(archives), 1000 - 10 * 24 - 1)
+        self.assertEqual(s3.stats['list'], 10)
+        self.assertRaises(rotatelib.simulated.SimulatedError, s3.get_bucket, 'missing')
+
+    def testS3ThrottledRemovalsAreRetried(self):
+        s3 = rotatelib.SimulatedS3Connection(latency=0.001, throttle_rate=0.3, seed=1)
+        bucket = s3.create_bucket('mybucket').fill(200, start=self.start)
+        items = rotatelib.list_archives(s3bucket='mybucket', s3_connection=s3)
+        executor = rotatelib.RemovalExecutor(max_workers=8, initial_workers=8, backoff_base=0.001, backoff_cap=0.01, retries=20)
+        rotatelib.remove_items(items=items, s3bucket='mybucket', s3_connection=s3, executor=executor)
+        self.assertEqual(len(bucket), 0)
+        self.assertTrue(s3.stats['throttled'] > 0)
+        self.assertEqual(executor.stats['removed'], 200)
+
+    def testEC2FiltersPagesAndDeletes(self):
+        ec2 = rotatelib.SimulatedEC2Connection(page_size=50, throttle_rate=0.2, seed=1)
+        ec2.fill(200, start=self.start)
+        ec2.fill(100, volume_id='vol-00000002', start=self.start)
+        archives = rotatelib.list_archives(ec2snapshots=True, ec2_connection=ec2, snapshot_volume='vol-00000002',
+                                           snapshot_page_size=1000, before=datetime.datetime(2009, 6, 29))
+        self.assertEqual(len(archives), 100 - 25)
+        self.assertEqual([snapshot.volume_id for snapshot in archives if snapshot.volume_id != 'vol-00000002'], [])
+        executor = rotatelib.RemovalExecutor(backoff_base=0.001, backoff_cap=0.01, retries=20)
+        rotatelib.remove_items(items=archives, ec2snapshots=True, ec2_connection=ec2, executor=executor)
+        self.assertEqual(len(ec2), 300 - 75)
+        # already gone
+        rotatelib.remove_items(items=[archives[0].id], ec2snapshots=True, ec2_connection=ec2, executor=executor)
+
+    def testEmptySimulatorsAreUsed(self):
+        ec2 = rotatelib.SimulatedEC2Connection()
+        ec2.fill(1, start=self.start)
+        archives = rotatelib.list_archives(ec2snapshots=True, ec2_connection=ec2)
+        rotatelib.remove_items(items=archives, ec2snapshots=True, ec2_connection=ec2)
+        self.assertEqual(len(ec2), 0)
+        # neither call may fall back to connecting to AWS
+        self.assertEqual(rotatelib.list_archives(ec2snapshots=True, ec2_connection=ec2), [])
+        rotatelib.remove_items(items=archives, ec2snapshots=True, ec2_connection=ec2)
+        s3 = rotatelib.SimulatedS3Connection()
+        s3.create_bucket('mybucket')
+        self.assertEqual(rotatelib.list_archives(s3bucket='mybucket', s3_connection=s3), [])
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.bucket = S3BucketMock([S3KeyMock(name) for name in ['test.log', 'test2009-06-01.log', 'test2009-06-20.log',
+                                                                 'test2009-06-01.zip', 'test2009-06-02.zip', 'test2009-07-01.zip',
+                                                                 'tmp2009-06-01.txt', 'tmp2009-06-25.txt']])
+        self.s3 = S3ConnectionMock({'mybucket': self.bucket})
+
+    def testPoliciesShareOneListing(self):
+        policies = [
+            {'kind': 'logs', 'before': datetime.datetime(2009, 6, 10)},
+            {'before': datetime.datetime(2009, 7, 10), 'except_first': 'month'},
+            {'kind': 'items', 'startswith': 'tmp', 'before': datetime.datetime(2009, 6, 10)},
+        ]
+        results = rotatelib.plan({'s3bucket': 'mybucket', 's3_connection': self.s3}, policies)
+        self.assertEqual(self.bucket.list_calls, 1)
+        self.assertEqual([[key.key for key in result] for result in results], [
+            ['test2009-06-01.log'],
+            ['test2009-06-02.zip'],
+            ['tmp2009-06-01.txt'],
+        ])
+        self.assertEqual([key.key for key in results[1]],
+                         [key.key for key in rotatelib.list_items(s3bucket='mybucket', s3_connection=self.s3, endswith='.zip',
+                                                                  before=datetime.datetime(2009, 7, 10), except_first='month')])
+
+    def testUnknownKind(self):
+        self.assertRaises(Exception, rotatelib.plan, {'items': ['test.zip']}, [{'kind': 'tables'}])
+
+
+class MySQLMock(object):
+    """
+    Stands in for a MySQLdb connection, answering the status queries used by DropPacer
+    """
+    def __init__(self, threads_running=None, lag=None, lock_waits=None):
+        self.threads_running = threads_running or [1]
+        self.lag = lag or []
+        # tables whose first DROP times out waiting for a lock
+        self.lock_waits = lock_waits or []
+        self.executed = []
+
+    def cursor(self):
+        return MySQLCursorMock(self)
+
+
+class MySQLCursorMock(object):
+    def __init__(self, db):
+        self.db = db
+        self.row = None
+        self.description = None
+
+    def execute(self, sql):
+        self.db.executed.append(sql)
+        if sql.startswith('DROP TABLE ') and sql[11:] in self.db.lock_waits:
+            self.db.lock_waits.remove(sql[11:])
+            raise Exception(1205, 'Lock wait timeout exceeded; try restarting transaction')
+        if sql == 'SELECT @@SESSION.lock_wait_timeout':
+            self.row = (50,)
+        elif sql.startswith('SHOW GLOBAL STATUS'):
+            value = self.db.threads_running.pop(0) if len(self.db.threads_running) > 1 else self.db.threads_running[0]
+            self.row = ('Threads_running', str(value))
+        elif sql == 'SHOW SLAVE STATUS':
+            self.description = [('Slave_IO_State',), ('Seconds_Behind_Master',)]
+            self.row = ('Waiting for master to send event', self.db.lag.pop(0) if len(self.db.lag) > 1 else self.db.lag[0])
+
+    def fetchone(self):
+        return self.row
+
+
+class TestDropPacer(unittest.TestCase):
+    def testBatchesAndLockWaitTimeout(self):
+        db = MySQLMock()
+        pacer = rotatelib.DropPacer(lock_wait_timeout=2, batch_size=2, pause=0.01)
+        rotatelib.remove_items(db=db, items=['t20090601', 't20090602', 't20090603'], pacer=pacer)
+        self.assertEqual(db.executed, ['SELECT @@SESSION.lock_wait_timeout', 'SET SESSION lock_wait_timeout = 2',
+                                       'DROP TABLE t20090601', 'DROP TABLE t20090602', 'DROP TABLE t20090603',
+                                       'SET SESSION lock_wait_timeout = 50'])
+        self.assertEqual(pacer.stats['batches'], 2)
+
+    def testRetriedDropIsPacedOnce(self):
+        db = MySQLMock(lock_waits=['t20090602'])
+        pacer = rotatelib.DropPacer(batch_size=2, pause=0, max_threads_running=50)
+        executor = rotatelib.RemovalExecutor(backoff_base=0.001)
+        rotatelib.remove_items(db=db, items=['t20090601', 't20090602', 't20090603'], pacer=pacer, executor=executor)
+        self.assertEqual([sql for sql in db.executed if sql.startswith('DROP')],
+                         ['DROP TABLE t20090601', 'DROP TABLE t20090602', 'DROP TABLE t20090602', 'DROP TABLE t20090603'])
+        self.assertEqual(pacer.stats['batches'], 2)
+        self.assertEqual(pacer.dropped, 3)
+        # one status check per batch
+        self.assertEqual(len([sql for sql in db.executed if sql.startswith('SHOW GLOBAL STATUS')]), 2)
+
+    def testWaitsForBusyServer(self):
+        db = MySQLMock(threads_running=[80, 60, 10])
+        replica = MySQLMock(lag=[30, 0])
+        pacer = rotatelib.DropPacer(batch_size=10, pause=0, max_threads_running=50, replicas=[replica],
+                                    max_replication_lag=5, check_interval=0.01)
+        rotatelib.remove_items(db=db, items=['t20090601', 't20090602'], pacer=pacer)
+        self.assertEqual(pacer.stats['waits'], 3)
+        self.assertEqual(len([sql for sql in db.executed if sql.startswith('DROP')]), 2)
+
+    def testGivesUpAfterMaxWait(self):
+        db = MySQLMock(threads_running=[80])
+        pacer = rotatelib.DropPacer(max_threads_running=50, check_interval=0.01, max_wait=0.05)
+        try:
+            rotatelib.remove_items(db=db, items=['t20090601'], pacer=pacer)
+            self.fail('RemovalError not raised')
+        except rotatelib.RemovalError, e:
+            self.assertTrue('Threads_running is 80' in str(e.failures[0][1]))
+        self.assertEqual([sql for sql in db.executed if sql.startswith('DROP')], [])
+        self.assertEqual(db.executed[-1], 'SET SESSION lock_wait_timeout = 50')
+
+    def testNoDropsWhileServerStaysBusy(self):
+        db = MySQLMock(threads_running=[100])
+        pacer = rotatelib.DropPacer(max_threads_running=50, check_interval=0.01, max_wait=0.03)
+        items = ['t%d' % i for i in range(5)]
+        try:
+            rotatelib.remove_items(db=db, items=items, pacer=pacer)
+            self.fail('RemovalError not raised')
+        except rotatelib.RemovalError, e:
+            self.assertEqual(sorted(item for item, error in e.failures), items)
+        self.assertEqual([sql for sql in db.executed if sql.startswith('DROP')], [])
+
+
+class TestDirectoryRotation(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outside = tempfile.mkdtemp()
+        open(os.path.join(self.outside, 'keep.txt'), 'w').close()
+        for name in ['2009-06-01T0300', '2009-06-02T0300', '2009-07-01T0300']:
+            for sub in ['a', 'a/b', 'c']:
+                os.makedirs(os.path.join(self.directory, name, sub))
+                for i in range(20):
+                    open(os.path.join(self.directory, name, sub, 'chunk%d' % i), 'w').close()
+            os.symlink(self.outside, os.path.join(self.directory, name, 'link'))
+        open(os.path.join(self.directory, '2009-06-01T0300.zip'), 'w').close()
+        os.mkdir(os.path.join(self.directory, 'current'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.outside)
+
+    def testListDirectories(self):
+        directories = rotatelib.list_directories(directory=self.directory, before=datetime.datetime(2009, 6, 30))
+        self.assertEqual(sorted(directories), ['2009-06-01T0300', '2009-06-02T0300'])
+
+    def testRemoveTrees(self):
+        directories = rotatelib.list_directories(directory=self.directory, before=datetime.datetime(2009, 6, 30))
+        self.assertRaises(rotatelib.RemovalError, rotatelib.remove_items, directory=self.directory, items=directories)
+        rotatelib.remove_items(directory=self.directory, items=directories, trees=True)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['2009-06-01T0300.zip', '2009-07-01T0300', 'current'])
+        self.assertEqual(os.listdir(self.outside), ['keep.txt'])
+
+    def testResumeTrees(self):
+        directories = rotatelib.list_directories(directory=self.directory, before=datetime.datetime(2009, 6, 30))
+        journal = os.path.join(self.outside, 'removal.journal')
+        # interrupted before anything was removed
+        remaining = rotatelib.remove_items(directory=self.directory, items=directories, trees=True, tree_workers=2,
+                                           deadline=datetime.datetime(2009, 1, 1), journal=journal)
+        self.assertEqual(sorted(remaining), ['2009-06-01T0300', '2009-06-02T0300'])
+        self.assertEqual(rotatelib.resume_removal(journal), 2)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['2009-06-01T0300.zip', '2009-07-01T0300', 'current'])
+
+    def testRemoveTree(self):
+        path = os.path.join(self.directory, '2009-07-01T0300')
+        self.assertEqual(rotatelib.remove_tree(path, max_workers=4), 4 + 60 + 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(os.path.join(self.outside, 'keep.txt')))
+
+
+class S3ResponseMock(object):
+    def __init__(self, body, status=200):
+        self.body = StringIO.StringIO(body)
+        self.status = status
+        self.reason = 'OK'
+
+    def read(self, size=-1):
+        return self.body.read(size)
+
+
+class S3RawConnectionMock(object):
+    """
+    Answers ListObjects requests with XML pages of `page_size` keys
+    """
+    page = """<?xml version="1.0" encoding="UTF-8"?>
+<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/"><Name>mybucket</Name><Prefix></Prefix>
+<MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>%s</ListBucketResult>"""
+    contents = """<Contents><Key>%s</Key><LastModified>2009-06-15T11:30:00.000Z</LastModified><ETag>&quot;abc&quot;</ETag>
+<Size>%d</Size><StorageClass>STANDARD</StorageClass></Contents>"""
+
+    def __init__(self, keys, page_size):
+        self.keys = sorted(keys)
+        self.page_size = page_size
+        self.requests = []
+
+    def make_request(self, method, bucket='', key='', headers=None, query_args=None):
+        self.requests.append(query_args)
+        params = dict(urlparse.parse_qsl(query_args))
+        keys = [k for k in self.keys if k.startswith(params.get('prefix', '')) and k > params.get('marker', '')]
+        page = keys[:self.page_size]
+        body = self.page % (self.page_size, 'true' if len(keys) > self.page_size else 'false',
+                            ''.join(self.contents % (cgi.escape(k), len(k)) for k in page))
+        return S3ResponseMock(body)
+
+
+class TestS3Records(unittest.TestCase):
+    keys = ['logs/a.log', 'backups/db 2009-06-01.zip', 'backups/db-2009-06-02.zip', 'backups/db-2009-07-01.zip',
+            'backups/db&2009-06-03.zip']
+
+    def testIterS3Keys(self):
+        s3 = S3RawConnectionMock(self.keys, 2)
+        records = list(rotatelib.iter_s3_keys(s3, 'mybucket', 'backups/', page_size=2))
+        self.assertEqual([record.key for record in records], sorted(self.keys)[:4])
+        self.assertEqual(records[0].size, len('backups/db 2009-06-01.zip'))
+        self.assertEqual(records[0].last_modified, '2009-06-15T11:30:00.000Z')
+        self.assertEqual(records[0].etag, '"abc"')
+        self.assertEqual(len(s3.requests), 2)
+        self.assertTrue('marker=backups%2Fdb%262009-06-03.zip' in s3.requests[1])
+
+    def testListArchives(self):
+        s3 = S3RawConnectionMock(self.keys, 1000)
+        archives = rotatelib.list_archives(s3bucket='mybucket', directory='backups/', s3_connection=s3, s3_records=True,
+                                           before=datetime.datetime(2009, 6, 30))
+        self.assertEqual([archive.key for archive in archives],
+                         ['backups/db 2009-06-01.zip', 'backups/db&2009-06-03.zip', 'backups/db-2009-06-02.zip'])
+        self.assertTrue(isinstance(archives[0], rotatelib.KeyRecord))
+
+    def testSimulatedConnection(self):
+        s3 = rotatelib.SimulatedS3Connection(page_size=2)
+        bucket = s3.create_bucket('mybucket')
+        for key in self.keys:
+            bucket.add_key(key, len(key), '2009-06-15T11:30:00.000Z')
+        archives = rotatelib.list_archives(s3bucket='mybucket', directory='backups/', s3_connection=s3, s3_records=True,
+                                           before=datetime.datetime(2009, 6, 30))
+        self.assertEqual([archive.key for archive in archives],
+                         ['backups/db 2009-06-01.zip', 'backups/db&2009-06-03.zip', 'backups/db-2009-06-02.zip'])
+        self.assertEqual(archives[1].size, len('backups/db&2009-06-03.zip'))
+        self.assertEqual(archives[1].last_modified, '2009-06-15T11:30:00.000Z')
+        self.assertEqual(s3.stats['list'], 2)
+
+
+class TestDeadlineRemoval(unittest.TestCase):
+    def setUp(self):
+        self.keys = [S3KeyMock('db2009-06-02.zip', 10), S3KeyMock('db.zip', 50), S3KeyMock('db2009-06-01.zip', 30),
+                     S3KeyMock('db2009-06-03.zip', 20)]
+        self.bucket = S3BucketMock(list(self.keys))
+        self.s3 = S3ConnectionMock({'mybucket': self.bucket})
+        self.executor = rotatelib.RemovalExecutor(max_workers=1)
+
+    def testPriority(self):
+        rotatelib.remove_items(items=self.keys, s3bucket='mybucket', s3_connection=self.s3, executor=self.executor, priority='oldest')
+        self.assertEqual(self.bucket.deleted, ['db2009-06-01.zip', 'db2009-06-02.zip', 'db2009-06-03.zip', 'db.zip'])
+        self.bucket.deleted = []
+        rotatelib.remove_items(items=self.keys, s3bucket='mybucket', s3_connection=self.s3, executor=self.executor, priority='newest')
+        self.assertEqual(self.bucket.deleted, ['db2009-06-03.zip', 'db2009-06-02.zip', 'db2009-06-01.zip', 'db.zip'])
+        self.bucket.deleted = []
+        rotatelib.remove_items(items=self.keys, s3bucket='mybucket', s3_connection=self.s3, executor=self.executor, priority='largest')
+        self.assertEqual(self.bucket.deleted, ['db.zip', 'db2009-06-01.zip', 'db2009-06-03.zip', 'db2009-06-02.zip'])
+        self.assertRaises(Exception, rotatelib.remove_items, items=self.keys, s3bucket='mybucket', s3_connection=self.s3,
+                          priority='smallest')
+
+    def testDeadline(self):
+        s3 = rotatelib.SimulatedS3Connection(latency=0.05)
+        bucket = s3.create_bucket('mybucket').fill(20, start=datetime.datetime(2009, 6, 30))
+        items = rotatelib.list_archives(s3bucket='mybucket', s3_connection=s3)
+        remaining = rotatelib.remove_items(items=items, s3bucket='mybucket', s3_connection=s3, executor=self.executor,
+                                           priority='oldest', deadline=0.12)
+        self.assertTrue(0 < len(remaining) < 20)
+        self.assertEqual(len(bucket), len(remaining))
+        self.assertEqual([key.key for key in remaining], sorted(key.key for key in remaining))
+        # the oldest went first, so the newest are left
+        self.assertEqual(remaining[-1].key, max(key.key for key in items))
+
+    def testDeadlinePassedWithJournal(self):
+        directory = tempfile.mkdtemp()
+        try:
+            journal = os.path.join(directory, 'journal')
+            remaining = rotatelib.remove_items(items=self.keys, s3bucket='mybucket', s3_connection=self.s3,
+                                               deadline=datetime.datetime(2009, 1, 1), journal=journal)
+            self.assertEqual(len(remaining), 4)
+            self.assertEqual(self.bucket.deleted, [])
+            self.assertEqual(rotatelib.resume_removal(journal, s3_connection=self.s3), 4)
+            self.assertEqual(len(self.bucket.deleted), 4)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestAggregate(unittest.TestCase):
+    def testStreamsTotalsPerBucket(self):
+        s3 = rotatelib.SimulatedS3Connection(page_size=10)
+        s3.create_bucket('mybucket').fill(72, prefix='db-', start=datetime.datetime(2009, 6, 3, 23), size=100)
+        s3.buckets['mybucket'].add_key('db.zip', 5)
+        by_day = rotatelib.aggregate(s3bucket='mybucket', s3_connection=s3, page_size=10)
+        self.assertEqual(by_day.items(), [
+            (datetime.datetime(2009, 6, 1), {'count': 24, 'bytes': 2400}),
+            (datetime.datetime(2009, 6, 2), {'count': 24, 'bytes': 2400}),
+            (datetime.datetime(2009, 6, 3), {'count': 24, 'bytes': 2400}),
+        ])
+        by_month = rotatelib.aggregate(s3bucket='mybucket', s3_connection=s3, by='month', before=datetime.datetime(2009, 6, 3))
+        self.assertEqual(by_month.items(), [(datetime.datetime(2009, 6, 1), {'count': 48, 'bytes': 4800})])
+
+    def testSnapshotSizesAreBytes(self):
+        key = S3KeyMock('db2009-06-01.zip', size=100)
+        snapshot = SnapshotMock(description='db2009-06-01', id='snap-1', volume_size='8')
+        self.assertEqual(rotatelib.aggregate(items=[key, snapshot]).items(),
+                         [(datetime.datetime(2009, 6, 1), {'count': 2, 'bytes': 8 * 1024 ** 3 + 100})])
+        self.assertEqual(rotatelib._prioritize([key, snapshot], 'largest', './'), [snapshot, key])
+
+    def testFilesAndErrors(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for name, size in [('a2009-06-01T10.zip', 3), ('b2009-06-01T10.log', 4), ('c2009-06-01T11.zip', 5), ('d.zip', 6)]:
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write('x' * size)
+            self.assertEqual(rotatelib.aggregate(directory=directory, by='hour', kind='archives').items(), [
+                (datetime.datetime(2009, 6, 1, 10), {'count': 1, 'bytes': 3}),
+                (datetime.datetime(2009, 6, 1, 11), {'count': 1, 'bytes': 5}),
+            ])
+            self.assertEqual(rotatelib.aggregate(directory=directory, by='year').items(),
+                             [(datetime.datetime(2009, 1, 1), {'count': 3, 'bytes': 12})])
+            self.assertRaises(Exception, rotatelib.aggregate, directory=directory, by='week')
+            self.assertRaises(Exception, rotatelib.aggregate, directory=directory, except_first='month')
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestEstimate(unittest.TestCase):
+    def setUp(self):
+        self.s3 = rotatelib.SimulatedS3Connection()
+        bucket = self.s3.create_bucket('mybucket')
+        for tenant in range(40):
+            bucket.fill(50 + tenant, prefix='tenant%02d/db-' % tenant, start=datetime.datetime(2009, 6, 30), step=datetime.timedelta(days=1), size=10)
+        bucket.add_key('README.zip', 5)
+
+    def testExactWithEverySample(self):
+        result = rotatelib.estimate('mybucket', s3_connection=self.s3, sample=40, before=datetime.datetime(2009, 6, 1))
+        self.assertEqual(result['prefixes'], 40)
+        # 40 tenants with 50..89 daily keys from June 30 back, 29 of each in June
+        matched = sum(50 + tenant - 30 for tenant in range(40))
+        self.assertEqual(result['matched'], {'estimate': matched, 'low': matched, 'high': matched})
+        self.assertEqual(result['listed']['estimate'], sum(50 + tenant for tenant in range(40)) + 1)
+        self.assertEqual(result['bytes']['estimate'], matched * 10)
+
+    def testSampleInterval(self):
+        self.s3.stats['list'] = 0
+        result = rotatelib.estimate('mybucket', s3_connection=self.s3, sample=8, seed=3, before=datetime.datetime(2009, 6, 1))
+        matched = sum(50 + tenant - 30 for tenant in range(40))
+        self.assertEqual(result['sampled'], 8)
+        self.assertTrue(result['matched']['low'] <= matched <= result['matched']['high'])
+        self.assertTrue(result['matched']['low'] < result['matched']['estimate'] < result['matched']['high'])
+        self.assertEqual(self.s3.stats['list'], 1 + 8)
+        even = rotatelib.estimate('mybucket', s3_connection=self.s3, prefixes=['tenant%02d/' % t for t in range(40)],
+                                  sample=4, spacing='even', before=datetime.datetime(2009, 6, 1))
+        self.assertEqual(even['listed']['estimate'], 10 * (50 + 60 + 70 + 80))
+        self.assertRaises(Exception, rotatelib.estimate, 'mybucket', s3_connection=self.s3, confidence=0.5)
+
+    def testFlatBucket(self):
+        s3 = rotatelib.SimulatedS3Connection(page_size=10)
+        bucket = s3.create_bucket('flat').fill(20000, prefix='db-', start=datetime.datetime(2009, 6, 30), size=10)
+        matched = len([name for name in bucket.keys if name < 'db-2009-01-01'])
+        s3.stats['list'] = 0
+        result = rotatelib.estimate('flat', s3_connection=s3, sample=10, seed=1, before=datetime.datetime(2009, 1, 1))
+        self.assertEqual((result['prefixes'], result['sampled']), (100, 10))
+        self.assertTrue(result['matched']['low'] <= matched <= result['matched']['high'])
+        # a full listing takes 2000 pages
+        self.assertTrue(s3.stats['list'] < 2000 / 3)
+
+
+class TestKeyLayout(unittest.TestCase):
+    def setUp(self):
+        self.s3 = rotatelib.SimulatedS3Connection(page_size=10)
+        bucket = self.s3.create_bucket('mybucket')
+        date = datetime.datetime(2026, 10, 16)
+        while date >= datetime.datetime(2024, 10, 17):
+            bucket.add_key(date.strftime('backups/%Y/%m/%d/db.tar.gz'), 10)
+            date -= datetime.timedelta(days=1)
+
+    def names(self, items):
+        return sorted(key.key for key in items)
+
+    def testListings(self):
+        layout = rotatelib.KeyLayout('%Y/%m/%d/')
+        listings = layout.listings('backups/', {'after': datetime.datetime(2025, 12, 30), 'before': datetime.datetime(2026, 3, 1)})
+        self.assertEqual([prefix for prefix, marker, stop in listings],
+                         ['backups/2025/12/30/', 'backups/2025/12/31/', 'backups/2026/01/', 'backups/2026/02/'])
+        self.assertEqual(layout.listings('backups/', {'before': datetime.datetime(2025, 1, 10, 12)}),
+                         [('backups/', None, 'backups/2025/01/11')])
+        self.assertEqual(layout.listings('backups/', {'year': 2025, 'day': [1, 15], 'startswith': 'backups/2025/06'}),
+                         [('backups/2025/06/01/', None, None), ('backups/2025/06/15/', None, None)])
+        self.assertEqual(layout.listings('backups/', {'after': datetime.datetime(2026, 1, 1), 'before': datetime.datetime(2025, 1, 1)}), [])
+        self.assertEqual(rotatelib.KeyLayout('db-%Y%m%d').render(datetime.datetime(2026, 10, 16), 2), 'db-202610')
+        self.assertRaises(Exception, rotatelib.KeyLayout, '%d/%m/%Y')
+        self.assertEqual(layout.parse_date('backups/2026/10/16/db.tar.gz', 'backups/'), datetime.datetime(2026, 10, 16))
+        self.assertEqual(layout.parse_date('backups/2026/13/16/db.tar.gz', 'backups/'), None)
+        self.assertEqual(layout.parse_date('other/2026/10/16/db.tar.gz', 'backups/'), None)
+
+    def testPushdown(self):
+        queries = [
+            {'before': datetime.datetime(2025, 1, 10)},
+            {'after': datetime.datetime(2026, 9, 30)},
+            {'after': datetime.datetime(2025, 2, 14), 'before': datetime.datetime(2025, 4, 2)},
+            {'year': 2025, 'day': 1},
+        ]
+        keys = sorted(self.s3.get_bucket('mybucket').keys)
+        self.s3.stats['list'] = 0
+        # without the layout, the slashed dates are not dates
+        self.assertEqual(rotatelib.list_archives(directory='backups/', s3bucket='mybucket', s3_connection=self.s3), [])
+        full = self.s3.stats['list']
+        for query in queries:
+            expected = []
+            for key in keys:
+                date = datetime.datetime.strptime(key[8:18], '%Y/%m/%d')
+                if (date < query.get('before', datetime.datetime.max) and date > query.get('after', datetime.datetime.min) and
+                        date.year == query.get('year', date.year) and date.day == query.get('day', date.day)):
+                    expected.append(key)
+            self.s3.stats['list'] = 0
+            items = rotatelib.list_archives(directory='backups/', s3bucket='mybucket', s3_connection=self.s3,
+                                            key_layout='%Y/%m/%d/', **query)
+            self.assertEqual(self.names(items), expected)
+            self.assertTrue(self.s3.stats['list'] < full, query)
+        stats = rotatelib.rotate(directory='backups/', s3bucket='mybucket', s3_connection=self.s3, key_layout='%Y/%m/%d/',
+                                 before=datetime.datetime(2024, 11, 1))
+        self.assertEqual(stats, {'listed': 15, 'matched': 15, 'removed': 15})
+
+
+class TestDirectoryWatch(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ['db-2009-06-01T0300.zip', 'db-2009-06-15T0300.zip', 'db-2009-07-01T0300.zip', 'notes.txt']:
+            open(os.path.join(self.directory, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def changes(self, watch):
+        # events can take a moment to show up
+        changed = watch.update(1)
+        while watch.update(0.05):
+            pass
+        return changed
+
+    def testEvents(self):
+        now = datetime.datetime(2009, 7, 20)
+        with rotatelib.watch_directory(self.directory, before=datetime.timedelta(30)) as watch:
+            if watch.inotify is None:
+                self.skipTest('inotify is not available')
+            self.assertEqual(watch.items(now), ['db-2009-06-01T0300.zip', 'db-2009-06-15T0300.zip'])
+            self.assertEqual(watch.stats['evaluated'], 4)
+
+            open(os.path.join(self.directory, 'db-2009-05-01T0300.zip'), 'w').close()
+            os.rename(os.path.join(self.directory, 'db-2009-06-15T0300.zip'), os.path.join(self.directory, 'db-2009-06-16T0300.zip'))
+            os.unlink(os.path.join(self.directory, 'db-2009-06-01T0300.zip'))
+            self.changes(watch)
+            self.assertEqual(watch.items(now), ['db-2009-05-01T0300.zip', 'db-2009-06-16T0300.zip'])
+            self.assertEqual(watch.stats['evaluated'], 4 + 2)
+            self.assertEqual(watch.stats['rescans'], 1)
+
+            # a clock tick only moves the cutoff
+            self.assertEqual(watch.items(datetime.datetime(2009, 8, 1)), ['db-2009-05-01T0300.zip', 'db-2009-06-16T0300.zip', 'db-2009-07-01T0300.zip'])
+            self.assertEqual(watch.stats['evaluated'], 6)
+
+    def testRescan(self):
+        now = datetime.datetime(2009, 7, 20)
+        watch = rotatelib.watch_directory(self.directory, use_inotify=False, before=datetime.timedelta(30),
+                                          after=datetime.datetime(2009, 6, 10))
+        self.assertEqual(watch.items(now), ['db-2009-06-15T0300.zip'])
+        open(os.path.join(self.directory, 'db-2009-06-12T0300.zip'), 'w').close()
+        os.unlink(os.path.join(self.directory, 'db-2009-06-15T0300.zip'))
+        self.assertEqual(watch.update(), 2)
+        self.assertEqual(watch.items(now), ['db-2009-06-12T0300.zip'])
+        self.assertEqual(watch.stats['evaluated'], 5)
+        self.assertRaises(Exception, rotatelib.watch_directory, self.directory, except_first='month')
+        self.assertRaises(Exception, rotatelib.watch_directory, self.directory, date_source='timestamp')
+
+    def testMtime(self):
+        for name, mtime in [('a1b2c3', 1245065400), ('d4e5f6', time.time())]:
+            open(os.path.join(self.directory, name), 'w').close()
+            os.utime(os.path.join(self.directory, name), (mtime, mtime))
+        with rotatelib.watch_directory(self.directory, kind='items', date_source='mtime', before=datetime.timedelta(30)) as watch:
+            self.assertEqual(watch.items(), ['a1b2c3'])
+            if watch.inotify is None:
+                self.skipTest('inotify is not available')
+            # touching a file is an event too
+            os.utime(os.path.join(self.directory, 'd4e5f6'), (1245065400, 1245065400))
+            self.changes(watch)
+            self.assertEqual(watch.items(), ['a1b2c3', 'd4e5f6'])
+
+
+class TestEC2RotationFunctions(unittest.TestCase):
+    def setUp(self):
+        self.executor = rotatelib.RemovalExecutor(backoff_base=0.001)
+        self.snapshots = [
+            SnapshotMock('backup20090601', id='snap-1', volume_id='vol-1'),
+            SnapshotMock('backup20090602', id='snap-2', volume_id='vol-1'),
+            SnapshotMock('backup20090603', id='snap-3', volume_id='vol-1'),
+            SnapshotMock('backup20090604', id='snap-4', volume_id='vol-2'),
+            SnapshotMock('backup20090605', id='snap-5', volume_id='vol-1', status='pending'),
+        ]
+
+    def testListArchivesSendsFiltersAndPages(self):
+        ec2 = EC2ConnectionMock(self.snapshots)
+        archives = rotatelib.list_archives(ec2snapshots=True, ec2_connection=ec2, snapshot_volume='vol-1',
+                                           snapshot_status='completed', snapshot_page_size=2,
+                                           before=datetime.datetime(2009, 6, 3))
+        self.assertEqual([a.id for a in archives], ['snap-1', 'snap-2'])
+        self.assertEqual(len(ec2.requests), 2)
+        self.assertEqual(ec2.requests[0]['Filters'], {'volume-id': 'vol-1', 'status': 'completed'})
+        self.assertEqual(ec2.requests[0]['MaxResults'], 2)
+        self.assertEqual(ec2.requests[1]['NextToken'], '2')
+
+    def testRemoveItemsRetriesThrottledSnapshots(self):
+        ec2 = EC2ConnectionMock(self.snapshots, errors={'snap-1': ['RequestLimitExceeded', 'RequestLimitExceeded']})
+        rotatelib.remove_items(items=self.snapshots[:3], ec2snapshots=True, ec2_connection=ec2, executor=self.executor)
+        self.assertEqual(sorted(ec2.deleted), ['snap-1', 'snap-2', 'snap-3'])
+
+    def testRemoveItemsReportsFailedSnapshots(self):
+        ec2 = EC2ConnectionMock(self.snapshots, errors={'snap-1': ['InvalidSnapshot.InUse'], 'snap-2': ['InvalidSnapshot.NotFound']})
+        try:
+            rotatelib.remove_items(items=['snap-1', 'snap-2', 'snap-3'], ec2snapshots=True, ec2_connection=ec2,
+                                   executor=self.executor)
+            self.fail('RemovalError was not raised')
+        except rotatelib.RemovalError, e:
+            self.assertEqual([item for item, error in e.failures], ['snap-1'])
+        self.assertEqual(ec2.deleted, ['snap-3'])
+
+
+class TestRemovalExecutor(unittest.TestCase):
+    def testControllerBacksOffAndRecovers(self):
+        controller = rotatelib.executor.AIMDController(initial=8, maximum=16, cooldown=0)
+        controller.on_throttle()
+        self.assertEqual(controller.concurrency(), 4)
+        for i in range(20):
+            controller.on_success(0.01)
+        self.assertTrue(controller.concurrency() > 4)
+        controller = rotatelib.executor.AIMDController(initial=8, latency_target=0.5, cooldown=0)
+        controller.on_success(1.0)
+        self.assertEqual(controller.concurrency(), 4)
+
+    def testRunRetriesThrottledItems(self):
+        attempts = {}
+
+        def remove(item):
+            attempts[item] = attempts.get(item, 0) + 1
+            if item % 3 == 0 and attempts[item] < 3:
+                raise EC2ErrorMock('SlowDown')
+            if item == 7:
+                raise ValueError('broken')
+
+        executor = rotatelib.RemovalExecutor(max_workers=4, backoff_base=0.001)
+        failures = executor.run(remove, range(20))
+        self.assertEqual([item for item, e in failures], [7])
+        self.assertEqual(executor.stats['removed'], 19)
+        self.assertEqual(executor.stats['throttled'], 14)
+
+    def testRemoveFilesReportsFailures(self):
+        directory = tempfile.mkdtemp()
+        try:
+            open(os.path.join(directory, 'test20090601.zip'), 'w').close()
+            os.mkdir(os.path.join(directory, 'test20090602.zip'))
+            try:
+                rotatelib.remove_items(directory=directory, items=['test20090601.zip', 'test20090602.zip', 'gone.zip'])
+                self.fail('RemovalError was not raised')
+            except rotatelib.RemovalError, e:
+                self.assertEqual([item for item, error in e.failures], ['test20090602.zip'])
+            self.assertEqual(os.listdir(directory), ['test20090602.zip'])
+        finally:
+            shutil.rmtree(directory)
+
+
 class TestDBRotationFunctions(unittest.TestCase):
     def create_tables(self, db, tables):
         cur = db.cursor()